@@ -39,26 +39,80 @@ def parse_arguments():
 def server():
     from polyai.server import loader
     from polyai.server import endpoints
+    from polyai.server import tools
+    from polyai.server import database
+    from polyai.server import orm
+    from polyai.server import auth
+    from polyai.server import ratelimit
+    from polyai.server import embed_cache
+    from polyai.server import vector_index
+    from polyai.server import serializer
 
     _start = False
 
+    serializer.use(sett.Server.json_backend)
+
+    database.configure(
+        sett.Postgres.pool_size, sett.Postgres.pool_overflow,
+        sett.Postgres.pool_pre_ping, sett.Postgres.pool_recycle)
+
+    tools.init_writer(
+        sett.Postgres.write_queue, sett.Postgres.write_batch,
+        sett.Postgres.write_interval, sett.Postgres.write_overflow,
+        sett.Postgres.spill_file, sett.Postgres.spool_dir)
+
+    # The upserts need unique indexes missing from older databases.
+    try:
+        orm.create_indexes(database.engine())
+    except Exception as err:
+        log.warn("Could not check the database indexes: {}", err)
+
+    auth.init_auth(
+        sett.Server.require_api_key, sett.Server.key_cache_ttl,
+        sett.Server.key_negative_ttl, sett.Server.key_cache_size,
+        sett.Server.key_refresh_interval)
+
+    ratelimit.init_limits(sett.Server.rate_limits, sett.Server.rate_burst)
+
+    embed_cache.init_cache(
+        sett.TextGen.embed_cache_dir, sett.TextGen.embed_cache_memory_mb,
+        sett.TextGen.embed_cache_disk_mb)
+    vector_index.init_index(
+        sett.TextGen.search_index_dir, sett.TextGen.search_nlist,
+        sett.TextGen.search_nprobe)
+
     if sett.Model.model_file_path:
         exllama = loader.init_exllama(
             sett.TextGen.user_fmt,
             sett.TextGen.bot_fmt,
             sett.TextGen.instruction_fmt,
-            sett.Model.vram_config, sett.TextGen.context_length)
+            sett.Model.vram_config, sett.TextGen.context_length,
+            sett.TextGen.max_batch_size, sett.TextGen.prefix_cache_mb,
+            sett.TextGen.num_draft_tokens, sett.Server.queue_depth,
+            sett.Server.queue_timeout, sett.Server.queue_token_budget,
+            sett.Server.queue_depth_per_key, sett.TextGen.embed_batch_tokens)
 
         exllama.load_model(sett.Model.model_file_path)
         _start = True
 
+        if sett.Model.draft_file_path:
+            exllama.load_draft_model(sett.Model.draft_file_path)
+
         if sett.Model.lora_file_path:
             exllama.add_lora(sett.Model.lora_file_path)
     else:
         log.error("No language model file specified.")
 
     if sett.Model.bert_file_path:
-        bert = loader.init_bert(sett.Model.bert_device)
+        bert = loader.init_bert(sett.Model.bert_device,
+                                sett.TextGen.embed_batch_tokens,
+                                sett.Model.bert_batch_size,
+                                sett.Model.bert_batch_wait_ms,
+                                sett.Model.bert_ner_words,
+                                sett.Model.bert_ner_stride,
+                                sett.Model.bert_cpu_mode,
+                                sett.Model.bert_cpu_threads,
+                                sett.Model.bert_cpu_workers)
         bert.load_model(sett.Model.bert_file_path)
         _start = True
     else:
@@ -71,7 +125,11 @@ def server():
             streaming_port=sett.Server.stream_endpoint_port,
             listen=sett.Server.listen_all,
             ssl=sett.Server.use_ssl,
-            debug=sett.Server.debug
+            debug=sett.Server.debug,
+            mode=sett.Server.server_mode,
+            threads=sett.Server.server_threads,
+            keep_alive=sett.Server.keep_alive,
+            drain_timeout=sett.Server.drain_timeout,
         )
 
 
@@ -1,6 +1,6 @@
 import time
 import pylogg
-from polyai.api import engine, error
+from polyai.api import engine, error, util
 
 log = pylogg.New("polyai")
 
@@ -13,15 +13,20 @@ class ChatCompletion(engine.APIEngine):
         start = time.time()
         timeout = kwargs.pop("timeout", None)
 
+        attempt = 0
         while True:
             try:
                 return super().create(*args, **kwargs)
-                
-            except error.TryAgain as e:
-                if timeout is not None and time.time() > start + timeout:
+
+            except (error.TryAgain, error.RateLimitError,
+                    error.ServiceUnavailableError) as e:
+                delay = util.retry_delay(e, attempt)
+                if timeout is not None and time.time() + delay > start + timeout:
                     raise
 
-                log.note("Waiting for model to warm up: error={}", e)
+                log.note("Server busy, retrying in {:.1f}s: error={}", delay, e)
+                time.sleep(delay)
+                attempt += 1
 
 
 class Completion(ChatCompletion):
@@ -1,6 +1,6 @@
 import time
 import pylogg
-from polyai.api import engine, error
+from polyai.api import engine, error, util
 
 log = pylogg.New("polyai")
 
@@ -10,15 +10,31 @@ class TextEmbedding(engine.APIEngine):
 
     @classmethod
     def create(cls, *args, **kwargs):
+        """
+        Embed the text. With encoding_format="base64" or "binary", and
+        optionally dtype="float16", the vectors are sent as bytes instead of
+        a json list of numbers. Use helpers.embeddings() to decode them.
+        """
         start = time.time()
         timeout = kwargs.pop("timeout", None)
 
+        if kwargs.get("encoding_format") == "binary":
+            # The raw bytes are requested by the Accept header.
+            kwargs.pop("encoding_format")
+            kwargs["headers"] = dict(kwargs.get("headers") or {},
+                                     Accept="application/octet-stream")
+
+        attempt = 0
         while True:
             try:
                 return super().create(*args, **kwargs)
-                
-            except error.TryAgain as e:
-                if timeout is not None and time.time() > start + timeout:
+
+            except (error.TryAgain, error.RateLimitError,
+                    error.ServiceUnavailableError) as e:
+                delay = util.retry_delay(e, attempt)
+                if timeout is not None and time.time() + delay > start + timeout:
                     raise
 
-                log.note("Waiting for model to warm up: error={}", e)
+                log.note("Server busy, retrying in {:.1f}s: error={}", delay, e)
+                time.sleep(delay)
+                attempt += 1
@@ -1,4 +1,5 @@
 import os
+import base64
 import polyai.api
 
 
@@ -42,8 +43,25 @@ def model_ner(respObj):
     return respObj['ner_tags']
 
 def embeddings(respObj):
-    """ Extract the NER tag list from the response json. """
-    return respObj['embeddings']
+    """
+    Extract the embeddings from the response json. The base64 or binary
+    encoded ones are decoded into a numpy array, of a single vector for a
+    single text, or of shape [texts, dim].
+    """
+    data = respObj['embeddings']
+    encoding = respObj.get('encoding_format', 'float')
+    if encoding == 'float':
+        return data
+
+    import numpy as np
+    dtype = np.dtype(respObj['dtype']).newbyteorder("<")
+    if encoding == 'binary':
+        return np.frombuffer(data, dtype=dtype).reshape(respObj['shape'])
+
+    if type(data) == str:
+        return np.frombuffer(base64.b64decode(data), dtype=dtype)
+    raw = b"".join(base64.b64decode(v) for v in data)
+    return np.frombuffer(raw, dtype=dtype).reshape(len(data), -1)
 
 def generation_time(repsObj):
     """ Return the generation time in miliseconds. """
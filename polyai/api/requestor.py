@@ -256,6 +256,14 @@ class APIRequestor:
                                               for line in parse_stream(result.iter_lines())
             ), True
 
+        elif "application/octet-stream" in result.headers.get("Content-Type", "") \
+                and 200 <= result.status_code < 300:
+            # Raw bytes, e.g. embeddings, the rest of the response is json
+            # in a header.
+            data = json.loads(result.headers.get("X-PolyAI-Meta", "{}"))
+            data['embeddings'] = result.content
+            return PolyAIResponse(data, result.headers), False
+
         else:
             return (self._interpret_response_line(result.content.decode("utf-8"),
                                                   result.status_code, result.headers,
@@ -8,6 +8,9 @@ class PolyAIResponse:
     def __getitem__(self, item):
             return self.data[item]
     
+    def get(self, item, default=None):
+        return self.data.get(item, default)
+
     def dict(self):
         return self.data
 
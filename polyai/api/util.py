@@ -1,6 +1,9 @@
+import random
 import polyai.api
 from urllib.parse import urlparse
 
+MAX_RETRY_DELAY = 30
+
 
 def default_api_key() -> str:
     if polyai.api.api_key_path:
@@ -17,6 +20,20 @@ def default_api_key() -> str:
         )
 
 
+def retry_delay(err, attempt : int) -> float:
+    """
+    Seconds to wait before retrying a request that failed with err.
+    Uses the Retry-After header if the server sent one, else an exponential
+    backoff with jitter.
+    """
+    try:
+        delay = float(err.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        delay = 0.5 * 2 ** min(attempt, 6)
+        delay *= random.uniform(0.5, 1.0)
+    return min(delay, MAX_RETRY_DELAY)
+
+
 def create_ssh_tunnel():
     """
     Update the API endpoint URL to connect via SSH tunnel.
@@ -0,0 +1,243 @@
+""" Admission control in front of the LLM.
+
+    Requests wait in a bounded queue until a generation slot is free and
+    the tokens they may take up, prompt + max_new_tokens, fit in the token
+    budget of the running requests. A request is rejected right away when
+    the queue is full, and leaves the queue if its deadline passes before
+    it is admitted. Either way the client is told how many seconds to wait
+    before retrying, estimated from the recent service times.
+
+    The queue is shared fairly by the clients, identified by a key, e.g.
+    their API key. Each request gets a start tag in virtual time, the later
+    of the current virtual time and the end of the previous request of the
+    same key, where a request lasts tokens / weight. The request with the
+    smallest tag goes next. So a client that queued many requests at once
+    waits for its own, while a client with one request goes ahead of them,
+    and clients with a larger weight get a larger share. Requests of the
+    same key are still served in arrival order.
+
+    A request larger than the whole budget is still admitted once nothing
+    else is running, so it is slow but never starved.
+"""
+import math
+import time
+import threading
+import contextlib
+import collections
+
+import pylogg
+
+log = pylogg.New("queue")
+
+
+class Overloaded(Exception):
+    """ Request was not admitted. Retry after retry_after seconds. """
+    status = 503
+
+    def __init__(self, message : str, retry_after : int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFull(Overloaded):
+    """ The queue was full when the request arrived. """
+    status = 429
+
+
+class QueueTimeout(Overloaded):
+    """ The deadline of the request passed while it was queued. """
+    status = 503
+
+
+class _Ticket:
+    __slots__ = ('key', 'tag', 'seq')
+
+    def __init__(self, key, tag : float, seq : int):
+        self.key = key
+        self.tag = tag
+        self.seq = seq
+
+
+class AdmissionQueue:
+    """
+    Bounded fair queue gating access to the model.
+
+    Args:
+        max_depth:      Max number of waiting requests, 0 to never wait.
+        max_running:    Max number of requests generating at once, i.e. the
+                        batch size of the scheduler, or 1.
+        token_budget:   Max prompt + new tokens of the running requests,
+                        0 for no limit.
+        timeout:        Seconds a request may wait before it is admitted,
+                        0 to wait forever. Requests may ask for less.
+        max_per_key:    Max number of waiting requests of one key, 0 for
+                        max_depth.
+    """
+
+    def __init__(self, max_depth : int = 16, max_running : int = 1,
+                 token_budget : int = 0, timeout : float = 60.0,
+                 max_per_key : int = 0):
+        self.max_depth = max_depth
+        self.max_running = max(1, max_running)
+        self.token_budget = token_budget
+        self.timeout = timeout
+        self.max_per_key = max_per_key or max_depth
+
+        self._cond = threading.Condition()
+        self._waiting : list[_Ticket] = []
+        self._per_key = collections.Counter()   # waiting tickets by key
+        self._finish = {}                       # virtual end time by key
+        self._vtime = 0.0
+        self._seq = 0
+        self._running = 0
+        self._running_tokens = 0
+        self._service_time : float = None       # moving average, seconds
+        self._waits = collections.deque(maxlen=1024)
+
+        self.total_admitted = 0
+        self.total_rejected = 0
+        self.total_expired = 0
+        self.total_completed = 0
+
+    def depth(self) -> int:
+        return len(self._waiting)
+
+    def stats(self) -> dict:
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                'depth': len(self._waiting),
+                'max_depth': self.max_depth,
+                'keys_waiting': len(self._per_key),
+                'running': self._running,
+                'max_running': self.max_running,
+                'running_tokens': self._running_tokens,
+                'token_budget': self.token_budget,
+                'admitted': self.total_admitted,
+                'rejected': self.total_rejected,
+                'expired': self.total_expired,
+                'completed': self.total_completed,
+                'wait_avg_ms': 1000 * sum(waits) / len(waits) if waits else 0.0,
+                'wait_p50_ms': 1000 * _percentile(waits, 0.50),
+                'wait_p95_ms': 1000 * _percentile(waits, 0.95),
+                'wait_max_ms': 1000 * waits[-1] if waits else 0.0,
+                'service_avg_ms': 1000 * (self._service_time or 0.0),
+                'retry_after': self._retry_after(),
+            }
+
+    def _fits(self, tokens : int) -> bool:
+        if self._running >= self.max_running:
+            return False
+        if self.token_budget <= 0 or self._running == 0:
+            return True
+        return self._running_tokens + tokens <= self.token_budget
+
+    def _retry_after(self) -> int:
+        """ Seconds until the requests ahead are expected to be done. """
+        service = self._service_time or 1.0
+        ahead = len(self._waiting) + self._running
+        return max(1, math.ceil(service * ahead / self.max_running))
+
+    def _head(self) -> _Ticket:
+        """ The waiting ticket to be admitted next. """
+        return min(self._waiting, key=lambda t: (t.tag, t.seq))
+
+    def _enqueue(self, key, tokens : int, weight : float) -> _Ticket:
+        start = max(self._vtime, self._finish.get(key, 0.0))
+        self._finish[key] = start + tokens / (weight if weight > 0 else 1.0)
+        self._seq += 1
+        ticket = _Ticket(key, start, self._seq)
+        self._waiting.append(ticket)
+        self._per_key[key] += 1
+        return ticket
+
+    def _dequeue(self, ticket : _Ticket):
+        self._waiting.remove(ticket)
+        self._per_key[ticket.key] -= 1
+        if self._per_key[ticket.key] <= 0:
+            del self._per_key[ticket.key]
+
+    def _advance(self, ticket : _Ticket):
+        """ Move the virtual time to an admitted ticket. """
+        self._vtime = max(self._vtime, ticket.tag)
+        # Keys that are idle and behind the virtual time start over.
+        for key in [k for k, end in self._finish.items()
+                    if end <= self._vtime and k not in self._per_key]:
+            del self._finish[key]
+
+    def _acquire(self, tokens : int, timeout : float = None, key = None,
+                 weight : float = 1.0):
+        arrived = time.time()
+        if not timeout or timeout <= 0:
+            timeout = self.timeout
+        elif self.timeout > 0:
+            timeout = min(timeout, self.timeout)
+        deadline = arrived + timeout if timeout > 0 else None
+
+        with self._cond:
+            if self._waiting or not self._fits(tokens):
+                if len(self._waiting) >= self.max_depth or \
+                        self._per_key[key] >= self.max_per_key:
+                    self.total_rejected += 1
+                    log.warn("Request rejected, queue full: depth={} key={}",
+                             len(self._waiting), self._per_key[key])
+                    raise QueueFull("Request queue is full.",
+                                    self._retry_after())
+
+                ticket = self._enqueue(key, tokens, weight)
+                while self._head() is not ticket or not self._fits(tokens):
+                    remaining = None if deadline is None \
+                                else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self._dequeue(ticket)
+                        self.total_expired += 1
+                        self._cond.notify_all()
+                        log.warn("Request expired in queue after {:.1f}s",
+                                 time.time() - arrived)
+                        raise QueueTimeout("Request deadline passed in queue.",
+                                           self._retry_after())
+                    self._cond.wait(remaining)
+                self._dequeue(ticket)
+                self._advance(ticket)
+
+            self._running += 1
+            self._running_tokens += tokens
+            self.total_admitted += 1
+            self._waits.append(time.time() - arrived)
+
+            # The next in line may fit as well.
+            self._cond.notify_all()
+
+    def _release(self, tokens : int, elapsed : float):
+        with self._cond:
+            self._running -= 1
+            self._running_tokens -= tokens
+            self.total_completed += 1
+            if self._service_time is None:
+                self._service_time = elapsed
+            else:
+                self._service_time += 0.2 * (elapsed - self._service_time)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def admit(self, tokens : int, timeout : float = None, key = None,
+              weight : float = 1.0):
+        """
+        Wait for the turn of a request that may take up the given number of
+        tokens, and hold its slot until the block exits. key identifies the
+        client for the fair share, and weight is its relative share. Raises
+        QueueFull or QueueTimeout if the request is not admitted.
+        """
+        self._acquire(tokens, timeout, key, weight)
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self._release(tokens, time.time() - t0)
+
+
+def _percentile(values : list, q : float) -> float:
+    """ Percentile of a sorted list. """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
@@ -0,0 +1,332 @@
+""" Authentication of the requests by their API key.
+
+    The rows of the api_key table are cached in memory, so checking a key is
+    a dictionary lookup. A key that is not cached is loaded from the database
+    once, even if many requests ask for it at the same time. Valid keys are
+    kept for ttl seconds, and unknown keys for negative_ttl seconds, in two
+    separate LRU caches, so a flood of bad keys cannot evict the good ones.
+
+    A background thread reloads the cached keys every refresh_interval
+    seconds with one query per chunk of keys, so role changes and revoked
+    keys take effect without waiting for the ttl. Until a key is reloaded,
+    its expired entry is still used. If the database is down, the cached
+    keys keep working and unknown keys are answered with a 503.
+"""
+import time
+import threading
+import collections
+from dataclasses import dataclass
+
+from flask import g, jsonify, make_response, request
+
+import pylogg
+
+log = pylogg.New("auth")
+
+HEADER = "Api-Key"
+KEY_PREFIX = "pl-"
+MAX_KEY_LEN = 40
+REFRESH_CHUNK = 500
+
+
+class AuthUnavailable(Exception):
+    """ The key is not cached and could not be loaded from the database. """
+
+
+@dataclass(frozen=True)
+class Identity:
+    """ The cached columns of an APIKey row. """
+    apikey : str
+    name : str
+    role : int
+    organization : str = None
+
+    @classmethod
+    def of(cls, row) -> 'Identity':
+        return cls(row.apikey, row.name, row.role, row.organization)
+
+
+def load_keys(keys : list) -> dict:
+    """ Load the api_key rows of the given keys from the database. """
+    from sqlalchemy import select
+    from polyai.server import orm, database
+
+    with database.session() as db:
+        rows = db.scalars(select(orm.APIKey)
+                          .where(orm.APIKey.apikey.in_(keys))).all()
+        return {row.apikey: Identity.of(row) for row in rows}
+
+
+class KeyCache:
+    """
+    In-process cache of the API keys.
+
+    Args:
+        ttl:                Seconds a valid key is trusted without a reload.
+        negative_ttl:       Seconds an unknown key is rejected without a
+                            reload, 0 to not cache unknown keys.
+        max_size:           Max number of valid keys cached.
+        max_negative:       Max number of unknown keys cached.
+        refresh_interval:   Seconds between background reloads, 0 to reload
+                            expired keys on the request thread instead.
+        loader:             Function of a list of keys returning a dict of
+                            the found ones to their Identity. load_keys()
+                            if None.
+    """
+
+    def __init__(self, ttl : float = 300, negative_ttl : float = 30,
+                 max_size : int = 10000, max_negative : int = 10000,
+                 refresh_interval : float = 60, loader = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.max_negative = max_negative
+        self.refresh_interval = refresh_interval
+        self.loader = loader or load_keys
+
+        self._lock = threading.Lock()
+        self._keys = collections.OrderedDict()      # key: (Identity, expiry)
+        self._bad = collections.OrderedDict()       # key: expiry
+        self._loading = {}                          # key: threading.Event
+        self._thread : threading.Thread = None
+        self._stop = threading.Event()
+
+        self.total_hits = 0
+        self.total_stale_hits = 0
+        self.total_negative_hits = 0
+        self.total_misses = 0
+        self.total_loads = 0
+        self.total_load_errors = 0
+        self.total_refreshes = 0
+        self.total_revoked = 0
+        self.total_evicted = 0
+        self.total_rejected = 0
+        self._load_times = collections.deque(maxlen=256)
+
+    def start(self):
+        if self._thread is None and self.refresh_interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._refresh_loop,
+                                            daemon=True, name="key-refresh")
+            self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self._bad.clear()
+
+    def get(self, key : str) -> Identity:
+        """
+        Identity of a key, or None if it is not valid. Raises AuthUnavailable
+        if the key had to be loaded and the database is down.
+        """
+        if not key or not key.startswith(KEY_PREFIX) or len(key) > MAX_KEY_LEN:
+            self.total_rejected += 1
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is not None:
+                self._keys.move_to_end(key)
+                if entry[1] > now:
+                    self.total_hits += 1
+                    return entry[0]
+                if self._thread is not None:
+                    # The refresh thread will reload it.
+                    self.total_stale_hits += 1
+                    return entry[0]
+
+            elif key in self._bad:
+                if self._bad[key] > now:
+                    self.total_negative_hits += 1
+                    return None
+                del self._bad[key]
+
+            self.total_misses += 1
+            loading = self._loading.get(key)
+            if loading is None:
+                self._loading[key] = threading.Event()
+
+        if loading is not None:
+            # Another request is loading the same key.
+            loading.wait()
+            return self._cached(key, entry)
+
+        try:
+            return self._load(key, entry)
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+
+    def _cached(self, key : str, stale : tuple) -> Identity:
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is not None:
+                return entry[0]
+            if key in self._bad:
+                return None
+        if stale is not None:
+            return stale[0]
+        raise AuthUnavailable("API key could not be verified.")
+
+    def _load(self, key : str, stale : tuple) -> Identity:
+        t0 = time.time()
+        try:
+            found = self.loader([key])
+        except Exception as err:
+            self.total_load_errors += 1
+            log.error("Loading API key failed: {}", err)
+            if stale is not None:
+                return stale[0]
+            raise AuthUnavailable("API key could not be verified.") from err
+
+        self.total_loads += 1
+        self._load_times.append(time.time() - t0)
+        self._store(found, [key])
+        return found.get(key)
+
+    def _store(self, found : dict, keys : list):
+        """ Cache the loaded keys, and the requested ones not found. """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                identity = found.get(key)
+                if identity is not None:
+                    self._keys[key] = (identity, now + self.ttl)
+                    self._keys.move_to_end(key)
+                    self._bad.pop(key, None)
+                    continue
+
+                if self._keys.pop(key, None) is not None:
+                    self.total_revoked += 1
+                    log.info("API key revoked: {}...", key[:8])
+                if self.negative_ttl > 0:
+                    self._bad[key] = now + self.negative_ttl
+                    self._bad.move_to_end(key)
+
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+                self.total_evicted += 1
+            while len(self._bad) > self.max_negative:
+                self._bad.popitem(last=False)
+
+    def refresh(self):
+        """ Reload the cached valid keys, and forget the expired bad ones. """
+        now = time.monotonic()
+        with self._lock:
+            keys = list(self._keys)
+            for key in [k for k, expiry in self._bad.items() if expiry <= now]:
+                del self._bad[key]
+
+        for i in range(0, len(keys), REFRESH_CHUNK):
+            chunk = keys[i:i + REFRESH_CHUNK]
+            try:
+                found = self.loader(chunk)
+            except Exception as err:
+                self.total_load_errors += 1
+                log.error("Refreshing {} API keys failed: {}", len(keys), err)
+                return
+            self._store(found, chunk)
+        self.total_refreshes += 1
+        log.trace("Refreshed {} API keys.", len(keys))
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def stats(self) -> dict:
+        lookups = self.total_hits + self.total_stale_hits \
+                  + self.total_negative_hits + self.total_misses
+        times = sorted(self._load_times)
+        return {
+            'size': len(self._keys),
+            'negative_size': len(self._bad),
+            'max_size': self.max_size,
+            'hits': self.total_hits,
+            'stale_hits': self.total_stale_hits,
+            'negative_hits': self.total_negative_hits,
+            'misses': self.total_misses,
+            'hit_ratio': (lookups - self.total_misses) / lookups \
+                         if lookups else 0.0,
+            'rejected': self.total_rejected,
+            'loads': self.total_loads,
+            'load_errors': self.total_load_errors,
+            'load_avg_ms': 1000 * sum(times) / len(times) if times else 0.0,
+            'refreshes': self.total_refreshes,
+            'revoked': self.total_revoked,
+            'evicted': self.total_evicted,
+        }
+
+
+# Cache of the keys, shared by the blueprints.
+keys = KeyCache()
+_required = False
+
+
+def init_auth(required = False, ttl = 300, negative_ttl = 30,
+              max_size = 10000, refresh_interval = 60,
+              loader = None) -> KeyCache:
+    """
+    Replace the key cache with a configured one. If required, requests to
+    the protected blueprints need a valid Api-Key header.
+    """
+    global keys, _required
+    keys.close()
+    keys = KeyCache(ttl, negative_ttl, max_size, max_size, refresh_interval,
+                    loader)
+    _required = required
+    if required:
+        keys.start()
+    return keys
+
+
+def protect(bp):
+    """ Check the API key of every request to a blueprint. """
+    bp.before_request(_authenticate)
+    return bp
+
+
+def identify(apikey : str) -> Identity:
+    """
+    Check a key, e.g. of a websocket handshake. Returns its Identity, or
+    None if keys are not required. Raises PermissionError if the key is
+    not valid, and AuthUnavailable if it could not be checked.
+    """
+    if not _required:
+        return None
+    identity = keys.get(apikey)
+    if identity is None:
+        raise PermissionError("Invalid API key.")
+    return identity
+
+
+def _authenticate():
+    g.identity = None
+    if request.method == "OPTIONS":
+        return None
+
+    try:
+        g.identity = identify(request.headers.get(HEADER))
+    except AuthUnavailable as err:
+        return _error(str(err), 'auth_unavailable', 503)
+    except PermissionError as err:
+        log.info("Invalid API key from {}", request.remote_addr)
+        return _error(str(err), 'invalid_api_key', 401)
+    return None
+
+
+def _error(message : str, kind : str, status : int):
+    resp = make_response(jsonify({
+        'error': {'message': message, 'type': kind}
+    }), status)
+    if status == 503:
+        resp.headers['Retry-After'] = "5"
+    return resp
@@ -1,13 +1,15 @@
 import os
 import uuid
+import contextlib
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, make_url
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import insert, update
 
 import pylogg
+from polyai.server import serializer
 log = pylogg.New('db')
 
 try:
@@ -46,6 +48,8 @@ class Operation:
             session.execute(insert(self.table.__class__), payload)
         except Exception as err:
             log.error("Insert ({}) - {}", self.table.__tablename__, err)
+            session.rollback()
+            raise
         if test:
             session.rollback()
             log.trace("Insert ({}) - rollback", self.table.__tablename__)
@@ -53,12 +57,17 @@ class Operation:
             session.commit()
 
     def update(self, session, newObj, *, test=False):
+        """ Update the record of self with the values of newObj. """
         values = newObj.serialize()
+        values.pop('id', None)
         try:
-            sql = update(self.table.__class__).where(self.id == newObj.id).values(**values)
-            self.session.execute(sql)
+            cls = self.table.__class__
+            sql = update(cls).where(cls.id == self.table.id).values(**values)
+            session.execute(sql)
         except Exception as err:
             log.error("Update ({}) - {}", self.table.__tablename__, err)
+            session.rollback()
+            raise
         if test:
             session.rollback()
             log.trace("Update ({}) - rollback", self.table.__tablename__)
@@ -89,7 +98,7 @@ class Operation:
             log.trace(f"{self.table.__tablename__} add: {name}")
         else:
             if update:
-                self.update(session, x, payload, test=test)
+                Operation(x).update(session, Operation(payload), test=test)
                 log.trace(f"{self.table.__tablename__} update: {name}")
             else:
                 log.trace(f"{self.table.__tablename__} ok: {name}")
@@ -172,47 +181,102 @@ def _setup_proxy() -> SSHTunnelForwarder | None:
         return None
 
 
+def _env_url(server : SSHTunnelForwarder = None) -> str:
+    """ Postgres url from the DB_* environment variables. """
+    if server is None:
+        return "postgresql+psycopg2://{}:{}@{}:{}/{}".format(
+            os.environ.get("DB_USER"),
+            os.environ.get("DB_PASSWORD"),
+            os.environ.get("DB_HOST"),
+            os.environ.get("DB_PORT"),
+            os.environ.get("DB_NAME"))
+    else:
+        return "postgresql+psycopg2://{}:{}@{}:{}/{}".format(
+            os.environ.get("DB_USER"),
+            os.environ.get("DB_PASSWORD"),
+            server.local_bind_host,
+            server.local_bind_port,
+            os.environ.get("DB_NAME"))
+
+
+def _pool_args(db_url) -> dict:
+    """ Pool options for an engine of the url. """
+    url = make_url(db_url)
+    if url.get_backend_name() == "sqlite" and \
+            url.database in (None, "", ":memory:"):
+        # In memory SQLite lives in a single connection.
+        return {'pool_pre_ping': _pool['pool_pre_ping']}
+    return dict(_pool)
+
+
 def _setup_engine(*, server : SSHTunnelForwarder = None, db_url = None):
     if db_url is None:
-        if server is None:
-            db_url = "postgresql+psycopg2://{}:{}@{}:{}/{}".format(
-                os.environ.get("DB_USER"),
-                os.environ.get("DB_PASSWORD"),
-                os.environ.get("DB_HOST"),
-                os.environ.get("DB_PORT"),
-                os.environ.get("DB_NAME"))
-        else:
-            db_url = "postgresql+psycopg2://{}:{}@{}:{}/{}".format(
-                os.environ.get("DB_USER"),
-                os.environ.get("DB_PASSWORD"),
-                server.local_bind_host,
-                server.local_bind_port,
-                os.environ.get("DB_NAME"))
-    engine = create_engine(db_url)
-    log.trace("DB engine created.")
+        db_url = _db_url or _env_url(server)
+    # The request records may hold responses already serialized.
+    engine = create_engine(db_url, json_serializer=serializer.dumps_str,
+                           **_pool_args(db_url))
+    log.trace("DB engine created: pool_size={} max_overflow={}",
+              _pool['pool_size'], _pool['max_overflow'])
     return engine
 
 
-def _new_session(engine) -> scoped_session:
-    connection = engine.connect()
-    session = scoped_session(
-        sessionmaker(autocommit=False, autoflush=False, bind=connection)
-    )
-    log.trace("DB connected.")
-    return session
+# Pool options of the engines, see configure().
+_pool = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'pool_timeout': 30,
+}
+
+# Drivers of the async engine.
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
 
+_db_url = None
 eng = None
 ssh = None
 sess = None
+aeng = None
+_factory : sessionmaker = None
+_async_factory = None
 
-def connect():
-    global ssh, eng, sess
-    if ssh is None:
+
+def configure(pool_size = 5, max_overflow = 10, pre_ping = True,
+              recycle = 1800, timeout = 30, db_url = None):
+    """
+    Set the connection pool options, and optionally a database url instead
+    of the DB_* environment variables, e.g. sqlite:///polyai.db.
+    The engines are recreated on next use.
+    """
+    global _db_url
+    disconnect()
+    _pool.update({
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_pre_ping': pre_ping,
+        'pool_recycle': recycle,
+        'pool_timeout': timeout,
+    })
+    _db_url = db_url
+
+
+def connect() -> scoped_session:
+    """
+    Registry of thread local sessions on the pooled engine. New code should
+    use session() instead.
+    """
+    global ssh, eng, sess, _factory
+    if ssh is None and _db_url is None:
         ssh = _setup_proxy()
     if eng is None:
         eng = _setup_engine(server=ssh)
+        _factory = sessionmaker(bind=eng, autoflush=False)
     if sess is None:
-        sess = _new_session(eng)
+        sess = scoped_session(_factory)
+        log.trace("DB connected.")
     return sess
 
 
@@ -220,11 +284,59 @@ def engine():
     connect()
     return eng
 
+
+@contextlib.contextmanager
+def session():
+    """
+    Short lived session for a unit of work. It commits when the block
+    exits, or rolls back on an exception, and returns the connection to
+    the pool.
+
+        with database.session() as db:
+            db.execute(...)
+    """
+    connect()
+    with _factory.begin() as db:
+        yield db
+
+
+def async_engine():
+    """ Pooled async engine of the same database. Needs asyncpg or aiosqlite. """
+    global aeng, _async_factory
+    if aeng is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        url = engine().url
+        url = url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+        aeng = create_async_engine(url, **_pool_args(url))
+        _async_factory = async_sessionmaker(bind=aeng, autoflush=False)
+        log.trace("DB async engine created.")
+    return aeng
+
+
+@contextlib.asynccontextmanager
+async def async_session():
+    """
+    Async version of session(), for the event loop.
+
+        async with database.async_session() as db:
+            await db.execute(...)
+    """
+    async_engine()
+    async with _async_factory.begin() as db:
+        yield db
+
+
 def disconnect():
-    global ssh, eng, sess
+    global ssh, eng, sess, aeng, _factory, _async_factory
     if sess is not None:
-        sess.close()
+        sess.remove()
+    if eng is not None:
+        eng.dispose()
+    if aeng is not None:
+        # Closing needs the event loop, the connections are left to it.
+        aeng.sync_engine.dispose(close=False)
     if ssh is not None:
         ssh.stop()
+    ssh = eng = sess = aeng = _factory = _async_factory = None
     log.info("DB disconnect.")
-
@@ -0,0 +1,360 @@
+""" Content addressed cache of the text embeddings.
+
+    A vector is cached under a hash of the model name, the pooling, the
+    normalize flag and the normalized text, i.e. NFC unicode with the white
+    space collapsed. The cache has two tiers:
+
+        memory  LRU of the recent vectors, within memory_bytes.
+        disk    Optional. A memory mapped float16 matrix of the vectors of
+                each dimension, and an append-only index of (hash, row,
+                crc32) records. The rows are reused in a ring, so the oldest
+                vectors are evicted once the matrix fills disk_bytes.
+
+    A vector is found in memory first, then on disk, where it is copied
+    out of the mapped file as float32, since its row may be reused by a
+    later put, and kept in memory.
+
+    The index records of new vectors are written by flush(), after the
+    matrix is flushed. The index is read back in order when the cache is
+    opened, and later records of a row replace the earlier ones. It is
+    rewritten when most of its records are stale. A row overwritten just
+    before a crash may not match its last record, so the crc32 of a row is
+    checked when it is found, and it is dropped if it does not match.
+"""
+import os
+import zlib
+import atexit
+import hashlib
+import threading
+import collections
+import unicodedata
+
+import numpy as np
+
+import pylogg
+
+log = pylogg.New("ecache")
+
+DIGEST_SIZE = 16
+RECORD = np.dtype([('digest', 'V16'), ('row', '<u4'), ('crc', '<u4')])
+
+
+def cache_key(model : str, pooling : str, normalize : bool, text : str) -> bytes:
+    """ Hash of a text embedded by a model with the given pooling. """
+    text = " ".join(unicodedata.normalize("NFC", text).split())
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for part in (model or "", pooling, "1" if normalize else "0"):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    return h.digest()
+
+
+class DiskStore:
+    """
+    Memory mapped float16 vectors of one dimension, and their index.
+
+    Args:
+        directory:      Directory of the files.
+        dim:            Size of the vectors.
+        max_bytes:      Size of the matrix, the oldest rows are overwritten
+                        when it is full.
+    """
+
+    def __init__(self, directory : str, dim : int, max_bytes : int):
+        self.dim = dim
+        self.capacity = max(1, max_bytes // (2 * dim))
+        self.matrix_path = os.path.join(directory, f"vectors-{dim}.f16")
+        self.index_path = os.path.join(directory, f"index-{dim}.bin")
+
+        size = self.capacity * dim * 2
+        with open(self.matrix_path, "ab") as fp:
+            if fp.tell() != size:
+                fp.truncate(size)
+        self.vectors = np.memmap(self.matrix_path, dtype=np.float16, mode="r+",
+                                 shape=(self.capacity, dim))
+
+        self.rows = {}                      # digest: row
+        self.crcs = {}                      # digest: crc32 of the row
+        self.owners = [None] * self.capacity  # row: digest
+        self.next_row = 0
+        self.records = 0                    # records in the index file
+        self._pending = []                  # records not written yet
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            data = open(self.index_path, "rb").read()
+        except FileNotFoundError:
+            return
+
+        whole = len(data) - len(data) % RECORD.itemsize
+        if whole < len(data):
+            log.warn("Truncating {} torn bytes of {}", len(data) - whole,
+                     self.index_path)
+            with open(self.index_path, "rb+") as fp:
+                fp.truncate(whole)
+
+        records = np.frombuffer(data[:whole], dtype=RECORD)
+        for digest, row, crc in zip(records['digest'].tolist(),
+                                    records['row'].tolist(),
+                                    records['crc'].tolist()):
+            if row >= self.capacity:
+                continue                    # the matrix got smaller
+            self._assign(digest, row, crc)
+            self.next_row = (row + 1) % self.capacity
+        self.records = len(records)
+
+    def _assign(self, digest : bytes, row : int, crc : int):
+        old = self.owners[row]
+        if old is not None and self.rows.get(old) == row:
+            self._drop(old)
+        self.rows[digest] = row
+        self.crcs[digest] = crc
+        self.owners[row] = digest
+
+    def _drop(self, digest : bytes):
+        del self.rows[digest]
+        del self.crcs[digest]
+
+    def get(self, digest : bytes) -> np.ndarray:
+        row = self.rows.get(digest)
+        if row is None:
+            return None
+        vector = self.vectors[row]
+        if zlib.crc32(vector) != self.crcs[digest]:
+            log.warn("Dropping a torn row {} of {}", row, self.matrix_path)
+            self._drop(digest)
+            self.owners[row] = None
+            return None
+        return vector
+
+    def put(self, digest : bytes, vector : np.ndarray):
+        if digest in self.rows:
+            return
+        row = self.next_row
+        self.next_row = (row + 1) % self.capacity
+        self.vectors[row] = vector
+        crc = zlib.crc32(self.vectors[row])
+        self._assign(digest, row, crc)
+        self._pending.append((digest, row, crc))
+
+    def flush(self):
+        """ Flush the matrix, then append the index records of new rows. """
+        if not self._pending:
+            return
+        self.vectors.flush()
+        records = np.array(self._pending, dtype=RECORD)
+        self._pending = []
+
+        if self.records + len(records) > 2 * self.capacity:
+            self._compact()
+            return
+
+        with open(self.index_path, "ab") as fp:
+            fp.write(records.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.records += len(records)
+
+    def _compact(self):
+        """ Rewrite the index with only the live rows, oldest first. """
+        order = list(range(self.next_row, self.capacity)) + \
+                list(range(self.next_row))
+        live = []
+        for row in order:
+            digest = self.owners[row]
+            if digest is not None and self.rows.get(digest) == row:
+                live.append((digest, row, self.crcs[digest]))
+        records = np.array(live, dtype=RECORD)
+        with open(self.index_path + ".tmp", "wb") as fp:
+            fp.write(records.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.records = len(records)
+        log.trace("Compacted {} to {} records.", self.index_path, len(records))
+
+    def nbytes(self) -> int:
+        return len(self.rows) * self.dim * 2
+
+    def close(self):
+        self.flush()
+        del self.vectors
+
+
+class EmbeddingCache:
+    """
+    Two tier cache of the embedding vectors.
+
+    Args:
+        directory:      Directory of the disk tier, None for memory only.
+        memory_bytes:   Size of the vectors kept in memory.
+        disk_bytes:     Size of the matrix of each vector dimension on disk.
+        flush_every:    Number of new vectors between writes of the index.
+    """
+
+    def __init__(self, directory : str = None, memory_bytes : int = 64 << 20,
+                 disk_bytes : int = 1 << 30, flush_every : int = 256):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.flush_every = flush_every
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()    # digest: float32 vector
+        self._memory_size = 0
+        self._stores : dict[int, DiskStore] = {}
+        self._unflushed = 0
+
+        self.total_hits = 0
+        self.total_disk_hits = 0
+        self.total_misses = 0
+        self.total_puts = 0
+        self.total_evicted = 0
+
+        if directory:
+            for name in sorted(os.listdir(directory)):
+                if name.startswith("vectors-") and name.endswith(".f16"):
+                    self._store(int(name[len("vectors-"):-len(".f16")]))
+            atexit.register(self.close)
+
+    def _store(self, dim : int) -> DiskStore:
+        store = self._stores.get(dim)
+        if store is None and self.directory:
+            store = DiskStore(self.directory, dim, self.disk_bytes)
+            self._stores[dim] = store
+            log.info("Embedding cache of dim {}: {} vectors on disk.",
+                     dim, len(store.rows))
+        return store
+
+    def _remember(self, digest : bytes, vector : np.ndarray):
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return
+        self._memory[digest] = vector
+        self._memory_size += vector.nbytes
+        while self._memory_size > self.memory_bytes and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= old.nbytes
+            self.total_evicted += 1
+
+    def get(self, digest : bytes) -> np.ndarray:
+        """ Cached vector of a key, or None. """
+        with self._lock:
+            vector = self._memory.get(digest)
+            if vector is not None:
+                self._memory.move_to_end(digest)
+                self.total_hits += 1
+                return vector
+
+            for store in self._stores.values():
+                vector = store.get(digest)
+                if vector is not None:
+                    self.total_disk_hits += 1
+                    # The row is reused by later puts, return a copy.
+                    vector = np.array(vector, dtype=np.float32)
+                    self._remember(digest, vector)
+                    return vector
+
+            self.total_misses += 1
+            return None
+
+    def put(self, digest : bytes, vector):
+        """ Cache the vector of a key. """
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(digest, vector)
+            self.total_puts += 1
+            store = self._store(vector.shape[-1])
+            if store is None:
+                return
+            store.put(digest, vector)
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        for store in self._stores.values():
+            store.flush()
+        self._unflushed = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores = {}
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict:
+        lookups = self.total_hits + self.total_disk_hits + self.total_misses
+        return {
+            'memory_vectors': len(self._memory),
+            'memory_bytes': self._memory_size,
+            'max_memory_bytes': self.memory_bytes,
+            'disk_vectors': sum(len(s.rows) for s in self._stores.values()),
+            'disk_bytes': sum(s.nbytes() for s in self._stores.values()),
+            'max_disk_bytes': self.disk_bytes * len(self._stores),
+            'hits': self.total_hits,
+            'disk_hits': self.total_disk_hits,
+            'misses': self.total_misses,
+            'hit_ratio': (lookups - self.total_misses) / lookups \
+                         if lookups else 0.0,
+            'puts': self.total_puts,
+            'evicted': self.total_evicted,
+        }
+
+
+def embed(cache : EmbeddingCache, model : str, texts : list, pooling : str,
+          normalize : bool, embed_fn) -> tuple:
+    """
+    Embed the texts, computing only the ones not in the cache.
+
+    Args:
+        embed_fn:   Function of a list of texts, returning the model name,
+                    the vectors, the number of tokens and the milliseconds,
+                    e.g. state.LLM.embed.
+
+    Returns the float32 vectors [len(texts), dim], the tokens and
+    milliseconds of the computed texts, and the number of texts found in
+    the cache.
+    """
+    keys = [cache_key(model, pooling, normalize, text) for text in texts]
+    vectors = [cache.get(key) for key in keys]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+
+    tokens, dt = 0, 0
+    if missing:
+        # Duplicates in the request are computed once.
+        unique = list(dict.fromkeys(keys[i] for i in missing))
+        first = {}
+        for i in missing:
+            first.setdefault(keys[i], i)
+        _, computed, tokens, dt = embed_fn([texts[first[k]] for k in unique])
+        by_key = dict(zip(unique, computed))
+        for key, vector in by_key.items():
+            cache.put(key, vector)
+        for i in missing:
+            vectors[i] = by_key[keys[i]]
+
+    vectors = np.stack([np.asarray(v, dtype=np.float32) for v in vectors])
+    return vectors, tokens, dt, len(texts) - len(missing)
+
+
+# Cache of the embedding endpoint.
+cache = EmbeddingCache()
+
+
+def init_cache(directory : str = None, memory_mb : int = 64,
+               disk_mb : int = 1024) -> EmbeddingCache:
+    """ Replace the embedding cache with a configured one. """
+    global cache
+    cache.close()
+    cache = EmbeddingCache(directory, memory_mb << 20, disk_mb << 20)
+    return cache
@@ -3,20 +3,46 @@ from flask import Flask
 from polyai.server.endpoints import openai
 from polyai.server.endpoints import textgen
 
-def run(polyai_port, streaming_port, listen=False, ssl=False, debug=False):
+
+def create_app() -> Flask:
+    """ Flask app with the /polyai and /api/v1 blueprints. """
+    app = Flask(__name__, static_url_path = "")
+    app.register_blueprint(openai.blocking.bp, url_prefix="/polyai/")
+    app.register_blueprint(textgen.blocking.bp, url_prefix="/api/v1/")
+    return app
+
+
+def run(polyai_port, streaming_port, listen=False, ssl=False, debug=False,
+        mode="flask", threads=32, keep_alive=5, drain_timeout=30.0):
+    """
+    Serve the endpoints.
+
+    mode "flask" runs the Flask development server, and the websocket
+    server on streaming_port in a background thread. mode "asgi" serves
+    everything from one uvicorn server on polyai_port, see asgi.py.
+    """
     log = pylogg.New('endpoint')
     protocol = 'https' if ssl else 'http'
     host = '0.0.0.0' if listen else '127.0.0.1'
-    app = Flask(__name__, static_url_path = "")
+    app = create_app()
 
-    app.register_blueprint(openai.blocking.bp, url_prefix="/polyai/")
     log.note('OpenAI like API endpoint {}://{}:{}{}',
              protocol, host, polyai_port, "/polyai")
-
-    app.register_blueprint(textgen.blocking.bp, url_prefix="/api/v1/")
     log.note('TextGen like API endpoint {}://{}:{}{}',
              protocol, host, polyai_port, "/api/v1")
 
+    if mode == "asgi":
+        from polyai.server.endpoints import asgi
+        log.note('TextGen streaming endpoint {}://{}:{}{}',
+                 'wss' if ssl else 'ws', host, polyai_port,
+                 textgen.streaming.PATH)
+        asgi.serve(app, host, polyai_port, ssl=ssl, threads=threads,
+                   keep_alive=keep_alive, drain_timeout=drain_timeout)
+        return
+
+    elif mode != "flask":
+        raise ValueError(f"unknown server mode: {mode}")
+
     # This runs in the bg, so start first.
     textgen.streaming.start_server(streaming_port, listen)
 
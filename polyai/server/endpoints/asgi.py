@@ -0,0 +1,272 @@
+""" Production serving of the endpoints on a single ASGI server.
+
+    The Flask blueprints run in a pool of threads behind a small WSGI to
+    ASGI adapter, and the streaming websocket is served by the same event
+    loop, on the same port. The request body is read from the connection as
+    the app reads it, and each chunk of the response is sent as the app
+    yields it, so streamed responses stream and neither is held in memory.
+    Connections are kept alive between requests, and on SIGINT/SIGTERM the
+    server stops accepting new connections and waits for the requests in
+    flight to finish before exiting.
+
+    The model lives in this process, so there is a single worker process
+    and the threads share it. Requires uvicorn.
+"""
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pylogg
+from websockets.datastructures import Headers
+from polyai.server.endpoints.textgen import streaming
+
+log = pylogg.New("asgi")
+
+
+class _WebSocket:
+    """ ASGI websocket with the interface the streaming handlers use. """
+
+    def __init__(self, scope, receive, send):
+        self._receive = receive
+        self._send = send
+        self.request_headers = Headers(
+            (k.decode('latin-1'), v.decode('latin-1'))
+            for k, v in scope['headers'])
+        self.remote_address = scope.get('client')
+
+    async def send(self, text : str):
+        await self._send({'type': 'websocket.send', 'text': text})
+
+    async def close(self, code : int = 1000, reason : str = ""):
+        await self._send({'type': 'websocket.close', 'code': code,
+                          'reason': reason})
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            message = await self._receive()
+            if message['type'] == 'websocket.disconnect':
+                raise StopAsyncIteration
+            if message['type'] == 'websocket.receive':
+                text = message.get('text')
+                if text is None:
+                    text = message.get('bytes', b'').decode('utf-8')
+                return text
+
+
+class ASGIApp:
+    """
+    Serve a WSGI app and the streaming websocket paths.
+
+    Args:
+        wsgi_app:   The Flask app.
+        threads:    Number of requests the WSGI app handles at once.
+    """
+
+    def __init__(self, wsgi_app, threads : int = 32):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(threads,
+                                            thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await self._websocket(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                log.note("Draining the request threads.")
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._executor.shutdown, True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _websocket(self, scope, receive, send):
+        path = scope['path']
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if path not in streaming.PATHS:
+            log.warn("Unknown path requested: {}", path)
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+
+        # Returns when the client disconnects.
+        await send({'type': 'websocket.accept'})
+        await streaming._handle_connection(_WebSocket(scope, receive, send),
+                                           path)
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, _Input(receive, loop))
+        await loop.run_in_executor(self._executor, self._call_wsgi,
+                                   environ, send, loop)
+
+    def _call_wsgi(self, environ, send, loop):
+        """ Run the WSGI app, in a worker thread, sending the response. """
+        response = []
+        started = []
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info = None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [int(status.split(" ", 1)[0]), headers]
+            return write
+
+        def write(data : bytes):
+            if not started:
+                status, headers = response
+                emit({
+                    'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(k.lower().encode('latin-1'),
+                                 v.encode('latin-1')) for k, v in headers],
+                })
+                started.append(True)
+            if data:
+                emit({'type': 'http.response.body', 'body': data,
+                      'more_body': True})
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        if not started:
+            write(b"")
+        emit({'type': 'http.response.body', 'body': b"", 'more_body': False})
+
+
+class _Input:
+    """ wsgi.input, receiving the request body as the app reads it. """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._done = False
+
+    def _fill(self) -> bool:
+        """ Wait for the next chunk of the body, False at its end. """
+        if self._done:
+            return False
+        message = asyncio.run_coroutine_threadsafe(
+            self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect' or \
+                not message.get('more_body', False):
+            self._done = True
+        self._buffer += message.get('body', b'')
+        return True
+
+    def _take(self, size : int) -> bytes:
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size : int = -1) -> bytes:
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            return self._take(len(self._buffer))
+        while len(self._buffer) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def readline(self, size : int = -1) -> bytes:
+        scanned = 0
+        while True:
+            end = self._buffer.find(b"\n", scanned)
+            if end >= 0:
+                end += 1
+                break
+            scanned = len(self._buffer)
+            if 0 <= size <= scanned or not self._fill():
+                end = len(self._buffer)
+                break
+        if size is not None and size >= 0:
+            end = min(end, size)
+        return self._take(end)
+
+    def readlines(self, hint : int = -1) -> list:
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def _environ(scope, body) -> dict:
+    """ WSGI environ of an ASGI http scope. """
+    server = scope.get('server') or ("localhost", 80)
+    client = scope.get('client') or ("", 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', "").encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': "HTTP/" + scope.get('http_version', "1.1"),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', "http"),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace("-", "_")
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+
+    return environ
+
+
+def serve(app, host : str, port : int, ssl : bool = False,
+          threads : int = 32, keep_alive : int = 5,
+          drain_timeout : float = 30.0):
+    """ Serve the Flask app and the streaming websocket until shutdown. """
+    import uvicorn
+
+    protocol = 'https' if ssl else 'http'
+    log.note("Serving with uvicorn at {}://{}:{} threads={} keep_alive={}s",
+             protocol, host, port, threads, keep_alive)
+
+    config = uvicorn.Config(
+        ASGIApp(app, threads), host=host, port=port,
+        ws="auto", ws_ping_interval=None,
+        timeout_keep_alive=keep_alive,
+        timeout_graceful_shutdown=drain_timeout,
+        ssl_certfile="keys/ssl.crt" if ssl else None,
+        ssl_keyfile="keys/ssl.key" if ssl else None,
+        log_level="warning")
+    uvicorn.Server(config).run()
@@ -1,17 +1,24 @@
+import functools
 from flask import (
-    Blueprint, jsonify, make_response, request,
-    abort, session, redirect,
+    Blueprint, Response, jsonify, make_response, request,
+    abort, session, redirect, g, stream_with_context,
 )
 
 import pylogg
 import polyai.sett as sett
 import polyai.server.state as state
 
-from polyai.server import tools
+from polyai.server import (
+    auth, embed_cache, ratelimit, serializer, tools, vector_index,
+)
+from polyai.server.admission import Overloaded
 from polyai.server.endpoints.openai import utils
+from polyai.server.generation import embedding
 
 # Handle all the urls that starts with /polyai
 bp = Blueprint("polyai", __name__)
+auth.protect(bp)
+ratelimit.protect(bp)
 
 # Set log prefix
 log = pylogg.New("end1")
@@ -32,7 +39,12 @@ def bert_ner():
         if not text:
             abort(400, "no input received")
 
-    mname, ner, dt = state.BERT.ner_tags(text)
+    try:
+        mname, ner, dt = state.BERT.ner_tags(text)
+    except ConnectionError:
+        abort(409, "Model not ready.")
+    except Overloaded as err:
+        abort(overloaded(err))
     p_tok = 0
     c_tok = 0
 
@@ -44,62 +56,396 @@ def bert_ner():
                                        prompt_tok=p_tok, compl_tok=c_tok, ner=ner)
 
     # http response
-    resp = make_response(jsonify(payload))
+    resp = utils.json_response(payload)
 
     # Add the request info to database in the background
     tools.store(text, payload, resp.headers, apiKey, request.url,
-                      request.method, request.headers)
+                      request.method, request.headers, body=resp.get_data())
 
     # Respond
     return resp
 
 
+# Documents of a batch NER request sent to the model at a time.
+NER_CHUNK = 256
+
+@bp.route('/bert/ner/batch', methods = ['POST'])
+def bert_ner_batch():
+    """
+    Handle NER requests of many documents. Must be a post method.
+
+    The documents are a JSON list of strings in "texts", or the lines of a
+    text/plain body, or of an application/x-ndjson body, each a JSON string
+    or an object with a "text". A body of lines is read as it arrives.
+
+    The response is application/x-ndjson, one {"index", "ner_tags"} line
+    per document, sent as soon as its chunk is done, and a last line with
+    the usage of the whole request. A single request record is stored,
+    with the documents sent so far if the client goes away.
+    """
+    apiKey = request.headers.get("Api-Key", None)
+
+    if request.is_json:
+        texts = request.get_json().get("texts")
+        if type(texts) != list or not all(type(t) == str for t in texts):
+            abort(400, "texts must be a list of strings")
+        documents = iter(texts)
+    else:
+        documents = _read_documents(request.stream,
+                                    "ndjson" in request.mimetype)
+
+    if state.BERT._pipeline is None:
+        abort(409, "Model not ready.")
+
+    idStr = tools.create_idStr("ner")
+    url, method, headers = request.url, request.method, dict(request.headers)
+
+    def generate():
+        model, count, chars, dt = state.BERT.model_name(), 0, 0, 0
+        error, body = None, None
+
+        def usage():
+            payload = utils.make_response_dict(idStr, 'bert.ner.batch', model,
+                                               dt, prompt_tok=0, compl_tok=0)
+            payload['documents'] = count
+            if error is not None:
+                payload['error'] = {'message': error}
+            return payload
+
+        try:
+            try:
+                for chunk in _chunks(documents, NER_CHUNK):
+                    model, tags, ms = state.BERT.ner_batch(chunk)
+                    dt += ms
+                    for text, ner in zip(chunk, tags):
+                        line = serializer.dumps({'index': count,
+                                                 'ner_tags': ner}) + b"\n"
+                        count += 1
+                        chars += len(text)
+                        yield line
+            except Exception as err:
+                # The status is already sent, report it in the last line.
+                log.error("Batch NER failed after {} documents: {}",
+                          count, err)
+                error = str(err)
+
+            payload = usage()
+            body = serializer.dumps(payload)
+            yield body + b"\n"
+
+        finally:
+            # Also stored if the client went away, with the documents sent.
+            if body is None:
+                error = "Client disconnected."
+                payload = usage()
+                body = serializer.dumps(payload)
+            tools.store({'documents': count, 'characters': chars}, payload,
+                        {'Content-Type': "application/x-ndjson"}, apiKey,
+                        url, method, headers, body=body)
+
+    return Response(stream_with_context(generate()),
+                    mimetype="application/x-ndjson")
+
+
+def _read_documents(stream, ndjson : bool):
+    """ Texts of the non-empty lines of a request body. """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if not ndjson:
+            yield line.decode("utf-8")
+            continue
+        doc = serializer.loads(line)
+        if type(doc) == dict:
+            doc = doc.get("text")
+        if type(doc) != str:
+            raise ValueError("each line must be a string or have a text")
+        yield doc
+
+
+def _chunks(iterable, size : int):
+    """
+    Lists of up to size items of an iterable. If the iterable fails, the
+    items read before are yielded first.
+    """
+    chunk = []
+    try:
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    except Exception:
+        if chunk:
+            yield chunk
+        raise
+    if chunk:
+        yield chunk
+
+
 @bp.route('/text/embedding', methods = ['POST'])
 def text_embeddings():
     """
     Handle Embedding requests. Must be a post method.
-    
+
+    The text may be a string, or a list of strings embedded in one batch.
+    Optional JSON fields:
+        pooling:    mean (default), last or cls.
+        normalize:  Scale the vectors to unit length (default true).
+        encoder:    llm (default if loaded) or bert.
+        encoding_format:
+                    float (default), a list of numbers per vector, or
+                    base64, a string of the little-endian bytes.
+        dtype:      float32 (default) or float16.
+
+    With an Accept: application/octet-stream header, the body is the raw
+    little-endian bytes of the [n, dim] matrix, or the [dim] vector of a
+    single text, and the rest of the response is json in the X-PolyAI-Meta
+    header.
     """
     apiKey = request.headers.get("Api-Key", None)
 
+    js = {}
     if request.is_json:
         js = request.get_json()
         text = js.get("text")
     else:
         text = request.get_data(as_text=True)
-        if not text:
-            abort(400, "no input received")
-
-    t2 = log.trace("Calculating text embeddings.")
 
-    inputs = state.LLM.encode(text)
-    inputs = inputs[-1].tolist()
-
-    p_tok = len(inputs)
-    dt = t2.elapsed()
+    if not text:
+        abort(400, "no input received")
+    texts = [text] if type(text) == str else text
+    if type(texts) != list or not all(type(t) == str for t in texts):
+        abort(400, "text must be a string or a list of strings")
+
+    pooling = js.get("pooling", "mean")
+    normalize = bool(js.get("normalize", True))
+    encoding_format = js.get("encoding_format", "float")
+    if encoding_format not in utils.ENCODINGS:
+        abort(400, f"encoding_format must be one of {utils.ENCODINGS}")
+    dtype = js.get("dtype", "float32")
+    if dtype not in utils.DTYPES:
+        abort(400, f"dtype must be one of {utils.DTYPES}")
+    raw = request.accept_mimetypes.best_match(
+        ["application/json", "application/octet-stream"]) == \
+        "application/octet-stream"
+
+    model, vectors, p_tok, dt = embed_texts(texts, pooling, normalize,
+                                            js.get("encoder"))
 
     c_tok = 0
-    model = state.LLM.model_name()
+    ratelimit.charge(p_tok, c_tok)
 
     # id of the chat request
     idStr = tools.create_idStr("embedding")
 
+    if raw:
+        # The vectors are not stored with the request log.
+        payload = utils.make_response_dict(idStr, 'text.embedding', model, dt,
+                                           prompt_tok=p_tok, compl_tok=c_tok)
+        payload['encoding_format'] = "binary"
+        payload['dtype'] = dtype
+        payload['shape'] = list(vectors.shape)
+        if type(text) == str:
+            payload['shape'] = payload['shape'][1:]
+        resp = make_response(utils.little_endian(vectors, dtype).tobytes())
+        resp.headers['Content-Type'] = "application/octet-stream"
+        resp.headers['X-PolyAI-Meta'] = serializer.dumps_str(payload)
+        tools.store(text, payload, resp.headers, apiKey, request.url,
+                          request.method, request.headers)
+        return resp
+
+    vectors = utils.encode_vectors(vectors, encoding_format, dtype)
+
+    # A single vector for a single text.
+    if type(text) == str:
+        vectors = vectors[0]
+
     # convert to openai like json format
     payload = utils.make_response_dict(idStr, 'text.embedding', model, dt,
                                        prompt_tok=p_tok, compl_tok=c_tok,
-                                       embeddings=inputs)
+                                       embeddings=vectors)
+    if encoding_format != "float" or dtype != "float32":
+        payload['encoding_format'] = encoding_format
+        payload['dtype'] = dtype
 
     # http response
-    resp = make_response(jsonify(payload))
+    resp = utils.json_response(payload)
 
     # Add the request info to database in the background
     tools.store(text, payload, resp.headers, apiKey, request.url,
-                      request.method, request.headers)
+                      request.method, request.headers, body=resp.get_data())
 
     # Respond
     return resp
 
 
+@bp.route('/text/search', methods = ['POST'])
+def text_search():
+    """
+    Search the index for the texts most similar to a text. Must be a post
+    method. The text may be a string, or a list of strings.
+    Optional JSON fields:
+        k:          Number of results of each text (default 10).
+        mode:       exact, approx or auto (default), i.e. approx once the
+                    index is large enough.
+        nprobe:     Number of IVF lists searched in approx mode.
+    """
+    apiKey = request.headers.get("Api-Key", None)
+    index = vector_index.index
+
+    js = request.get_json() if request.is_json else {}
+    text = js.get("text")
+    if not text:
+        abort(400, "no input received")
+    texts = [text] if type(text) == str else text
+    if type(texts) != list or not all(type(t) == str for t in texts):
+        abort(400, "text must be a string or a list of strings")
+
+    validate("k", int, js)
+    validate("nprobe", int, js)
+    for name in ("k", "nprobe"):
+        if js.get(name) is not None and js[name] < 1:
+            abort(400, f"{name} must be at least 1")
+    mode = js.get("mode", "auto")
+    if mode not in ("exact", "approx", "auto"):
+        abort(400, "mode must be exact, approx or auto")
+    if not index.info:
+        abort(409, "Search index is empty.")
+
+    # Queries are embedded the same way as the indexed texts.
+    info = index.info
+    model, vectors, p_tok, dt = embed_texts(texts, info['pooling'],
+                                            info['normalize'], info['encoder'])
+    if model != info['model']:
+        abort(409, f"Index was built with {info['model']}, not {model}.")
+
+    t1 = log.trace("Searching {} texts.", len(texts))
+    found = index.search(vectors, js.get("k") or 10,
+                         exact={"exact": True, "approx": False}.get(mode),
+                         nprobe=js.get("nprobe"))
+    t1.done("Searched {} texts.", len(texts))
+
+    results = [{'text': t,
+                'matches': [{'id': id, 'score': score, 'text': match}
+                            for id, score, match in matches]}
+               for t, matches in zip(texts, found)]
+
+    c_tok = 0
+    ratelimit.charge(p_tok, c_tok)
+    idStr = tools.create_idStr("search")
+    payload = utils.make_response_dict(idStr, 'text.search', model, dt,
+                                       prompt_tok=p_tok, compl_tok=c_tok,
+                                       search=results)
+    resp = utils.json_response(payload)
+    tools.store(text, payload, resp.headers, apiKey, request.url,
+                      request.method, request.headers, body=resp.get_data())
+    return resp
+
+
+@bp.route('/text/index', methods = ['POST', 'DELETE'])
+def text_index():
+    """
+    Add texts to the search index (POST), or delete them (DELETE).
+    JSON fields:
+        ids:        List of ids of the texts, replaced if already indexed.
+        text:       List of texts to add, same length as the ids.
+        store_text: Return the texts with the search results (default true).
+        pooling, normalize, encoder:
+                    As for /text/embedding, used by the first add only.
+                    Later adds and searches embed the same way.
+    """
+    identity = g.get('identity')
+    if identity is not None and (identity.role or 0) >= 10:
+        abort(403, "Only admin keys may change the search index.")
+
+    apiKey = request.headers.get("Api-Key", None)
+    index = vector_index.index
+
+    js = request.get_json() if request.is_json else {}
+    ids = js.get("ids")
+    if type(ids) != list or not ids:
+        abort(400, "ids must be a list")
+
+    model, p_tok, dt, count = None, 0, 0, 0
+    if request.method == "DELETE":
+        count = index.delete(ids)
+    else:
+        texts = js.get("text")
+        if type(texts) != list or len(texts) != len(ids) or \
+                not all(type(t) == str for t in texts):
+            abort(400, "text must be a list of strings, one for each id")
+
+        info = index.info or {
+            'pooling': js.get("pooling", "mean"),
+            'normalize': bool(js.get("normalize", True)),
+            'encoder': js.get("encoder") or \
+                ("llm" if state.LLM._model is not None else "bert"),
+        }
+        model, vectors, p_tok, dt = embed_texts(texts, info['pooling'],
+                                                info['normalize'],
+                                                info['encoder'])
+        if index.info and model != info['model']:
+            abort(409, f"Index was built with {info['model']}, not {model}.")
+        try:
+            index.add(ids, vectors,
+                      texts if js.get("store_text", True) else None)
+        except ValueError as err:
+            abort(400, str(err))
+        if not index.info:
+            index.info = dict(info, model=model)
+        count = len(ids)
+    index.flush()
+
+    c_tok = 0
+    ratelimit.charge(p_tok, c_tok)
+    idStr = tools.create_idStr("index")
+    payload = utils.make_response_dict(idStr, 'text.index', model, dt,
+                                       prompt_tok=p_tok, compl_tok=c_tok)
+    payload['count'] = count
+    payload['size'] = len(index)
+    resp = utils.json_response(payload)
+    tools.store(ids, payload, resp.headers, apiKey, request.url,
+                      request.method, request.headers, body=resp.get_data())
+    return resp
+
+
+def embed_texts(texts : list, pooling : str, normalize : bool,
+                encoder : str = None) -> tuple:
+    """
+    Embed the texts with the llm or the bert encoder, through the cache.
+    Returns the model name, the vectors, the prompt tokens and the msec.
+    """
+    if pooling not in embedding.POOLING:
+        abort(400, f"pooling must be one of {embedding.POOLING}")
+    encoder = encoder or \
+        ("llm" if state.LLM._model is not None else "bert")
+
+    if encoder == "bert":
+        model = state.BERT.model_name()
+        embed_fn = functools.partial(state.BERT.embed, pooling=pooling,
+                                     normalize=normalize)
+    elif encoder == "llm":
+        model = state.LLM.model_name()
+        embed_fn = functools.partial(state.LLM.embed, pooling=pooling,
+                                     normalize=normalize, **ratelimit.share())
+    else:
+        abort(400, "encoder must be llm or bert")
+
+    # Only the texts not in the cache are embedded by the model.
+    try:
+        vectors, p_tok, dt, cached = embed_cache.embed(
+            embed_cache.cache, model, texts, pooling, normalize, embed_fn)
+    except ConnectionError:
+        abort(409, "Model not ready.")
+    except Overloaded as err:
+        abort(overloaded(err))
+    except ValueError as err:
+        abort(400, str(err))
+    return model, vectors, p_tok, dt
+
+
 @bp.route('/chat/completions', methods = ['POST'])
 def chat_completions():
     """
@@ -119,6 +465,7 @@ def chat_completions():
 
     # model text generation stats
     model_name, texts, p_tok, c_tok, dt = output
+    ratelimit.charge(p_tok, c_tok)
 
     assert type(texts) == list, "model response must be a list of str"
 
@@ -131,11 +478,12 @@ def chat_completions():
                                        prompt_tok=p_tok, compl_tok=c_tok, choices=ch)
 
     # http response
-    resp = make_response(jsonify(payload))
+    resp = utils.json_response(payload)
 
     # Add the request info to database in the background
     tools.store(inputs, payload, resp.headers, apiKey,
-                    request.url, request.method, request.headers)
+                    request.url, request.method, request.headers,
+                    body=resp.get_data())
 
     # Respond
     return resp
@@ -232,12 +580,38 @@ def response_for_json(js : dict):
                  max_tokens, js.get('max_tokens'))
 
     try:
-        response = state.LLM.generate(message, js)
+        response = state.LLM.generate(message, js, **ratelimit.share())
     except ConnectionError:
         abort(409, "Model not ready.")
+    except Overloaded as err:
+        abort(overloaded(err))
+    except ValueError as err:
+        abort(400, str(err))
     return response
 
 
+def overloaded(err : Overloaded):
+    """ Response asking the client to retry a request that was not admitted. """
+    resp = make_response(jsonify({
+        'error': {'message': str(err), 'type': 'overloaded'}
+    }), err.status)
+    resp.headers['Retry-After'] = str(err.retry_after)
+    return resp
+
+
+@bp.route('/metrics', methods = ['GET'])
+def metrics():
+    """ Request queue and generation metrics, e.g. to size the replicas. """
+    stats = state.LLM.stats()
+    stats['writer'] = tools.writer.stats()
+    stats['auth'] = auth.keys.stats()
+    stats['limits'] = ratelimit.limiter.stats()
+    stats['embed_cache'] = embed_cache.cache.stats()
+    stats['search_index'] = vector_index.index.stats()
+    stats['ner'] = state.BERT.stats()
+    return utils.json_response(stats)
+
+
 def validate(name : str, ptype : callable, d : dict):
     """ Validate a dictionary item by typecasting. """
     value = d.get(name, None)
@@ -1,14 +1,27 @@
 import time
+import base64
+
+import numpy as np
+from flask import make_response
+
+from polyai.server import serializer
+
+# Encodings of the embedding vectors.
+#   float:  JSON list of numbers.
+#   base64: base64 string of the little-endian bytes of each vector.
+ENCODINGS = ("float", "base64")
+DTYPES = ("float32", "float16")
 
 def make_response_dict(idstr : str, object : str, model : str, dt : int,
                prompt_tok : int, compl_tok : int, choices : list = [],
-               ner : list = [], embeddings : list = []):
+               ner : list = [], embeddings : list = [], search : list = []):
     
     """ Construct and return an OPENAI like response dict for json payload. """
 
     assert type(choices) == list
     assert type(ner) == list
-    assert type(embeddings) == list
+    assert type(embeddings) in (list, str)
+    assert type(search) == list
 
     # set indices
     for i, ch in enumerate(choices):
@@ -35,6 +48,8 @@ def make_response_dict(idstr : str, object : str, model : str, dt : int,
         response['ner_tags'] = ner
     if embeddings:
         response['embeddings'] = embeddings
+    if search:
+        response['search'] = search
 
     return response
 
@@ -48,3 +63,28 @@ def make_choice_dict(response, finish_reason):
         },
         'finish_reason': finish_reason
     }
+
+
+def little_endian(vectors : np.ndarray, dtype : str = "float32") -> np.ndarray:
+    """ Contiguous little-endian copy of vectors, if not already. """
+    return np.ascontiguousarray(vectors,
+                                dtype=np.dtype(dtype).newbyteorder("<"))
+
+
+def encode_vectors(vectors : np.ndarray, encoding_format : str = "float",
+                   dtype : str = "float32") -> list:
+    """ Encode the rows of vectors [n, dim] for a json payload. """
+    vectors = little_endian(vectors, dtype)
+    if encoding_format == "base64":
+        return [base64.b64encode(v.tobytes()).decode("ascii") for v in vectors]
+    return vectors.tolist()
+
+
+def json_response(payload : dict, status : int = 200):
+    """
+    Http response of a payload, serialized once. The body is the same
+    bytes to store with the request, see tools.store(body=...).
+    """
+    resp = make_response(serializer.dumps(payload), status)
+    resp.headers['Content-Type'] = "application/json"
+    return resp
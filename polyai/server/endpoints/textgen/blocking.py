@@ -2,7 +2,7 @@ import os
 import ssl
 import json
 from flask import (
-    Blueprint, jsonify, make_response, request,
+    Blueprint, make_response, request,
     abort, session, redirect,
 )
 
@@ -10,12 +10,16 @@ from threading import Thread
 
 import pylogg
 import polyai.server.state as state
+from polyai.server import auth, ratelimit, serializer
+from polyai.server.admission import Overloaded
 
 # Set log prefix
 log = pylogg.New("api")
 
 # Handle all the urls that starts with /api/v1
 bp = Blueprint("api", __name__)
+auth.protect(bp)
+ratelimit.protect(bp)
 
 def get_model_info():
     return {
@@ -27,7 +31,8 @@ def get_model_info():
     }
 
 def respond(obj : dict = {}, status = 200):
-    resp = make_response(jsonify(obj), status)
+    resp = make_response(serializer.dumps(obj), status)
+    resp.headers['Content-Type'] = 'application/json'
     resp.headers['Access-Control-Allow-Origin'] =  '*'
     resp.headers['Access-Control-Allow-Methods'] =  '*'
     resp.headers['Access-Control-Allow-Headers'] =  '*'
@@ -54,8 +59,15 @@ def generate():
     body = request.get_json()
     prompt = body['prompt']
     try:
-        output = state.LLM.generate(prompt, body)
+        output = state.LLM.generate(prompt, body, **ratelimit.share())
         model, reply_list, ptok, ctok, dt = output
+        ratelimit.charge(ptok, ctok)
+    except Overloaded as err:
+        resp = respond({'result': str(err)}, err.status)
+        resp.headers['Retry-After'] = str(err.retry_after)
+        return resp
+    except ValueError as err:
+        return respond({'result': str(err)}, 400)
     except Exception as err:
         reply_list = [str(err)]
     return respond({
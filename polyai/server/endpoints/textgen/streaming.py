@@ -1,16 +1,19 @@
 import os
-import json
 import asyncio
 from threading import Thread
 from websockets.server import serve
 
 import pylogg
 import polyai.server.state as state
+from polyai.server import auth, ratelimit, serializer
+from polyai.server.admission import Overloaded
 
 # Set log prefix
 log = pylogg.New("stream")
 
 PATH = '/api/v1/stream'
+CHAT_PATH = '/api/v1/chat-stream'
+PATHS = (PATH, CHAT_PATH)
 
 import asyncio
 import functools
@@ -46,59 +49,113 @@ def with_api_lock(func):
     This decorator should be added to all streaming API methods which
     require access to the shared.generation_lock.  It ensures that the
     tls.asyncio_lock is acquired before the method is called, and
-    released afterwards.
+    released afterwards. Not when the admission queue or the batch
+    scheduler bound the concurrent streams, so they are batched together.
     """
     @functools.wraps(func)
     async def api_wrapper(*args, **kwargs):
+        if state.LLM.concurrent():
+            return await func(*args, **kwargs)
         async with _get_api_lock(api_tls):
             return await func(*args, **kwargs)
     return api_wrapper
 
 
+async def _iterate(generator):
+    """
+    Step a blocking generator in a worker thread, so that the event loop
+    keeps serving the other connections while the model runs.
+    """
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, generator, done)
+        if item is done:
+            return
+        yield item
+
+
+def _charge(caller : tuple, prompt : str, texts : list):
+    """
+    Charge the tokens of a stream to the rate limit of the caller. The
+    first text streamed is the prompt.
+    """
+    if not texts:
+        return
+    tokens = state.LLM.encode(prompt).shape[-1] + \
+             state.LLM.encode("".join(texts[1:])).shape[-1]
+    ratelimit.limiter.charge(*caller, tokens)
+
+
 @with_api_lock
-async def _handle_stream_message(websocket, message):
+async def _handle_stream_message(websocket, message, caller):
     log.trace("Stream requested: {}", message)
 
-    body = json.loads(message)
+    body = serializer.loads(message)
     prompt = body['prompt']
     body['stream'] = True
 
-    # As we stream, only send the new bytes.
-    skip_index = 0
+    key, role = caller
     message_num = 0
+    sent = []
 
-    if not state.LLM._is_ready:
-        await websocket.send(json.dumps({
+    # The stream yields only the new text, partial unicode characters
+    # are held back by the stream decoder.
+    try:
+        ratelimit.limiter.check(key, role)
+        stream = state.LLM.stream(prompt, body, key,
+                                  ratelimit.limiter.weight(role))
+        async for to_send in _iterate(stream):
+            sent.append(to_send)
+            if not to_send:
+                continue
+
+            await websocket.send(serializer.dumps_str({
+                'event': 'text_stream',
+                'message_num': message_num,
+                'text': to_send
+            }))
+
+            await asyncio.sleep(0)
+            message_num += 1
+
+    except ConnectionError:
+        await websocket.send(serializer.dumps_str({
             'event': 'stream_end',
             'message_num': message_num,
             'text': 'Error!! Model not ready.'
         }))
+        return
 
+    except Overloaded as err:
+        await websocket.send(serializer.dumps_str({
+            'event': 'stream_end',
+            'message_num': message_num,
+            'text': f'Error!! {err}',
+            'retry_after': err.retry_after
+        }))
+        return
 
-    for a in state.LLM.stream(prompt, body):
-        to_send = a[skip_index:]
-        if to_send is None or chr(0xfffd) in to_send:  # partial unicode character, don't send it yet.
-            continue
-
-        await websocket.send(json.dumps({
-            'event': 'text_stream',
+    except ValueError as err:
+        await websocket.send(serializer.dumps_str({
+            'event': 'stream_end',
             'message_num': message_num,
-            'text': to_send
+            'text': f'Error!! {err}'
         }))
+        return
 
-        await asyncio.sleep(0)
-        skip_index += len(to_send)
-        message_num += 1
+    finally:
+        _charge(caller, prompt, sent)
 
-    await websocket.send(json.dumps({
+    await websocket.send(serializer.dumps_str({
         'event': 'stream_end',
         'message_num': message_num
     }))
 
 
 @with_api_lock
-async def _handle_chat_stream_message(websocket, message):
-    body = json.loads(message)
+async def _handle_chat_stream_message(websocket, message, caller):
+    body = serializer.loads(message)
 
     user_input = body['user_input']
     body['stream'] = True
@@ -109,36 +166,88 @@ async def _handle_chat_stream_message(websocket, message):
     #     user_input, generate_params, regenerate=regenerate, _continue=_continue, loading_message=False)
     log.warn("Chat stream requested. Not fully supported.")
 
+    key, role = caller
     message_num = 0
-    for a in state.LLM.stream(user_input, body):
-        await websocket.send(json.dumps({
-            'event': 'text_stream',
+    sent = []
+    try:
+        ratelimit.limiter.check(key, role)
+        stream = state.LLM.stream(user_input, body, key,
+                                  ratelimit.limiter.weight(role))
+        async for a in _iterate(stream):
+            sent.append(a)
+            await websocket.send(serializer.dumps_str({
+                'event': 'text_stream',
+                'message_num': message_num,
+                'history': a
+            }))
+
+            await asyncio.sleep(0)
+            message_num += 1
+
+    except Overloaded as err:
+        await websocket.send(serializer.dumps_str({
+            'event': 'stream_end',
             'message_num': message_num,
-            'history': a
+            'text': f'Error!! {err}',
+            'retry_after': err.retry_after
         }))
+        return
+
+    except ValueError as err:
+        await websocket.send(serializer.dumps_str({
+            'event': 'stream_end',
+            'message_num': message_num,
+            'text': f'Error!! {err}'
+        }))
+        return
 
-        await asyncio.sleep(0)
-        message_num += 1
+    finally:
+        _charge(caller, user_input, sent)
 
-    await websocket.send(json.dumps({
+    await websocket.send(serializer.dumps_str({
         'event': 'stream_end',
         'message_num': message_num
     }))
 
 
+async def _identify(websocket):
+    """
+    Check the Api-Key of the handshake. Returns the rate limit key and role
+    of the client, or None after closing the connection.
+    """
+    address = (websocket.remote_address or ("",))[0]
+    apikey = websocket.request_headers.get(auth.HEADER)
+    try:
+        # May load the key from the database.
+        identity = await asyncio.get_running_loop().run_in_executor(
+            None, auth.identify, apikey)
+    except auth.AuthUnavailable as err:
+        await websocket.close(1013, str(err))
+        return None
+    except PermissionError as err:
+        log.info("Invalid API key from {}", address)
+        await websocket.close(1008, str(err))
+        return None
+    return ratelimit.caller(identity, address)
+
+
 async def _handle_connection(websocket, path):
     log.trace("Stream request: {}", path)
+    if path not in PATHS:
+        log.warn(f'Unknown path requested: {path}')
+        return
+
+    caller = await _identify(websocket)
+    if caller is None:
+        return
+
     if path == PATH:
         async for message in websocket:
-            await _handle_stream_message(websocket, message)
+            await _handle_stream_message(websocket, message, caller)
 
-    elif path == '/api/v1/chat-stream':
+    elif path == CHAT_PATH:
         async for message in websocket:
-            await _handle_chat_stream_message(websocket, message)
-
-    else:
-        log.warn(f'Unknown path requested: {path}')
-        return
+            await _handle_chat_stream_message(websocket, message, caller)
 
 
 async def _run(host: str, port: int,
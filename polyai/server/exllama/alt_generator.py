@@ -2,6 +2,7 @@ from . import cuda_ext
 from .model import ExLlama, ExLlamaCache
 from .tokenizer import ExLlamaTokenizer
 from .lora import ExLlamaLora
+from polyai.server.generation.sampling import sample_batch
 import torch
 import torch.nn.functional as F
 
@@ -16,6 +17,8 @@ class ExLlamaAltGenerator:
         top_p = 0.65                            # consider tokens up to a cumulative probabiltiy of top_p, 0.0 to disable top_p sampling
         min_p = 0.0                             # Do not consider tokens with probability less than this
         typical = 0.0                           # Locally typical sampling threshold, 0.0 to disable typical sampling
+        tfs = 1.0                               # Tail free sampling threshold, 1.0 to disable tail free sampling
+        top_a = 0.0                             # Drop tokens less probable than top_a * max_prob^2, 0.0 to disable
 
         token_repetition_penalty_max = 1.15     # Repetition penalty for most recent tokens
         token_repetition_penalty_sustain = -1   # No. most recent tokens to repeat penalty for, -1 to apply to whole context
@@ -255,75 +258,14 @@ class ExLlamaAltGenerator:
         elif logits.dim() == 2: logits = logits[-1, :]
         else: raise ValueError("Bad logits dimension")
 
-        # Disallow tokens
-
-        if gen_settings.disallowed_tokens is not None:
-            logits[gen_settings.disallowed_tokens] = float("-inf")
-
-        # Base probabilities
-
-        logits /= gen_settings.temperature
-        logits += 1e-8
-        probs = torch.softmax(logits, dim = -1)
-
-        # Top K
-
-        if gen_settings.top_k == 0:
-            top_probs, top_indices = torch.sort(probs, descending = True)
-        else:
-            top_probs, top_indices = torch.topk(probs, gen_settings.top_k)
-            top_probs = F.normalize(top_probs, p = 1, dim = -1)
-
-        # Top P
-
-        if gen_settings.top_p > 0.0:
-
-            num_top_p_probs = 0
-            cum_prob = top_probs[0].item()
-            while True:
-                num_top_p_probs += 1
-                if num_top_p_probs == top_probs.shape[-1]: break
-                if top_probs[num_top_p_probs].item() < gen_settings.min_p: break
-                cum_prob += top_probs[num_top_p_probs].item()
-                if cum_prob > gen_settings.top_p: break
-
-            top_probs = top_probs[:num_top_p_probs]
-            top_probs = F.normalize(top_probs, p = 1, dim = -1)
-            top_indices = top_indices[:num_top_p_probs]
-
-        # Locally typical sampling
-
-        if gen_settings.typical > 0.0:
-
-            epsilon = 1e-10
-            log_probs = (top_probs + epsilon).log()
-            neg_entropy = (top_probs * log_probs).sum()
-            entropy_dev = (neg_entropy - log_probs).abs()
-            _, entropy_dev_order = torch.sort(entropy_dev)
-
-            top_probs = top_probs.gather(-1, entropy_dev_order)
-            top_indices = top_indices.gather(-1, entropy_dev_order)
-
-            num_typical_probs = 0
-            cum_prob = top_probs[0].item()
-            while True:
-                num_typical_probs += 1
-                if num_typical_probs == top_probs.shape[-1]: break
-                cum_prob += top_probs[num_typical_probs].item()
-                if cum_prob > gen_settings.typical: break
-
-            top_probs = top_probs[:num_typical_probs]
-            top_probs = F.normalize(top_probs, p = 1, dim = -1)
-            top_indices = top_indices[:num_typical_probs]
-
-        # Multinomial sampling from top_probs, kept in same order as top_indices
-
-        sampled_ind = torch.multinomial(top_probs, 1)
-        sampled_tokens = top_indices[sampled_ind]
-        sampled_probs = top_probs[sampled_ind]  # Return probs before second norm
-
-        # if sampled_tokens.shape[0] > 1:
-        #     sampled_tokens, ind = sampled_tokens.sort()
-        #     sampled_probs = sampled_probs[ind]
-
-        return sampled_tokens.unsqueeze(0), sampled_probs.unsqueeze(0)
+        # Filter and sample as masks over the sorted distribution
+
+        return sample_batch(logits.unsqueeze(0),
+                            gen_settings.temperature,
+                            gen_settings.top_k,
+                            gen_settings.top_p,
+                            gen_settings.min_p,
+                            gen_settings.typical,
+                            tfs = gen_settings.tfs,
+                            top_a = gen_settings.top_a,
+                            disallowed_tokens = gen_settings.disallowed_tokens)
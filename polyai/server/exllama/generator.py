@@ -1,6 +1,7 @@
 from . import cuda_ext
 from .model import ExLlama, ExLlamaCache
 from .lora import ExLlamaLora
+from polyai.server.generation.sampling import sample_batch
 import torch
 import torch.nn.functional as F
 
@@ -13,6 +14,8 @@ class ExLlamaGenerator:
         top_p = 0.65                            # consider tokens up to a cumulative probabiltiy of top_p, 0.0 to disable top_p sampling
         min_p = 0.0                             # Do not consider tokens with probability less than this
         typical = 0.0                           # Locally typical sampling threshold, 0.0 to disable typical sampling
+        tfs = 1.0                               # Tail free sampling threshold, 1.0 to disable tail free sampling
+        top_a = 0.0                             # Drop tokens less probable than top_a * max_prob^2, 0.0 to disable
 
         token_repetition_penalty_max = 1.15     # Repetition penalty for most recent tokens
         token_repetition_penalty_sustain = 256  # No. most recent tokens to repeat penalty for, -1 to apply to whole context
@@ -64,14 +67,12 @@ class ExLlamaGenerator:
 
         if logits.shape[0] == 1: return self.sample(logits, temperature, top_k, top_p, min_p, typical, num)
 
-        samples = []
-        scores = []
-        for i in range(logits.shape[0]):
-            t, s = self.sample(logits[i, :, :], temperature, top_k, top_p, min_p, typical)
-            samples.append(t)
-            scores.append(s)
+        # All rows in one shot
 
-        return torch.cat(samples, dim = 0), torch.cat(scores, dim = 0)
+        return sample_batch(logits[:, -1, :], temperature, top_k, top_p, min_p, typical,
+                            tfs = self.settings.tfs,
+                            top_a = self.settings.top_a,
+                            disallowed_tokens = self.disallowed_tokens)
 
 
     # Sample one token from logits with current settings
@@ -86,7 +87,8 @@ class ExLlamaGenerator:
                            self.settings.typical)
 
 
-    # Sample one token from logits
+    # Sample one token from logits. The filters run as masks over the sorted
+    # distribution (see generation.sampling), without a sync per candidate.
 
     def sample(self, logits, temperature, top_k, top_p, min_p, typical, num = 1):
 
@@ -96,78 +98,11 @@ class ExLlamaGenerator:
         elif logits.dim() == 2: logits = logits[-1, :]
         else: raise ValueError("Bad logits dimension")
 
-        # Disallow tokens
-
-        if self.disallowed_tokens is not None:
-            logits[self.disallowed_tokens] = float("-inf")
-
-        # Base probabilities
-
-        logits /= temperature
-        logits += 1e-8
-        probs = torch.softmax(logits, dim = -1)
-
-        # Top K
-
-        if top_k == 0:
-            top_probs, top_indices = torch.sort(probs, descending = True)
-        else:
-            top_probs, top_indices = torch.topk(probs, top_k)
-            top_probs = F.normalize(top_probs, p = 1, dim = -1)
-
-        # Top P
-
-        if top_p > 0.0:
-
-            num_top_p_probs = 0
-            cum_prob = top_probs[0].item()
-            while True:
-                num_top_p_probs += 1
-                if num_top_p_probs == top_probs.shape[-1]: break
-                if top_probs[num_top_p_probs].item() < min_p: break
-                cum_prob += top_probs[num_top_p_probs].item()
-                if cum_prob > top_p: break
-
-            top_probs = top_probs[:num_top_p_probs]
-            top_probs = F.normalize(top_probs, p = 1, dim = -1)
-            top_indices = top_indices[:num_top_p_probs]
-
-        # Locally typical sampling
-
-        if typical > 0.0:
-
-            epsilon = 1e-10
-            log_probs = (top_probs + epsilon).log()
-            neg_entropy = (top_probs * log_probs).sum()
-            entropy_dev = (neg_entropy - log_probs).abs()
-            _, entropy_dev_order = torch.sort(entropy_dev)
-
-            top_probs = top_probs.gather(-1, entropy_dev_order)
-            top_indices = top_indices.gather(-1, entropy_dev_order)
-
-            num_typical_probs = 0
-            cum_prob = top_probs[0].item()
-            while True:
-                num_typical_probs += 1
-                if num_typical_probs == top_probs.shape[-1]: break
-                cum_prob += top_probs[num_typical_probs].item()
-                if cum_prob > typical: break
-
-            top_probs = top_probs[:num_typical_probs]
-            top_probs = F.normalize(top_probs, p = 1, dim = -1)
-            top_indices = top_indices[:num_typical_probs]
-
-        # Multinomial sampling from top_probs, kept in same order as top_indices
-
-        sampled_ind = torch.multinomial(top_probs, top_probs.shape[-1] if num == -1 else min(num, top_probs.shape[-1]))
-        sampled_tokens = top_indices[sampled_ind]
-        sampled_probs = top_probs[sampled_ind]  # Return probs before second norm
-
-        if sampled_tokens.shape[0] > 1:
-            sampled_tokens, ind = sampled_tokens.sort()
-            sampled_probs = sampled_probs[ind]
-
-        return sampled_tokens.unsqueeze(0), sampled_probs.unsqueeze(0)
+        return sample_batch(logits.unsqueeze(0), temperature, top_k, top_p, min_p, typical,
+                            tfs = self.settings.tfs,
+                            top_a = self.settings.top_a,
+                            disallowed_tokens = self.disallowed_tokens,
+                            num = num)
 
 
     def disallow_tokens(self, tokens):
@@ -525,7 +525,7 @@ class ExLlamaDecoderLayer:
 
         # Self-attention
 
-        if self.config.fused_attn and _rows(hidden_states) == 1:
+        if self.config.fused_attn and _rows(hidden_states) == 1 and buffer.attn_mask is None:
 
             self.self_attn.fused(hidden_states, cache, buffer, self.input_layernorm, lora)
 
@@ -928,7 +928,8 @@ class ExLlama:
                 preprocess_only = False,
                 lora = None,
                 output_device = None,
-                input_mask = None):
+                input_mask = None,
+                output_hidden = False):
 
         q_len = input_ids.shape[-1]
         remaining_q_len = q_len
@@ -975,7 +976,8 @@ class ExLlama:
                              _preprocess_only,
                              lora,
                              output_device,
-                             input_mask)
+                             input_mask,
+                             output_hidden)
 
             if not _preprocess_only:
                 result = r if result is None else torch.cat((result, r), dim = 1)
@@ -993,7 +995,8 @@ class ExLlama:
                  preprocess_only = False,
                  lora = None,
                  output_device = None,
-                 input_mask = None):
+                 input_mask = None,
+                 output_hidden = False):
 
         # if torch.is_grad_enabled():
         #     raise ValueError("Forward pass called with gradients enabled. Back propagation is not supported yet.")
@@ -1071,6 +1074,12 @@ class ExLlama:
             # Head
 
             if last_id_only: hidden_states = hidden_states[:, -1:, :].contiguous()
+
+            # Normalized hidden states instead of logits, e.g. for embeddings
+
+            if output_hidden:
+                return _move_tensor(hidden_states.float(), output_device, "hidden_states", self.config)
+
             if self.config.device_map.lm_head == "cpu": hidden_states = hidden_states.float()
 
             hidden_states = _move_tensor(hidden_states, self.config.device_map.lm_head, "hidden_states", self.config)
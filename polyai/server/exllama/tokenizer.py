@@ -176,6 +176,13 @@ class ExLlamaTokenizer:
             return text
 
 
+    # Incremental decoder for streaming generated tokens
+
+    def stream_decoder(self, context_ids = None):
+
+        return ExLlamaStreamDecoder(self, context_ids)
+
+
     def num_tokens(self, text, encode_special_characters = False):
         
         if encode_special_characters:
@@ -186,4 +193,64 @@ class ExLlamaTokenizer:
         else:
             
             ids = self.tokenizer.Encode(text)
-            return len(ids)
\ No newline at end of file
+            return len(ids)
+
+class ExLlamaStreamDecoder:
+
+    # Decodes a stream of token ids incrementally, returning only the new text per token.
+    #
+    # Decoding a single SentencePiece token on its own drops its leading space and can
+    # split multi-byte UTF-8 characters over several byte fallback tokens, which is why
+    # the streaming loops used to re-decode the whole response on every step. Instead,
+    # only a small window is decoded: the token(s) emitted last time as a prefix, plus
+    # the ones not emitted yet. New text is held back while it ends in a partial UTF-8
+    # character (decoded as 0xfffd), so the per token cost does not grow with the
+    # length of the response.
+
+    lookback = 4                                # context tokens kept from context_ids
+
+    def __init__(self, tokenizer, context_ids = None):
+
+        self.tokenizer = tokenizer
+        self.ids = []
+        if context_ids is not None:
+            if isinstance(context_ids, torch.Tensor): context_ids = context_ids.view(-1).tolist()
+            self.ids = list(context_ids)[-self.lookback:]
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        self.num_tokens = 0
+
+
+    def add(self, token_id):
+
+        if isinstance(token_id, torch.Tensor): token_id = token_id.item()
+        self.ids.append(token_id)
+        self.num_tokens += 1
+
+        decode = self.tokenizer.tokenizer.Decode
+        prefix_text = decode(self.ids[self.prefix_offset:self.read_offset])
+        text = decode(self.ids[self.prefix_offset:])
+
+        # Partial unicode character, wait for the rest of its bytes
+
+        if len(text) <= len(prefix_text) or text.endswith(chr(0xfffd)):
+            return ""
+
+        # Slide the window past the emitted tokens
+
+        del self.ids[:self.read_offset]
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        return text[len(prefix_text):]
+
+
+    def flush(self):
+
+        # Remaining text held back, e.g. an incomplete character at the end of the stream
+
+        decode = self.tokenizer.tokenizer.Decode
+        prefix_text = decode(self.ids[self.prefix_offset:self.read_offset])
+        text = decode(self.ids[self.prefix_offset:])
+        del self.ids[:self.read_offset]
+        self.read_offset = len(self.ids)
+        return text[len(prefix_text):]
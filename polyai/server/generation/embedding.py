@@ -0,0 +1,96 @@
+""" Text embeddings from the last hidden states of a model.
+
+    The texts are sorted by length and grouped into batches of at most
+    max_batch_tokens padded tokens, so that one forward pass embeds many
+    texts with little padding. The hidden states of each text are pooled
+    over its unmasked tokens into one vector:
+        mean    average of the tokens.
+        last    the last token, e.g. for decoder models like Llama, where
+                only the last token has seen the whole text.
+        cls     the first token, e.g. the [CLS] token of BERT.
+
+    Works with ExLlama + ExLlamaCache on GPU, or TorchLlama + TorchLlamaCache
+    on CPU, through forward(..., output_hidden=True).
+"""
+import torch
+import torch.nn.functional as F
+
+POOLING = ("mean", "last", "cls")
+
+
+def pool(hidden : torch.Tensor, mask : torch.Tensor, pooling : str = "mean",
+         normalize : bool = True) -> torch.Tensor:
+    """
+    Pool hidden states [batch, seq_len, hidden] over the positions where
+    mask [batch, seq_len] is True. Returns float [batch, hidden].
+    """
+    if pooling not in POOLING:
+        raise ValueError(f"unknown pooling: {pooling}")
+
+    hidden = hidden.float()
+    if mask is None:
+        mask = torch.ones(hidden.shape[:2], dtype=torch.bool)
+    mask = mask[:, :hidden.shape[1]].to(hidden.device)
+    rows = torch.arange(hidden.shape[0], device=hidden.device)
+
+    if pooling == "mean":
+        m = mask.unsqueeze(-1).to(hidden.dtype)
+        vectors = (hidden * m).sum(dim=1) / m.sum(dim=1).clamp(min=1)
+    elif pooling == "last":
+        last = mask.shape[1] - 1 - mask.flip(1).int().argmax(dim=1)
+        vectors = hidden[rows, last]
+    else:
+        first = mask.int().argmax(dim=1)
+        vectors = hidden[rows, first]
+
+    if normalize:
+        vectors = F.normalize(vectors, dim=-1)
+    return vectors
+
+
+def length_batches(lengths : list, max_batch_tokens : int) -> list:
+    """
+    Group the indices of the texts, shortest first, so that the batch size
+    times the longest length of a batch is at most max_batch_tokens.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # Lengths are sorted, so the new one is the longest of the batch.
+        if batch and (len(batch) + 1) * max(lengths[i], 1) > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed(model, cache_class, encode, texts : list, lengths : list,
+          pooling : str = "mean", normalize : bool = True,
+          max_batch_tokens : int = 4096) -> torch.Tensor:
+    """
+    Embed the texts with a decoder model.
+
+    Args:
+        model:          ExLlama or TorchLlama instance.
+        cache_class:    Its cache class, a cache is made for each batch.
+        encode:         Function of a list of texts returning the padded
+                        token ids [batch, seq_len] and the mask, or None.
+        lengths:        Number of tokens of each text.
+
+    Returns float [len(texts), hidden], in the order of the texts.
+    """
+    vectors = [None] * len(texts)
+    for batch in length_batches(lengths, max_batch_tokens):
+        ids, mask = encode([texts[i] for i in batch])
+        cache = cache_class(model, batch_size=ids.shape[0],
+                            max_seq_len=ids.shape[-1])
+        hidden = model.forward(ids, cache, last_id_only=False,
+                               input_mask=mask, output_hidden=True)
+        pooled = pool(hidden, mask, pooling, normalize).cpu()
+        for i, vector in zip(batch, pooled):
+            vectors[i] = vector
+        del cache
+    return torch.stack(vectors)
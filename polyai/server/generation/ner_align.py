@@ -0,0 +1,70 @@
+""" Word level labels from the entity spans of a NER pipeline.
+
+    The HF token classification pipeline, with an aggregation strategy,
+    returns the entities as character spans of the text, taken from the
+    offset_mapping of the tokenizer. The text is split into words, and
+    each word gets the label of the entity it overlaps, or 'O'. Both lists
+    are ordered by position, so this is a single O(words + entities) walk.
+
+    Words are split by:
+        regex       runs of word characters, and each other non space
+                    character, as the BERT pre-tokenizer splits them.
+        whitespace  runs of non space characters.
+        spacy       the tokens of a spaCy pipeline, if installed.
+
+    Any whitespace, e.g. tabs and newlines, separates the words.
+"""
+import re
+from collections import namedtuple
+
+WORDS = ("regex", "whitespace", "spacy")
+
+token_label = namedtuple('token_label', ["text", "label"])
+
+_patterns = {
+    'regex': re.compile(r"\w+|[^\w\s]"),
+    'whitespace': re.compile(r"\S+"),
+}
+
+
+def word_spans(text : str, words : str = "regex", nlp = None) -> list:
+    """ Character (start, end) of each word of the text. """
+    if words == "spacy":
+        if nlp is None:
+            raise ValueError("spacy words need a spacy pipeline")
+        return [(tok.idx, tok.idx + len(tok.text)) for tok in nlp(text)
+                if not tok.is_space]
+    if words not in _patterns:
+        raise ValueError(f"unknown word splitter: {words}")
+    return [m.span() for m in _patterns[words].finditer(text)]
+
+
+def align(entities : list, text : str, spans : list) -> list[token_label]:
+    """
+    Label the words at spans of text by the entities.
+
+    Args:
+        entities:   Pipeline outputs with start, end and entity_group,
+                    ordered by start.
+        text:       Text given to the pipeline.
+        spans:      Ordered (start, end) of the words.
+    """
+    labels = []
+    j = 0
+    n = len(entities)
+    for start, end in spans:
+        # Skip the entities ending before this word.
+        while j < n and entities[j]["end"] <= start:
+            j += 1
+        if j < n and entities[j]["start"] < end:
+            label = entities[j]["entity_group"]
+        else:
+            label = 'O'
+        labels.append(token_label(text[start:end], label))
+    return labels
+
+
+def ner_words(entities : list, text : str, words : str = "regex",
+              nlp = None) -> list[token_label]:
+    """ Split the text into words and label them by the entities. """
+    return align(entities, text, word_spans(text, words, nlp))
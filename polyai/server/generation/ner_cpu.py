@@ -0,0 +1,116 @@
+""" CPU inference of the BERT NER model.
+
+    Without a GPU, the model runs in one of the modes:
+        fp32    the model as is.
+        int8    dynamic int8 quantization of the Linear layers. Their
+                weights are stored as int8 and the activations quantized
+                on the fly, so the matmuls, most of the time of BERT on
+                CPU, use int8 kernels. The layers are 4x smaller.
+
+    The number of torch threads can be set. On machines with many cores,
+    where one process does not scale, the NER batches can also be split
+    across worker processes, each with its own copy of the model.
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import torch
+from polyai.server.generation import ner_window
+
+MODES = ("fp32", "int8")
+
+
+def set_threads(threads : int):
+    """ Set the torch threads, 0 to keep the default. """
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+
+def optimize(model, device : str = "cpu", mode : str = "fp32"):
+    """ Return the token classification model for the inference mode. """
+    if mode not in MODES:
+        raise ValueError(f"unknown NER mode: {mode}")
+    if mode == "fp32":
+        return model
+    if not str(device).startswith("cpu"):
+        raise ValueError(f"{mode} NER runs on cpu only")
+
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_pipeline(model_dir : str, device : str = "cpu", mode : str = "fp32"):
+    """ Load the NER pipeline of a token classification model. """
+    from transformers import (AutoModelForTokenClassification, AutoTokenizer,
+                              pipeline)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, model_max_length=512)
+    model = AutoModelForTokenClassification.from_pretrained(model_dir)
+    return pipeline(task="ner",
+                    model=optimize(model, device, mode),
+                    tokenizer=tokenizer,
+                    aggregation_strategy="simple",
+                    device=device)
+
+
+# Pipeline of a worker process.
+_pipe = None
+
+def _init_worker(model_dir : str, mode : str, threads : int):
+    global _pipe
+    set_threads(threads)
+    _pipe = load_pipeline(model_dir, "cpu", mode)
+
+
+def _ready():
+    return os.getpid()
+
+
+def _ner(texts : list, stride : int, max_batch_tokens : int) -> list:
+    return ner_window.ner(_pipe, texts, stride, max_batch_tokens)
+
+
+class Workers:
+    """
+    Run the NER of a batch of texts on worker processes.
+
+    Args:
+        model_dir:          Directory of the model.
+        workers:            Number of processes.
+        mode:               Inference mode of the model.
+        threads:            Torch threads per process, 0 to share the
+                            cores between the processes.
+        stride:             Tokens shared by the windows of long texts.
+        max_batch_tokens:   Max padded tokens per forward pass.
+    """
+
+    def __init__(self, model_dir : str, workers : int, mode : str = "fp32",
+                 threads : int = 0, stride : int = 128,
+                 max_batch_tokens : int = 4096):
+        self.workers = workers
+        self.stride = stride
+        self.max_batch_tokens = max_batch_tokens
+        if threads <= 0:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+
+        # Spawn, a forked torch may hang on its thread pools.
+        self.pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(model_dir, mode, threads))
+
+        # Load the model in the processes before the first request.
+        wait([self.pool.submit(_ready) for _ in range(workers)])
+
+    def ner(self, texts : list) -> list:
+        """ Entities of each text, the texts split across the workers. """
+        n = max(1, min(self.workers, len(texts)))
+        futures = [self.pool.submit(_ner, texts[i::n], self.stride,
+                                    self.max_batch_tokens) for i in range(n)]
+        results = [None] * len(texts)
+        for i, future in enumerate(futures):
+            results[i::n] = future.result()
+        return results
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,104 @@
+""" NER of texts longer than the model, over overlapping windows.
+
+    The fast tokenizer splits each text into windows of model_max_length
+    tokens, each overlapping the previous one by stride tokens. The windows
+    of all the texts are grouped by length into padded forward passes of
+    at most max_batch_tokens, so a long document costs a few batched passes
+    instead of one call per piece.
+
+    The offsets of the tokens are into the original text, whichever window
+    they are in. A token of an overlap is seen by two windows, and the
+    prediction of the more confident one is kept, which is usually the one
+    where the token has more context. The merged tokens of each text are
+    then grouped into entities by the pipeline, as for a short text.
+"""
+import torch
+from transformers.pipelines.token_classification import AggregationStrategy
+
+from polyai.server.microbatch import by_length
+
+
+def windows(tokenizer, texts : list, stride : int = 128):
+    """
+    Tokenize the texts into overlapping windows.
+
+    Returns:
+        The tokenizer encoding of the windows, and the
+        index of the text of each window.
+    """
+    enc = tokenizer(texts, truncation=True, stride=stride,
+                    return_overflowing_tokens=True,
+                    return_offsets_mapping=True,
+                    return_special_tokens_mask=True)
+    return enc, enc['overflow_to_sample_mapping']
+
+
+def forward(model, tokenizer, input_ids : list) -> list:
+    """ Logits of a padded batch of windows, without the padding. """
+    inputs = tokenizer.pad({'input_ids': input_ids}, return_tensors="pt")
+    inputs = inputs.to(model.device)
+    with torch.no_grad():
+        logits = model(**inputs).logits.float().cpu()
+    return [logits[i, :len(ids)] for i, ids in enumerate(input_ids)]
+
+
+def merge(enc, owners : list, logits : list, count : int) -> list:
+    """
+    Merge the tokens of the windows of each text, keeping the most
+    confident prediction of a token seen twice.
+
+    Returns:
+        List of the (offsets, input ids, logits) of each text.
+    """
+    best = [{} for _ in range(count)]
+    for w, doc in enumerate(owners):
+        confidence = logits[w].softmax(-1).max(-1).values.tolist()
+        special = enc['special_tokens_mask'][w]
+        for t, span in enumerate(enc['offset_mapping'][w]):
+            if special[t]:
+                continue
+            seen = best[doc].get(span)
+            if seen is None or confidence[t] > seen[0]:
+                best[doc][span] = (confidence[t], w, t)
+
+    merged = []
+    for tokens in best:
+        spans = sorted(tokens)
+        rows = [tokens[span][1:] for span in spans]
+        merged.append((
+            spans,
+            [enc['input_ids'][w][t] for w, t in rows],
+            torch.stack([logits[w][t] for w, t in rows]) if rows else None,
+        ))
+    return merged
+
+
+def ner(pipe, texts : list, stride : int = 128,
+        max_batch_tokens : int = 4096) -> list:
+    """
+    Entities of each text, of any length, as pipe(text) would give for a
+    text that fits the model.
+    """
+    tokenizer, model = pipe.tokenizer, pipe.model
+    enc, owners = windows(tokenizer, texts, stride)
+    input_ids = enc['input_ids']
+    logits = by_length(lambda group: forward(model, tokenizer, group),
+                       input_ids, [len(ids) for ids in input_ids],
+                       max_batch_tokens)
+
+    results = []
+    for text, (spans, ids, rows) in zip(texts, merge(enc, owners, logits,
+                                                     len(texts))):
+        if rows is None:
+            results.append([])
+            continue
+        outputs = {
+            'logits': rows.unsqueeze(0),
+            'input_ids': torch.tensor([ids]),
+            'offset_mapping': torch.tensor([spans]),
+            'special_tokens_mask': torch.zeros(1, len(ids), dtype=torch.long),
+            'sentence': text,
+        }
+        results.append(pipe.postprocess(
+            [outputs], aggregation_strategy=AggregationStrategy.SIMPLE))
+    return results
@@ -0,0 +1,269 @@
+""" Paged key/value cache.
+
+    Instead of preallocating max_seq_len positions per batch row, keys and
+    values are stored in a pool of fixed size blocks. Each sequence owns a
+    block table mapping its logical positions to physical blocks, and blocks
+    are handed out from a free list as the sequence grows.
+
+    Blocks are reference counted, so sequences can share them (forked beams,
+    common prompt prefixes). A shared block is copied before it is written
+    to (copy-on-write).
+
+    Attention gathers the keys/values of each sequence through its block
+    table. TorchLlama.forward_paged() is the PyTorch reference of this path,
+    and PagedBatchScheduler batches sequences on it. The ExLlama CUDA
+    kernels write into the contiguous ExLlamaCache, so the server does not
+    use the paged cache yet.
+"""
+import threading
+
+import torch
+
+
+class OutOfBlocks(RuntimeError):
+    pass
+
+
+class BlockAllocator:
+    """ Free list of physical cache blocks with reference counts. """
+
+    def __init__(self, num_blocks : int):
+        self.num_blocks = num_blocks
+        self._free = list(range(num_blocks - 1, -1, -1))
+        self._refs = [0] * num_blocks
+
+    @property
+    def num_free(self) -> int:
+        return len(self._free)
+
+    @property
+    def num_used(self) -> int:
+        return self.num_blocks - len(self._free)
+
+    def allocate(self) -> int:
+        if not self._free:
+            raise OutOfBlocks("no free cache blocks")
+        block = self._free.pop()
+        self._refs[block] = 1
+        return block
+
+    def share(self, block : int) -> int:
+        assert self._refs[block] > 0
+        self._refs[block] += 1
+        return block
+
+    def release(self, block : int):
+        assert self._refs[block] > 0
+        self._refs[block] -= 1
+        if self._refs[block] == 0:
+            self._free.append(block)
+
+    def refs(self, block : int) -> int:
+        return self._refs[block]
+
+
+class _Sequence:
+    __slots__ = ('blocks', 'length')
+
+    def __init__(self):
+        self.blocks : list[int] = []
+        self.length = 0
+
+
+class PagedCache:
+    """
+    Block paged key/value cache for a model config.
+
+    Args:
+        config:         Model config (ExLlamaConfig or TorchLlamaConfig).
+        num_blocks:     Number of physical blocks in the pool.
+        block_size:     Number of token positions per block.
+    """
+
+    def __init__(self, config, num_blocks : int, block_size : int = 16,
+                 dtype = None, device = None):
+        self.config = config
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.dtype = dtype or getattr(config, 'dtype', torch.float16)
+        self.device = device or getattr(config, 'device', 'cpu')
+
+        self.allocator = BlockAllocator(num_blocks)
+        self._seqs : dict[object, _Sequence] = {}
+        self._lock = threading.Lock()
+
+        # Flat slot storage, slot = block * block_size + offset
+        shape = (num_blocks * block_size, config.num_key_value_heads,
+                 config.head_dim)
+        self.key_states = [torch.zeros(shape, dtype=self.dtype, device=self.device)
+                           for _ in range(config.num_hidden_layers)]
+        self.value_states = [torch.zeros(shape, dtype=self.dtype, device=self.device)
+                             for _ in range(config.num_hidden_layers)]
+
+    def num_bytes(self) -> int:
+        return sum(t.numel() * t.element_size()
+                   for t in self.key_states + self.value_states)
+
+    def add_sequence(self, seq_id):
+        with self._lock:
+            if seq_id in self._seqs:
+                raise KeyError(f"sequence exists: {seq_id}")
+            self._seqs[seq_id] = _Sequence()
+
+    def free_sequence(self, seq_id):
+        with self._lock:
+            seq = self._seqs.pop(seq_id)
+            for block in seq.blocks:
+                self.allocator.release(block)
+
+    def fork(self, src_id, dst_id, length : int = None):
+        """
+        Start sequence dst_id with the first length positions of src_id
+        (all of them by default), sharing the blocks copy-on-write.
+        """
+        with self._lock:
+            src = self._seqs[src_id]
+            length = src.length if length is None else min(length, src.length)
+            n = -(-length // self.block_size)
+            dst = _Sequence()
+            dst.blocks = [self.allocator.share(b) for b in src.blocks[:n]]
+            dst.length = length
+            self._seqs[dst_id] = dst
+
+    def length(self, seq_id) -> int:
+        return self._seqs[seq_id].length
+
+    def block_table(self, seq_id) -> list:
+        return list(self._seqs[seq_id].blocks)
+
+    def _copy_block(self, src : int, dst : int):
+        bs = self.block_size
+        for t in self.key_states + self.value_states:
+            t[dst * bs : (dst + 1) * bs] = t[src * bs : (src + 1) * bs]
+
+    def reserve(self, seq_id, num_tokens : int) -> torch.Tensor:
+        """
+        Make room for num_tokens new positions at the end of a sequence.
+        Returns the slot index of each new position. Shared blocks that
+        would be written to are copied first.
+        """
+        bs = self.block_size
+        with self._lock:
+            seq = self._seqs[seq_id]
+            start = seq.length
+            end = start + num_tokens
+
+            # Copy on write: the partially filled last block may be shared.
+            if start % bs != 0:
+                last = seq.blocks[-1]
+                if self.allocator.refs(last) > 1:
+                    new = self.allocator.allocate()
+                    self._copy_block(last, new)
+                    self.allocator.release(last)
+                    seq.blocks[-1] = new
+
+            # All or nothing, give back the blocks of a failed reserve.
+            added = len(seq.blocks)
+            try:
+                while len(seq.blocks) * bs < end:
+                    seq.blocks.append(self.allocator.allocate())
+            except OutOfBlocks:
+                for block in seq.blocks[added:]:
+                    self.allocator.release(block)
+                del seq.blocks[added:]
+                raise
+
+            seq.length = end
+            pos = torch.arange(start, end)
+            blocks = torch.tensor(seq.blocks, dtype=torch.long)
+            return blocks[pos // bs] * bs + pos % bs
+
+    def rewind(self, seq_id, num_tokens : int):
+        """ Drop the last num_tokens positions, releasing empty blocks. """
+        bs = self.block_size
+        with self._lock:
+            seq = self._seqs[seq_id]
+            seq.length = max(0, seq.length - num_tokens)
+            keep = -(-seq.length // bs)
+            for block in seq.blocks[keep:]:
+                self.allocator.release(block)
+            del seq.blocks[keep:]
+
+    def write(self, layer : int, slots, keys, values):
+        """ Store keys/values [tokens, kv_heads, head_dim] into slots. """
+        self.key_states[layer][slots] = keys.to(self.dtype)
+        self.value_states[layer][slots] = values.to(self.dtype)
+
+    def gather_slots(self, seq_ids : list):
+        """
+        Slot indices [batch, max_len] of all the positions of each sequence,
+        and a bool mask [batch, max_len] of the valid ones.
+        """
+        bs = self.block_size
+        lengths = [self._seqs[s].length for s in seq_ids]
+        max_len = max(lengths)
+        slots = torch.zeros((len(seq_ids), max_len), dtype=torch.long)
+        mask = torch.zeros((len(seq_ids), max_len), dtype=torch.bool)
+        pos = torch.arange(max_len)
+        for i, s in enumerate(seq_ids):
+            n = lengths[i]
+            if n == 0:
+                continue
+            blocks = torch.tensor(self._seqs[s].blocks, dtype=torch.long)
+            slots[i, :n] = blocks[pos[:n] // bs] * bs + pos[:n] % bs
+            mask[i, :n] = True
+        return slots, mask
+
+    def gather(self, layer : int, slots):
+        """ Keys, values [batch, max_len, kv_heads, head_dim] of the slots. """
+        return self.key_states[layer][slots], self.value_states[layer][slots]
+
+    def utilization(self) -> dict:
+        """ Block usage and how full the used blocks are. """
+        with self._lock:
+            used = self.allocator.num_used
+            tokens = sum(s.length for s in self._seqs.values())
+            logical = sum(len(s.blocks) for s in self._seqs.values())
+        return {
+            'blocks': self.num_blocks,
+            'used_blocks': used,
+            'free_blocks': self.num_blocks - used,
+            'block_utilization': used / self.num_blocks,
+            'sequences': len(self._seqs),
+            'tokens': tokens,
+            'shared_blocks': logical - used,
+            'fill_ratio': tokens / (logical * self.block_size) if logical else 0.0,
+        }
+
+
+def paged_attention(query, cache : PagedCache, layer : int, slots, mask,
+                    q_positions):
+    """
+    Reference attention through the block tables.
+
+    Args:
+        query:          [batch, heads, q_len, head_dim], RoPE applied.
+        slots, mask:    From PagedCache.gather_slots().
+        q_positions:    [batch, q_len] logical position of each query.
+
+    Returns:
+        Attention output [batch, q_len, heads, head_dim].
+    """
+    cfg = cache.config
+    keys, values = cache.gather(layer, slots)
+    keys = keys.transpose(1, 2).to(query.dtype)       # [b, kvh, len, d]
+    values = values.transpose(1, 2).to(query.dtype)
+    groups = cfg.num_attention_heads // cfg.num_key_value_heads
+    if groups > 1:
+        keys = keys.repeat_interleave(groups, dim=1)
+        values = values.repeat_interleave(groups, dim=1)
+
+    scores = torch.matmul(query, keys.transpose(2, 3)) / cfg.head_dim ** 0.5
+
+    # Causal and padding mask
+    k_pos = torch.arange(slots.shape[1], device=query.device)
+    allowed = mask[:, None, :] & (k_pos[None, None, :] <= q_positions[:, :, None])
+    scores = scores.masked_fill(~allowed[:, None, :, :], -65504.0)
+
+    probs = torch.softmax(scores.float(), dim=-1).to(query.dtype)
+    return torch.matmul(probs, values).transpose(1, 2)
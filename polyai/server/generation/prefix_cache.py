@@ -0,0 +1,178 @@
+""" Prompt prefix key/value cache shared across requests.
+
+    Prompts are split into fixed size token blocks. Each block is keyed by a
+    hash chained with the hash of the block before it, so a key identifies
+    the whole prefix up to and including that block. The keys/values of a
+    block are snapshotted into a small cache of the model with copy_states,
+    and restored into any later request that starts with the same tokens.
+
+    Keys are stored relative to the start of the sequence. When a block is
+    restored at a different cache offset (e.g. a right-aligned row of the
+    batch scheduler), the keys are rotated by the offset, which is exact for
+    RoPE up to the cache precision.
+
+    Blocks are evicted least recently used first under a memory budget.
+"""
+import threading
+import collections
+
+import torch
+import pylogg
+
+log = pylogg.New("prefix")
+
+
+class _Block:
+    __slots__ = ('key', 'parent', 'tokens', 'cache')
+
+    def __init__(self, key, parent, tokens, cache):
+        self.key = key
+        self.parent = parent
+        self.tokens = tokens
+        self.cache = cache
+
+
+def _rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+class PrefixCache:
+    """
+    LRU cache of prompt prefix key/value blocks.
+
+    Args:
+        model:          ExLlama or TorchLlama instance.
+        cache_class:    Cache class of the model, used for block snapshots.
+        block_size:     Number of tokens per block.
+        max_bytes:      Memory budget for all the snapshots.
+    """
+
+    def __init__(self, model, cache_class, block_size : int = 64,
+                 max_bytes : int = 512 * 1024**2):
+        self.model = model
+        self.config = model.config
+        self.cache_class = cache_class
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+
+        cfg = self.config
+        dtype = getattr(cfg, 'dtype', torch.float16)     # ExLlama uses fp16
+        elem = torch.tensor([], dtype=dtype).element_size()
+        self.block_bytes = 2 * cfg.num_hidden_layers * cfg.num_key_value_heads \
+                            * block_size * cfg.head_dim * elem
+
+        self.inv_freq = 1.0 / (cfg.rotary_embedding_base ** (
+            torch.arange(0, cfg.head_dim, 2, dtype=torch.float32) / cfg.head_dim))
+        self.inv_freq /= getattr(cfg, 'compress_pos_emb', 1.0)
+
+        self._blocks : collections.OrderedDict[int, _Block] = \
+            collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+        self.evictions = 0
+
+    @property
+    def num_bytes(self) -> int:
+        return len(self._blocks) * self.block_bytes
+
+    def stats(self) -> dict:
+        total = self.hit_tokens + self.miss_tokens
+        return {
+            'blocks': len(self._blocks),
+            'bytes': self.num_bytes,
+            'max_bytes': self.max_bytes,
+            'lookups': self.lookups,
+            'hit_tokens': self.hit_tokens,
+            'hit_rate': self.hit_tokens / total if total else 0.0,
+            'evictions': self.evictions,
+        }
+
+    def _chain(self, tokens : list):
+        """ Yield (key, parent key, block tokens) of the full blocks. """
+        parent = None
+        for i in range(len(tokens) // self.block_size):
+            block = tuple(tokens[i * self.block_size : (i + 1) * self.block_size])
+            key = hash((parent, block))
+            yield key, parent, block
+            parent = key
+
+    def lookup(self, tokens : list) -> list:
+        """ Return the cached blocks of the longest matching prefix. """
+        found = []
+        with self._lock:
+            for key, parent, block in self._chain(tokens):
+                b = self._blocks.get(key)
+                if b is None or b.parent != parent or b.tokens != block:
+                    break
+                found.append(b)
+
+            # Touch children first, so the parents are evicted last.
+            for b in reversed(found):
+                self._blocks.move_to_end(b.key)
+
+            self.lookups += 1
+            self.hit_tokens += len(found) * self.block_size
+            self.miss_tokens += len(tokens) - len(found) * self.block_size
+        return found
+
+    def _rotate_keys(self, keys, offset : int):
+        """ Rotate RoPE embedded keys [..., seq, head_dim] by offset, in place. """
+        if offset == 0:
+            return
+        freqs = offset * self.inv_freq.to(keys.device)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        k = keys.float()
+        k = k * emb.cos() + _rotate_half(k) * emb.sin()
+        keys.copy_(k.to(keys.dtype))
+
+    def restore(self, blocks : list, cache, row : int = 0,
+                position : int = 0) -> int:
+        """
+        Copy the given blocks into a row of the cache, starting at position.
+        Returns the number of tokens restored.
+        """
+        bs = self.block_size
+        for i, b in enumerate(blocks):
+            col = position + i * bs
+            b.cache.copy_states(cache, 0, bs, col, bs, 0, 1, row, 1)
+            if position != 0:
+                for k in cache.key_states:
+                    self._rotate_keys(k[row, :, col : col + bs], position)
+        return len(blocks) * bs
+
+    def store(self, tokens : list, cache, row : int = 0, position : int = 0):
+        """
+        Snapshot the full blocks of tokens, prefilled in a row of the cache
+        starting at position, that are not already cached.
+        """
+        bs = self.block_size
+        chain = list(self._chain(tokens))
+        if not chain or self.max_bytes < self.block_bytes:
+            return
+
+        with self._lock:
+            for i, (key, parent, block) in enumerate(chain):
+                if key in self._blocks:
+                    continue
+                snap = self.cache_class(self.model, batch_size=1, max_seq_len=bs)
+                cache.copy_states(snap, position + i * bs, bs, 0, bs,
+                                  row, 1, 0, 1)
+                if position != 0:
+                    for k in snap.key_states:
+                        self._rotate_keys(k[0], -position)
+                self._blocks[key] = _Block(key, parent, block, snap)
+
+            for key, _, _ in reversed(chain):
+                self._blocks.move_to_end(key)
+
+            while self.num_bytes > self.max_bytes:
+                self._blocks.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
@@ -0,0 +1,298 @@
+""" Token sampling for batched generation.
+
+    All the filters work on the sorted distribution of every row at once,
+    as masks over a [batch, vocab] tensor, so a decode step samples the whole
+    batch without a Python loop or a device sync per candidate token.
+
+    The filters and their order match ExLlamaGenerator.sample(): top_k,
+    top_p (with min_p), tfs, top_a, then locally typical sampling. Removed
+    tokens are zeroed instead of sliced off, and torch.multinomial draws the
+    same token from the zero padded distribution as from the truncated one,
+    so a single row gives the same result as before for a fixed seed.
+"""
+import torch
+import torch.nn.functional as F
+from dataclasses import dataclass, field
+
+HEAD_SIZE = 256     # candidates sorted first for top_p on CPU
+
+
+@dataclass
+class SamplingParams:
+    temperature : float = 0.5
+    top_k : int = 0                 # 0 to disable top_k sampling
+    top_p : float = 0.95            # 0.0 to disable top_p sampling
+    min_p : float = 0.0             # do not consider tokens less probable than this
+    typical : float = 0.0           # 0.0 to disable locally typical sampling
+    tfs : float = 1.0               # 1.0 to disable tail free sampling
+    top_a : float = 0.0             # 0.0 to disable top_a sampling
+    repetition_penalty : float = 1.0
+    disallowed_tokens : list = field(default_factory=list)
+
+
+def apply_repetition_penalty(logits, contexts : list, penalties : list):
+    """
+    Penalize logits [batch, vocab] of the tokens already present in each
+    row's context (list of token ids), in place.
+    """
+    for i, (ctx, penalty) in enumerate(zip(contexts, penalties)):
+        if penalty == 1.0 or not ctx:
+            continue
+        ids = torch.tensor(ctx, dtype=torch.long, device=logits.device).unique()
+        scores = logits[i, ids]
+        logits[i, ids] = torch.where(scores > 0, scores / penalty,
+                                     scores * penalty)
+    return logits
+
+
+def _rows(value, batch : int, dtype, device):
+    """ Scalar or per row value as a [batch, 1] tensor. """
+    if isinstance(value, torch.Tensor):
+        value = value.to(device=device, dtype=dtype)
+    else:
+        value = torch.tensor(value, dtype=dtype, device=device)
+    return value.reshape(-1, 1).expand(batch, 1)
+
+
+def _any(value, cond) -> bool:
+    """
+    Whether cond holds for any row of a scalar or per row value, decided on
+    the host so that disabled filters are skipped without a device sync.
+    Tensors are assumed to enable the filter.
+    """
+    if isinstance(value, torch.Tensor):
+        return True
+    if isinstance(value, (list, tuple)):
+        return any(cond(v) for v in value)
+    return cond(value)
+
+
+def _select(value, cond, batch : int, dtype, device):
+    """
+    Per row value as a [batch, 1] tensor, and the [batch, 1] bool mask of
+    the rows cond holds for, or None if it holds for all of them.
+    """
+    rows = _rows(value, batch, dtype, device)
+    if not isinstance(value, torch.Tensor) and \
+            not _any(value, lambda v: not cond(v)):
+        return rows, None
+    return rows, cond(rows)
+
+
+def _normalize(probs, rows):
+    """ L1 normalize the rows selected by the [batch, 1] bool mask. """
+    if rows is None:
+        return F.normalize(probs, p=1, dim=-1)
+    return torch.where(rows, F.normalize(probs, p=1, dim=-1), probs)
+
+
+def _filter(keep, rows, first, cond):
+    """ Keep the tokens that meet cond in the selected rows. """
+    if rows is None:
+        return keep & (first | cond)
+    return keep & (~rows | first | cond)
+
+
+def filter_probs(logits, temperature = 0.95, top_k = 0, top_p = 0.0,
+                 min_p = 0.0, typical = 0.0, tfs = 1.0, top_a = 0.0,
+                 disallowed_tokens = None):
+    """
+    Filtered sampling distribution of logits [batch, vocab].
+
+    Each parameter is a scalar or a per row sequence/tensor. A temperature
+    of 0 or less samples greedily. disallowed_tokens is a list of token ids,
+    or a list of such lists, one per row.
+
+    Returns:
+        probs [batch, width] in sampling order, zero for removed tokens,
+        the token ids [batch, width] in the same order, and a bool mask
+        [batch, width] of the kept tokens. The kept tokens come first.
+        width is at most the vocab size, and is trimmed to the largest
+        top_k, or to the tokens kept by top_p on CPU.
+    """
+    batch, vocab = logits.shape
+    device = logits.device
+    logits = logits.float()
+
+    if disallowed_tokens:
+        logits = logits.clone()
+        if isinstance(disallowed_tokens[0], (list, tuple)):
+            for i, tokens in enumerate(disallowed_tokens):
+                if tokens:
+                    logits[i, tokens] = float("-inf")
+        else:
+            logits[:, disallowed_tokens] = float("-inf")
+
+    greedy = None
+    if _any(temperature, lambda t: t <= 0):
+        temperature = _rows(temperature, batch, torch.float32, device)
+        greedy = temperature <= 0
+        temperature = torch.where(greedy, torch.ones_like(temperature),
+                                  temperature)
+    elif not isinstance(temperature, (int, float)):
+        temperature = _rows(temperature, batch, torch.float32, device)
+
+    # Top K. Only the candidates of the largest top_k are kept around.
+    # Temperature and softmax keep the order of the logits, so the
+    # candidates are picked from the logits and only they are normalized,
+    # the same distribution as top_k of the full softmax renormalized.
+    max_k = max(top_k) if isinstance(top_k, (list, tuple)) else top_k
+    if not _any(top_k, lambda k: k <= 0):
+        width = min(vocab, max_k)
+        logits, indices = torch.topk(logits, width, dim=-1)
+        probs = torch.softmax(logits / temperature, dim=-1)
+        # Rows at the largest top_k are already cut.
+        if not _any(top_k, lambda k: k < width):
+            top_k = 0
+
+    else:
+        logits = logits / temperature
+        logits += 1e-8
+        probs = torch.softmax(logits, dim=-1)
+
+        if probs.device.type == "cpu" and \
+                not _any(top_p, lambda p: p <= 0) and vocab > HEAD_SIZE:
+            # Sorting the whole vocab dominates on CPU. If the head of the
+            # distribution already holds more than top_p, no token past it
+            # can be kept, so only the head is sorted.
+            width = max(HEAD_SIZE, max_k)
+            head, head_indices = torch.topk(probs, width, dim=-1)
+            p = _rows(top_p, batch, torch.float64, device)
+            if bool((head.double().sum(dim=-1, keepdim=True) > p).all()):
+                probs, indices = head, head_indices
+            else:
+                width = vocab
+                probs, indices = torch.sort(probs, dim=-1, descending=True)
+
+        else:
+            width = vocab
+            probs, indices = torch.sort(probs, dim=-1, descending=True)
+
+    rank = torch.arange(width, device=device).unsqueeze(0)
+    first = rank == 0
+    keep = torch.ones_like(probs, dtype=torch.bool)
+    if greedy is not None:
+        keep &= ~greedy | first
+
+    if _any(top_k, lambda k: k > 0):
+        top_k, rows = _select(top_k, lambda k: k > 0, batch, torch.long, device)
+        keep = _filter(keep, rows, first, rank < top_k)
+        probs = _normalize(probs * keep, rows)
+
+    # Top P, min P. Cumulative sums in double, like the scalar loop.
+    if _any(top_p, lambda p: p > 0):
+        top_p, rows = _select(top_p, lambda p: p > 0, batch, torch.float64,
+                              device)
+        cum = probs.double().cumsum(dim=-1)
+        cond = cum <= top_p
+        if _any(min_p, lambda m: m > 0):
+            cond &= probs >= _rows(min_p, batch, torch.float32, device)
+        keep = _filter(keep, rows, first, cond)
+        probs = _normalize(probs * keep, rows)
+
+        # Reading the count back is free on CPU, and the remaining filters
+        # and the multinomial draw then only see the kept head.
+        if probs.device.type == "cpu":
+            width = max(1, int(keep.sum(dim=-1).max()))
+            probs, indices, keep = \
+                probs[:, :width], indices[:, :width], keep[:, :width]
+            rank, first = rank[:, :width], first[:, :width]
+
+    # Tail free sampling
+    if _any(tfs, lambda z: z < 1.0) and width > 2:
+        tfs, rows = _select(tfs, lambda z: z < 1.0, batch, torch.float32,
+                            device)
+        d1 = probs[:, :-1] - probs[:, 1:]
+        d2 = (d1[:, :-1] - d1[:, 1:]).abs()
+        d2 = d2 / d2.sum(dim=-1, keepdim=True).clamp_min(1e-10)
+        tail = torch.cat((first[:, :1].expand(batch, 1),
+                          d2.cumsum(dim=-1) <= tfs,
+                          ~first[:, :1].expand(batch, 1)), dim=-1)
+        keep = _filter(keep, rows, first, tail)
+        probs = _normalize(probs * keep, rows)
+
+    # Top A
+    if _any(top_a, lambda a: a > 0):
+        top_a, rows = _select(top_a, lambda a: a > 0, batch, torch.float32,
+                              device)
+        keep = _filter(keep, rows, first, probs >= top_a * probs[:, :1] ** 2)
+        probs = _normalize(probs * keep, rows)
+
+    # Locally typical sampling
+    if _any(typical, lambda t: t > 0):
+        typical, rows = _select(typical, lambda t: t > 0, batch,
+                                torch.float64, device)
+        log_probs = (probs + 1e-10).log()
+        neg_entropy = (probs * log_probs).sum(dim=-1, keepdim=True)
+        entropy_dev = (neg_entropy - log_probs).abs()
+        entropy_dev = entropy_dev.masked_fill(~keep, float("inf"))
+        if rows is not None:
+            entropy_dev = torch.where(rows, entropy_dev, rank.float())
+        _, order = torch.sort(entropy_dev, dim=-1)
+
+        probs = probs.gather(-1, order)
+        indices = indices.gather(-1, order)
+        keep = keep.gather(-1, order)
+
+        cum = probs.double().cumsum(dim=-1)
+        keep = _filter(keep, rows, first, cum <= typical)
+        probs = _normalize(probs * keep, rows)
+
+    if greedy is not None:
+        probs = _normalize(probs * keep, greedy)
+    return probs, indices, keep
+
+
+def sample_batch(logits, temperature = 0.95, top_k = 0, top_p = 0.0,
+                 min_p = 0.0, typical = 0.0, tfs = 1.0, top_a = 0.0,
+                 disallowed_tokens = None, num = 1, generator = None):
+    """
+    Sample from logits [batch, vocab] with the filters of filter_probs().
+
+    Returns the sampled token ids and their probabilities, [batch, num].
+    num = -1 samples all the kept tokens. More than one sample is drawn
+    without replacement and sorted by token id, one row at a time.
+    """
+    probs, indices, keep = filter_probs(logits, temperature, top_k, top_p,
+                                        min_p, typical, tfs, top_a,
+                                        disallowed_tokens)
+    if num == 1:
+        ind = torch.multinomial(probs, 1, generator=generator)
+        return indices.gather(-1, ind), probs.gather(-1, ind)
+
+    if probs.shape[0] != 1:
+        raise ValueError("multiple samples are drawn for a single row")
+
+    n = int(keep.sum())
+    probs, indices = probs[0, :n], indices[0, :n]
+    ind = torch.multinomial(probs, n if num == -1 else min(num, n),
+                            generator=generator)
+    tokens, probs = indices[ind], probs[ind]
+    if tokens.shape[0] > 1:
+        tokens, ind = tokens.sort()
+        probs = probs[ind]
+    return tokens.unsqueeze(0), probs.unsqueeze(0)
+
+
+def sample(logits, params : list, contexts : list = None, generator = None):
+    """
+    Sample one token per row from logits [batch, vocab], using the
+    SamplingParams of each row. Returns a LongTensor [batch].
+    """
+    logits = logits.float().clone()
+    if contexts is not None:
+        apply_repetition_penalty(logits, contexts,
+                                 [p.repetition_penalty for p in params])
+
+    tokens, _ = sample_batch(
+        logits,
+        temperature = [p.temperature for p in params],
+        top_k = [p.top_k for p in params],
+        top_p = [p.top_p for p in params],
+        min_p = [p.min_p for p in params],
+        typical = [p.typical for p in params],
+        tfs = [p.tfs for p in params],
+        top_a = [p.top_a for p in params],
+        disallowed_tokens = [p.disallowed_tokens for p in params],
+        generator = generator)
+    return tokens.view(-1)
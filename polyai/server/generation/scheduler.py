@@ -0,0 +1,494 @@
+""" Continuous batching scheduler for the LLM.
+
+    The scheduler owns a batched key/value cache and decodes one token for
+    every active sequence per forward pass. New sequences are admitted into
+    free batch rows between decode steps, and finished rows are retired
+    immediately, so the batch is refilled without waiting for the longest
+    running sequence.
+
+    All rows share the cache position (cache.current_seq_len). A new prompt
+    is prefilled right-aligned to the current position and the positions
+    before it are masked out with the input mask. RoPE is relative, so the
+    offset does not change the attention scores. When the cache window is
+    exhausted, the remaining rows are drained and the window starts over.
+
+    The model is not safe to call from two threads, so other work on it,
+    e.g. embeddings, is handed to the scheduler thread with call() and runs
+    between two decode steps.
+
+    Works with ExLlama + ExLlamaCache on GPU, or TorchLlama + TorchLlamaCache
+    on CPU.
+
+    PagedBatchScheduler keeps the sequences in a PagedCache instead, each at
+    its own length, so there is no shared window to drain and a sequence
+    only takes the blocks of its prompt and max_new_tokens. It needs the
+    model to have forward_paged(), i.e. TorchLlama for now.
+"""
+import time
+import queue
+import threading
+import collections
+
+import torch
+import pylogg
+
+from polyai.server.generation import sampling
+
+log = pylogg.New("batch")
+
+
+class _Job:
+    """ A function to run on the scheduler thread. """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error : Exception = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn()
+        except Exception as err:
+            self.error = err
+        self.done.set()
+
+
+class SequenceRequest:
+    """ A single sequence submitted to the scheduler. """
+
+    def __init__(self, prompt_ids : list, max_new_tokens : int,
+                 params : sampling.SamplingParams, stop_token_ids = ()):
+        self.prompt_ids = list(prompt_ids)
+        self.max_new_tokens = max_new_tokens
+        self.params = params
+        self.stop_token_ids = set(stop_token_ids)
+
+        self.generated : list[int] = []
+        self.finish_reason : str = None
+        self.error : Exception = None
+        self.row : int = None
+        self.submitted = time.time()
+        self.first_token_time : float = None
+
+        self._next_token = self.prompt_ids[-1]
+        self._cancelled = False
+        self._queue = queue.Queue()
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self):
+        """ Ask the scheduler to retire this sequence at the next step. """
+        self._cancelled = True
+
+    def tokens(self):
+        """ Yield the generated token ids as they are produced. """
+        while True:
+            tok = self._queue.get()
+            if tok is None:
+                break
+            yield tok
+        if self.error is not None:
+            raise self.error
+
+    def result(self, timeout = None) -> list:
+        """ Wait for the sequence to finish and return the generated ids. """
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.generated
+
+    def _accept(self, token : int):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.generated.append(token)
+        self._next_token = token
+        self._queue.put(token)
+
+    def _finish(self, reason : str, error : Exception = None):
+        self.finish_reason = reason
+        self.error = error
+        self._queue.put(None)
+        self._done.set()
+
+
+class BatchScheduler:
+    """
+    In-process continuous batching over a batched cache.
+
+    Args:
+        model:      ExLlama or TorchLlama instance.
+        cache:      Batched cache of the model, one row per sequence slot.
+        eos_token_id:   Token id that ends a sequence.
+        pad_token_id:   Token id fed into idle rows.
+        prefix_cache:   Optional PrefixCache to reuse prompt prefixes.
+    """
+
+    def __init__(self, model, cache, eos_token_id : int,
+                 pad_token_id : int = 0, lora = None, prefix_cache = None):
+        self.model = model
+        self.cache = cache
+        self.lora = lora
+        self.prefix_cache = prefix_cache
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self._init_rows()
+
+        self._active : dict[int, SequenceRequest] = {}
+        self._waiting = collections.deque()
+        self._jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._shutdown = False
+
+        self.generator = None       # torch.Generator for sampling
+        self.total_steps = 0
+        self.total_tokens = 0
+        self.busy_time = 0.0
+
+    def _init_rows(self):
+        self.batch_size = self.cache.batch_size
+        self.max_seq_len = self.cache.max_seq_len
+
+        # Single row cache to prefill new prompts into.
+        self._prefill_cache = self.cache.__class__(
+            self.model, batch_size=1, max_seq_len=self.max_seq_len)
+
+        # Positions each row is allowed to attend to.
+        self._mask = torch.ones((self.batch_size, self.max_seq_len),
+                                dtype=torch.bool)
+
+    def submit(self, prompt_ids : list, max_new_tokens : int,
+               params : sampling.SamplingParams = None,
+               stop_token_ids = ()) -> SequenceRequest:
+        """ Queue a new sequence. Returns the request handle. """
+        prompt_ids = list(prompt_ids)
+        if len(prompt_ids) == 0:
+            raise ValueError("empty prompt")
+        if len(prompt_ids) >= self.max_seq_len:
+            raise ValueError("prompt longer than max sequence length")
+
+        max_new_tokens = min(max_new_tokens,
+                             self.max_seq_len - len(prompt_ids) + 1)
+        params = params or sampling.SamplingParams()
+        req = SequenceRequest(prompt_ids, max_new_tokens, params,
+                              stop_token_ids)
+        with self._cond:
+            self._waiting.append(req)
+            self._cond.notify()
+        return req
+
+    def call(self, fn):
+        """
+        Run fn() on the scheduler thread between two steps, and return its
+        result. Runs it right away if the scheduler is not started.
+        """
+        job = _Job(fn)
+        with self._cond:
+            if self._thread is None:
+                job.run()
+            else:
+                self._jobs.append(job)
+                self._cond.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run_jobs(self):
+        while self._jobs:
+            self._jobs.popleft().run()
+
+    def num_active(self) -> int:
+        return len(self._active)
+
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    def stats(self) -> dict:
+        return {
+            'active': self.num_active(),
+            'waiting': self.num_waiting(),
+            'batch_size': self.batch_size,
+            'steps': self.total_steps,
+            'tokens': self.total_tokens,
+            'tokens_per_sec': self.total_tokens / self.busy_time \
+                                if self.busy_time > 0 else 0.0,
+        }
+
+    def _free_rows(self) -> list:
+        return [r for r in range(self.batch_size) if r not in self._active]
+
+    def _fits(self, req : SequenceRequest, window : int) -> bool:
+        prefix = len(req.prompt_ids) - 1
+        return prefix <= window and \
+               window + req.max_new_tokens <= self.max_seq_len
+
+    def _admit(self):
+        """ Move waiting sequences into free rows, in arrival order. """
+        with self._cond:
+            if not self._waiting:
+                return
+
+            free = self._free_rows()
+            admitted = []
+
+            if not self._active:
+                # Start a new window, aligned to the longest prompt.
+                window = 0
+                while self._waiting and len(admitted) < len(free):
+                    req = self._waiting[0]
+                    w = max(window, len(req.prompt_ids) - 1)
+                    if not all(self._fits(r, w) for r in admitted + [req]):
+                        break
+                    window = w
+                    admitted.append(self._waiting.popleft())
+                self.cache.current_seq_len = window
+
+            else:
+                window = self.cache.current_seq_len
+                while self._waiting and len(admitted) < len(free):
+                    if not self._fits(self._waiting[0], window):
+                        break
+                    admitted.append(self._waiting.popleft())
+
+        for row, req in zip(free, admitted):
+            try:
+                self._prefill(row, req)
+            except Exception as err:
+                log.error("Prefill failed: {}", err)
+                req._finish("error", err)
+                continue
+            req.row = row
+            self._active[row] = req
+
+    def _prefill(self, row : int, req : SequenceRequest):
+        window = self.cache.current_seq_len
+        prefix = req.prompt_ids[:-1]
+        start = window - len(prefix)
+
+        self._mask[row].fill_(False)
+        self._mask[row, start:] = True
+
+        if not prefix:
+            return
+
+        # Reuse the cached blocks of a matching prompt prefix.
+        reuse = 0
+        if self.prefix_cache is not None:
+            blocks = self.prefix_cache.lookup(prefix)
+            reuse = self.prefix_cache.restore(blocks, self._prefill_cache,
+                                              position=start)
+
+        self._prefill_cache.current_seq_len = start + reuse
+        if reuse < len(prefix):
+            mask = torch.zeros((1, self.max_seq_len), dtype=torch.bool)
+            mask[0, start:] = True
+            ids = torch.tensor([prefix[reuse:]], dtype=torch.long)
+            self.model.forward(ids, self._prefill_cache, preprocess_only=True,
+                               lora=self.lora, input_mask=mask)
+            if self.prefix_cache is not None:
+                self.prefix_cache.store(prefix, self._prefill_cache,
+                                        position=start)
+
+        self._prefill_cache.copy_states(self.cache, start, len(prefix),
+                                        start, len(prefix), 0, 1, row, 1)
+
+    def _retire(self, row : int, reason : str, error : Exception = None):
+        req = self._active.pop(row)
+        req._finish(reason, error)
+
+    def step(self) -> int:
+        """
+        Admit waiting sequences, then decode one token for all active rows.
+        Returns the number of tokens generated.
+        """
+        for row in [r for r, q in self._active.items() if q._cancelled]:
+            self._retire(row, "cancelled")
+
+        self._run_jobs()
+        self._admit()
+        if not self._active:
+            return 0
+
+        t0 = time.time()
+        rows = sorted(self._active)
+        logits = self._forward(rows)
+
+        reqs = [self._active[r] for r in rows]
+        tokens = sampling.sample(logits, [q.params for q in reqs],
+                                 [q.prompt_ids + q.generated for q in reqs],
+                                 generator=self.generator)
+
+        window_full = self._window_full()
+        for row, req, tok in zip(rows, reqs, tokens.tolist()):
+            req._accept(tok)
+            if tok == self.eos_token_id or tok in req.stop_token_ids:
+                self._retire(row, "stop")
+            elif len(req.generated) >= req.max_new_tokens or window_full:
+                self._retire(row, "length")
+
+        self.total_steps += 1
+        self.total_tokens += len(rows)
+        self.busy_time += time.time() - t0
+        return len(rows)
+
+    def _forward(self, rows : list):
+        """ Logits [rows, vocab] of the next token of the active rows. """
+        hi = rows[-1] + 1
+        ids = torch.full((hi, 1), self.pad_token_id, dtype=torch.long)
+        for row in rows:
+            ids[row, 0] = self._active[row]._next_token
+
+        logits = self.model.forward(ids, self.cache, lora=self.lora,
+                                    input_mask=self._mask[:hi])
+        return logits[rows, -1, :]
+
+    def _window_full(self) -> bool:
+        return self.cache.current_seq_len >= self.max_seq_len
+
+    def run_until_idle(self):
+        """ Step until there is nothing left to generate. """
+        while self._active or self._waiting:
+            self.step()
+
+    def _fail_all(self, err : Exception):
+        for row in list(self._active):
+            self._retire(row, "error", err)
+        self.cache.current_seq_len = 0
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not self._jobs and \
+                        not self._active and not self._waiting:
+                    self._cond.wait()
+                if self._shutdown:
+                    break
+            try:
+                self.step()
+            except Exception as err:
+                log.error("Batch step failed: {}", err)
+                self._fail_all(err)
+
+    def start(self):
+        """ Run the scheduler in a background thread. """
+        if self._thread is not None:
+            return
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        log.info("Batch scheduler started with {} rows.", self.batch_size)
+
+    def stop(self):
+        """ Stop the background thread, cancelling any running sequence. """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        while self._waiting:
+            self._waiting.popleft()._finish("cancelled")
+        self._run_jobs()
+        for row in list(self._active):
+            self._retire(row, "cancelled")
+
+
+class PagedBatchScheduler(BatchScheduler):
+    """
+    Continuous batching over a PagedCache, one sequence per row.
+
+    Args:
+        model:      Model with forward_paged(), e.g. TorchLlama.
+        cache:      PagedCache of the model.
+        batch_size: Max number of sequences decoded together.
+        eos_token_id:   Token id that ends a sequence.
+        pad_token_id:   Unused, rows are not padded.
+
+    A sequence is admitted when the blocks of its prompt and max_new_tokens
+    are free, so the running ones never run out of blocks.
+    """
+
+    def __init__(self, model, cache, batch_size : int, eos_token_id : int,
+                 pad_token_id : int = 0, lora = None):
+        self._batch_size = batch_size
+        self._reserved : dict[int, int] = {}    # blocks promised per row
+        super().__init__(model, cache, eos_token_id, pad_token_id, lora)
+
+    def _init_rows(self):
+        self.batch_size = self._batch_size
+        self.max_seq_len = self.model.config.max_seq_len
+
+    def _blocks(self, req : SequenceRequest) -> int:
+        tokens = len(req.prompt_ids) - 1 + req.max_new_tokens
+        return -(-tokens // self.cache.block_size)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['cache'] = self.cache.utilization()
+        return stats
+
+    def _admit(self):
+        """ Move waiting sequences into free rows while their blocks fit. """
+        with self._cond:
+            free = self._free_rows()
+            admitted = []
+            reserved = sum(self._reserved.values())
+            while self._waiting and len(admitted) < len(free):
+                need = self._blocks(self._waiting[0])
+                if need > self.cache.num_blocks:
+                    req = self._waiting.popleft()
+                    req._finish("error", ValueError(
+                        "sequence longer than the paged cache"))
+                    continue
+                if reserved + need > self.cache.num_blocks:
+                    break
+                reserved += need
+                admitted.append(self._waiting.popleft())
+
+        for row, req in zip(free, admitted):
+            self._reserved[row] = self._blocks(req)
+            try:
+                self._prefill(row, req)
+            except Exception as err:
+                log.error("Prefill failed: {}", err)
+                self._release(row)
+                req._finish("error", err)
+                continue
+            req.row = row
+            self._active[row] = req
+
+    def _prefill(self, row : int, req : SequenceRequest):
+        self.cache.add_sequence(row)
+        prefix = req.prompt_ids[:-1]
+        if prefix:
+            ids = torch.tensor([prefix], dtype=torch.long)
+            self.model.forward_paged(ids, self.cache, [row],
+                                     preprocess_only=True)
+
+    def _release(self, row : int):
+        self._reserved.pop(row, None)
+        try:
+            self.cache.free_sequence(row)
+        except KeyError:
+            pass
+
+    def _retire(self, row : int, reason : str, error : Exception = None):
+        self._release(row)
+        super()._retire(row, reason, error)
+
+    def _forward(self, rows : list):
+        ids = torch.tensor([[self._active[row]._next_token] for row in rows],
+                           dtype=torch.long)
+        return self.model.forward_paged(ids, self.cache, rows)[:, -1, :]
+
+    def _window_full(self) -> bool:
+        return False
+
+    def _fail_all(self, err : Exception):
+        for row in list(self._active):
+            self._retire(row, "error", err)
@@ -0,0 +1,186 @@
+""" Speculative decoding with a small draft model.
+
+    The draft model proposes num_draft_tokens tokens, one at a time. The
+    main model then scores all of them in a single forward pass
+    (last_id_only=False), which costs about the same as decoding one token
+    when the model is memory bound.
+
+    Draft token i is accepted with probability min(1, p_i / q_i), where p
+    and q are the main and draft probabilities after the sampling filters.
+    At the first rejection, a token is sampled from the normalized residual
+    max(0, p - q) instead, the rest of the draft is dropped and the cache is
+    rewound. If every draft token is accepted, a bonus token is sampled from
+    the last position of the main model. Either way the output follows the
+    distribution of the main model exactly.
+
+    Works with ExLlama + ExLlamaCache on GPU, or TorchLlama + TorchLlamaCache
+    on CPU. The two models must share the tokenizer.
+"""
+import time
+
+import torch
+import pylogg
+
+from polyai.server.generation import sampling
+
+log = pylogg.New("spec")
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding of a single sequence.
+
+    Args:
+        model, cache:               Main model and its cache.
+        draft_model, draft_cache:   Draft model and its cache.
+        num_draft_tokens:           Tokens proposed per step.
+
+    Like ExLlamaGenerator, the cache holds all but the last token of the
+    sequence between steps.
+    """
+
+    def __init__(self, model, cache, draft_model, draft_cache,
+                 num_draft_tokens : int = 4, lora = None):
+        if model.config.vocab_size != draft_model.config.vocab_size:
+            raise ValueError("draft model vocab size does not match")
+
+        self.model = model
+        self.cache = cache
+        self.draft_model = draft_model
+        self.draft_cache = draft_cache
+        self.num_draft_tokens = num_draft_tokens
+        self.lora = lora
+
+        self.sequence : torch.Tensor = None
+        self.generator = None       # torch.Generator for sampling
+
+        self.total_steps = 0
+        self.total_proposed = 0
+        self.total_accepted = 0
+        self.total_tokens = 0
+        self.busy_time = 0.0
+
+    def stats(self) -> dict:
+        return {
+            'draft_tokens': self.num_draft_tokens,
+            'steps': self.total_steps,
+            'proposed': self.total_proposed,
+            'accepted': self.total_accepted,
+            'acceptance_rate': self.total_accepted / self.total_proposed \
+                                if self.total_proposed else 0.0,
+            'tokens_per_step': self.total_tokens / self.total_steps \
+                                if self.total_steps else 0.0,
+            'tokens_per_sec': self.total_tokens / self.busy_time \
+                                if self.busy_time > 0 else 0.0,
+        }
+
+    def begin(self, prompt_ids):
+        """ Start a new sequence, prefilling both caches with the prompt. """
+        if not isinstance(prompt_ids, torch.Tensor):
+            prompt_ids = torch.tensor([list(prompt_ids)], dtype=torch.long)
+        self.sequence = prompt_ids.clone()
+        self.cache.current_seq_len = 0
+        self.draft_cache.current_seq_len = 0
+
+        if self.sequence.shape[-1] > 1:
+            self.model.forward(self.sequence[:, :-1], self.cache,
+                               preprocess_only=True, lora=self.lora)
+            self.draft_model.forward(self.sequence[:, :-1], self.draft_cache,
+                                     preprocess_only=True)
+
+    def gen_rewind(self, num_tokens : int):
+        """ Drop the last num_tokens of the sequence and the caches. """
+        if num_tokens == 0:
+            return
+        self.sequence = self.sequence[:, :-num_tokens]
+        self.cache.current_seq_len -= num_tokens
+        self.draft_cache.current_seq_len = min(self.draft_cache.current_seq_len,
+                                               self.sequence.shape[-1] - 1)
+
+    def _probs(self, logits, params : sampling.SamplingParams, contexts : list):
+        """ Filtered probabilities [rows, vocab] of logits [rows, vocab]. """
+        logits = logits.float().clone()
+        sampling.apply_repetition_penalty(
+            logits, contexts, [params.repetition_penalty] * len(contexts))
+        probs, indices, _ = sampling.filter_probs(
+            logits, params.temperature, params.top_k, params.top_p,
+            params.min_p, params.typical, params.tfs, params.top_a,
+            params.disallowed_tokens)
+        return torch.zeros_like(logits).scatter_(-1, indices, probs)
+
+    def step(self, params : sampling.SamplingParams) -> list:
+        """
+        Propose, verify and accept tokens. Returns the new token ids, at
+        least one unless the cache is full.
+        """
+        t0 = time.time()
+        n = self.sequence.shape[-1]
+        k = min(self.num_draft_tokens, self.cache.max_seq_len - n,
+                self.draft_cache.max_seq_len - n)
+        if k < 0:
+            return []
+        context = self.sequence[0].tolist()
+
+        # Draft k tokens, feeding what the draft cache has not seen yet.
+        drafts = []
+        draft_probs = []
+        ids = self.sequence[:, self.draft_cache.current_seq_len:]
+        for _ in range(k):
+            logits = self.draft_model.forward(ids, self.draft_cache)
+            q = self._probs(logits[:, -1, :], params, [context + drafts])
+            ids = torch.multinomial(q, 1, generator=self.generator)
+            drafts.append(ids.item())
+            draft_probs.append(q)
+
+        # Score the last token and all the drafts in one pass.
+        verify = torch.tensor([context[-1:] + drafts], dtype=torch.long)
+        logits = self.model.forward(verify, self.cache, last_id_only=False,
+                                    lora=self.lora)
+        p = self._probs(logits[0], params,
+                        [context + drafts[:i] for i in range(k + 1)])
+
+        # Accept each draft with probability min(1, p/q), up to the first
+        # rejection.
+        accepted = 0
+        if k > 0:
+            d = torch.tensor(drafts, dtype=torch.long)
+            rows = torch.arange(k)
+            q = torch.cat(draft_probs)
+            p_d, q_d = p[rows, d], q[rows, d]
+            r = torch.rand(k, generator=self.generator)
+            accepted = int((r * q_d <= p_d).long().cumprod(0).sum())
+
+            self.sequence = torch.cat((self.sequence, d.unsqueeze(0)), dim=1)
+            self.gen_rewind(k - accepted)
+
+        if accepted < k:
+            residual = (p[accepted] - q[accepted]).clamp_min(0)
+            if residual.sum() <= 0:
+                residual = p[accepted]
+            probs = residual
+        else:
+            probs = p[k]
+        token = torch.multinomial(probs / probs.sum(), 1,
+                                  generator=self.generator)
+        self.sequence = torch.cat((self.sequence, token.view(1, 1)), dim=1)
+
+        self.total_steps += 1
+        self.total_proposed += k
+        self.total_accepted += accepted
+        self.total_tokens += accepted + 1
+        self.busy_time += time.time() - t0
+        return drafts[:accepted] + [token.item()]
+
+    def tokens(self, prompt_ids, max_new_tokens : int,
+               params : sampling.SamplingParams = None):
+        """ Generate up to max_new_tokens, yielding the token ids. """
+        params = params or sampling.SamplingParams()
+        self.begin(prompt_ids)
+        count = 0
+        while count < max_new_tokens:
+            new = self.step(params)
+            if not new:
+                break
+            for token in new[:max_new_tokens - count]:
+                yield token
+            count += len(new)
@@ -0,0 +1,191 @@
+""" Stop sequence matching for streamed generation.
+
+    The stop strings of a request are compiled once into an Aho-Corasick
+    automaton, matched case insensitively. A StopState walks the automaton
+    over the new characters of each step only, so checking is O(new chars)
+    per token no matter how many stop strings there are. The state also
+    tells how much of the tail of the text may be the start of a stop
+    string, which is held back from the client until it is resolved.
+
+    Stop sequences of token ids are matched the same way over the sampled
+    tokens. The text of the tokens that may be the start of a stop sequence
+    is held back as well, one packet per token.
+"""
+import collections
+
+
+def _fold(c : str) -> str:
+    """ Lower case a character, keeping it one character long. """
+    low = c.lower()
+    return low if len(low) == 1 else c
+
+
+class _Automaton:
+    """ Aho-Corasick automaton over sequences of hashable symbols. """
+
+    def __init__(self, patterns : list):
+        self.goto : list[dict] = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match = [-1]       # index of the first pattern ending here
+
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for symbol in pattern:
+                nxt = self.goto[node].get(symbol)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[node] + 1)
+                    self.match.append(-1)
+                    self.goto[node][symbol] = nxt
+                node = nxt
+            if self.match[node] < 0:
+                self.match[node] = index
+
+        # Breadth first, so the fail node of a node is finished before it.
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for symbol, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and symbol not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(symbol, 0)
+
+                # Patterns ending at the fail node also end here.
+                inherited = self.match[self.fail[child]]
+                if inherited >= 0 and \
+                        (self.match[child] < 0 or inherited < self.match[child]):
+                    self.match[child] = inherited
+                queue.append(child)
+
+    def step(self, node : int, symbol) -> int:
+        while node and symbol not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(symbol, 0)
+
+
+class StopMatcher:
+    """
+    Compiled set of stop strings and stop token sequences.
+
+    Args:
+        strings:            Stop strings, matched case insensitively.
+        token_sequences:    Stop sequences of token ids.
+        token_lengths:      Optional number of tokens each stop string
+                            takes, see rewind().
+
+    When several patterns end at the same position, the one given first
+    is reported.
+    """
+
+    def __init__(self, strings = (), token_sequences = (),
+                 token_lengths = None):
+        pairs = [(s, n) for s, n in zip(
+            strings, token_lengths or [0] * len(strings)) if s]
+        self.strings = tuple(s for s, _ in pairs)
+        self._lengths = {}
+        for s, n in pairs:
+            self._lengths.setdefault(s, n)
+
+        self.token_sequences = tuple(tuple(seq) for seq in token_sequences
+                                     if len(seq) > 0)
+        self._text = _Automaton([[_fold(c) for c in s] for s in self.strings])
+        self._tokens = _Automaton(self.token_sequences)
+
+    def __len__(self):
+        return len(self.strings) + len(self.token_sequences)
+
+    def rewind(self, stop : str) -> int:
+        """ Number of tokens to rewind the generator by for a stop string. """
+        return self._lengths.get(stop, 0)
+
+    def stream(self) -> "StopState":
+        """ New matching state for a generated sequence. """
+        return StopState(self)
+
+
+class StopState:
+    """ Streaming state of a StopMatcher over one generated sequence. """
+
+    def __init__(self, matcher : StopMatcher):
+        self.matcher = matcher
+        self.held = ""          # text that may be the start of a stop string
+        self._node = 0
+        self._token_node = 0
+        self._pending = collections.deque()   # text of the last tokens
+
+    def feed(self, text : str):
+        """
+        Advance over newly generated text.
+
+        Returns the text that is safe to stream, and the stop string that
+        matched or None. On a match, the returned text ends right before the
+        stop string and the rest is dropped.
+
+        With feed_token(), call once per token after it, so the text of the
+        tokens that may start a stop sequence is held back.
+        """
+        auto = self.matcher._text
+        buf = self.held + text
+        base = len(self.held)
+        node = self._node
+
+        for i, c in enumerate(text):
+            node = auto.step(node, _fold(c))
+            k = auto.match[node]
+            if k >= 0:
+                stop = self.matcher.strings[k]
+                self._node = 0
+                self.held = ""
+                safe = buf[:max(0, base + i + 1 - len(stop))]
+                return self._release() + safe, stop
+
+        self._node = node
+        keep = min(auto.depth[node], len(buf))
+        self.held = buf[len(buf) - keep:]
+
+        # Hold the text of the tokens of a partial stop sequence.
+        self._pending.append(buf[:len(buf) - keep])
+        keep = self.matcher._tokens.depth[self._token_node]
+        packet = ""
+        while len(self._pending) > keep:
+            packet += self._pending.popleft()
+        return packet, None
+
+    def finish(self, text : str = ""):
+        """
+        End of the sequence without a stop token sequence. Feeds the last
+        text, e.g. flushed from the decoder, and releases the held text.
+
+        Returns the rest of the text to stream, and the stop string that
+        matched in it or None.
+        """
+        packet, stop = self.feed(text)
+        if stop is None:
+            packet += self._release() + self.held
+            self.held = ""
+            self._node = 0
+        self._token_node = 0
+        return packet, stop
+
+    def _release(self) -> str:
+        """ Text of the tokens held back for the stop sequences. """
+        packet = "".join(self._pending)
+        self._pending.clear()
+        return packet
+
+    def feed_token(self, token : int):
+        """ Advance over a sampled token id. Returns the matched stop
+            token sequence or None. """
+        auto = self.matcher._tokens
+        self._token_node = auto.step(self._token_node, token)
+        k = auto.match[self._token_node]
+        if k >= 0:
+            # The text of the sequence is not sent.
+            self._token_node = 0
+            self._pending.clear()
+            return self.matcher.token_sequences[k]
+        return None
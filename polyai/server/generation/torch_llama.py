@@ -0,0 +1,319 @@
+""" Pure PyTorch Llama model with the same forward/cache interface as ExLlama.
+
+    Used as the CPU path of the generation components, e.g. to test the
+    batch scheduler with a tiny randomly initialized model without CUDA.
+"""
+import math
+import torch
+import torch.nn.functional as F
+
+
+class TorchLlamaConfig:
+    def __init__(self, vocab_size = 256, hidden_size = 64,
+                 intermediate_size = 172, num_attention_heads = 4,
+                 num_key_value_heads = None, num_hidden_layers = 2,
+                 max_seq_len = 512, rms_norm_eps = 1e-6,
+                 rotary_embedding_base = 10000.0, initializer_range = 0.02,
+                 dtype = torch.float32, device = "cpu"):
+
+        self.bos_token_id = 1
+        self.eos_token_id = 2
+        self.pad_token_id = 0
+
+        self.vocab_size = vocab_size
+        self.hidden_size = hidden_size
+        self.intermediate_size = intermediate_size
+        self.num_attention_heads = num_attention_heads
+        self.num_key_value_heads = num_key_value_heads or num_attention_heads
+        self.num_key_value_groups = \
+            self.num_attention_heads // self.num_key_value_heads
+        self.num_hidden_layers = num_hidden_layers
+        self.head_dim = self.hidden_size // self.num_attention_heads
+        self.max_seq_len = max_seq_len
+        self.rms_norm_eps = rms_norm_eps
+        self.rotary_embedding_base = rotary_embedding_base
+        self.initializer_range = initializer_range
+        self.dtype = dtype
+        self.device = device
+
+
+class TorchLlamaCache:
+    """ Preallocated key/value cache, compatible with ExLlamaCache. """
+
+    def __init__(self, model, batch_size = 1, max_seq_len = -1,
+                 copy_from = None):
+        self.model = model
+        self.config = model.config
+        self.max_seq_len = max_seq_len if max_seq_len != -1 \
+                            else self.config.max_seq_len
+        self.batch_size = batch_size
+        self.current_seq_len = 0
+
+        self.key_states = []
+        self.value_states = []
+
+        shape = (self.batch_size, self.config.num_key_value_heads,
+                 self.max_seq_len, self.config.head_dim)
+
+        for i in range(self.config.num_hidden_layers):
+            if copy_from is None:
+                k = torch.zeros(shape, dtype=self.config.dtype,
+                                device=self.config.device)
+                v = torch.zeros(shape, dtype=self.config.dtype,
+                                device=self.config.device)
+            else:
+                k = copy_from.key_states[i].clone()
+                v = copy_from.value_states[i].clone()
+            self.key_states.append(k)
+            self.value_states.append(v)
+
+    def zero(self):
+        for i in range(self.config.num_hidden_layers):
+            self.key_states[i].zero_()
+            self.value_states[i].zero_()
+
+    def clone(self):
+        new = TorchLlamaCache(self.model, batch_size=self.batch_size,
+                              max_seq_len=self.max_seq_len, copy_from=self)
+        new.current_seq_len = self.current_seq_len
+        return new
+
+    def roll_left(self):
+        for i in range(self.config.num_hidden_layers):
+            self.key_states[i] = torch.roll(self.key_states[i], -1, dims=2)
+            self.value_states[i] = torch.roll(self.value_states[i], -1, dims=2)
+        self.current_seq_len -= 1
+
+    def copy_states(self, target, from_column, from_columns, to_column,
+                    to_columns, from_row, from_rows, to_row, to_rows):
+        assert from_rows == 1
+        assert from_columns == to_columns
+        assert to_column + to_columns <= target.max_seq_len
+        assert from_column + from_columns <= self.max_seq_len
+
+        for i in range(self.config.num_hidden_layers):
+            src_k = self.key_states[i].narrow(0, from_row, from_rows) \
+                        .narrow(2, from_column, from_columns)
+            src_v = self.value_states[i].narrow(0, from_row, from_rows) \
+                        .narrow(2, from_column, from_columns)
+            dst_k = target.key_states[i].narrow(0, to_row, to_rows) \
+                        .narrow(2, to_column, to_columns)
+            dst_v = target.value_states[i].narrow(0, to_row, to_rows) \
+                        .narrow(2, to_column, to_columns)
+            dst_k.copy_(src_k.expand_as(dst_k))
+            dst_v.copy_(src_v.expand_as(dst_v))
+
+
+def _rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def _rms_norm(x, weight, eps):
+    variance = x.pow(2).mean(-1, keepdim=True)
+    return x * torch.rsqrt(variance + eps) * weight
+
+
+class TorchLlama:
+    """
+    Minimal Llama decoder in plain PyTorch.
+
+    The forward() signature and the returned logits follow ExLlama.forward,
+    so anything written against ExLlama + ExLlamaCache can run on CPU with
+    this model and TorchLlamaCache.
+    """
+
+    def __init__(self, config : TorchLlamaConfig, seed : int = 0):
+        self.config = config
+        gen = torch.Generator().manual_seed(seed)
+        std = config.initializer_range
+        hd = config.head_dim
+
+        def w(*shape):
+            t = torch.randn(*shape, generator=gen) * std
+            return t.to(dtype=config.dtype, device=config.device)
+
+        def ones(n):
+            return torch.ones(n, dtype=config.dtype, device=config.device)
+
+        self.embed_tokens = w(config.vocab_size, config.hidden_size)
+        self.embed_tokens[config.pad_token_id] = 0
+        self.lm_head = w(config.vocab_size, config.hidden_size)
+        self.norm = ones(config.hidden_size)
+
+        self.layers = []
+        for _ in range(config.num_hidden_layers):
+            self.layers.append({
+                'input_layernorm': ones(config.hidden_size),
+                'q_proj': w(config.num_attention_heads * hd, config.hidden_size),
+                'k_proj': w(config.num_key_value_heads * hd, config.hidden_size),
+                'v_proj': w(config.num_key_value_heads * hd, config.hidden_size),
+                'o_proj': w(config.hidden_size, config.num_attention_heads * hd),
+                'post_attention_layernorm': ones(config.hidden_size),
+                'gate_proj': w(config.intermediate_size, config.hidden_size),
+                'up_proj': w(config.intermediate_size, config.hidden_size),
+                'down_proj': w(config.hidden_size, config.intermediate_size),
+            })
+
+        # Position embeddings for the max sequence length
+        inv_freq = 1.0 / (config.rotary_embedding_base ** (
+            torch.arange(0, hd, 2, dtype=torch.float32) / hd))
+        t = torch.arange(config.max_seq_len, dtype=torch.float32)
+        freqs = torch.outer(t, inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        self.sin = emb.sin().to(dtype=config.dtype, device=config.device)
+        self.cos = emb.cos().to(dtype=config.dtype, device=config.device)
+
+    def _attention(self, layer, x, cache, index, attn_mask):
+        cfg = self.config
+        bsz, q_len, _ = x.shape
+        past_len = cache.current_seq_len
+
+        q = F.linear(x, layer['q_proj'])
+        k = F.linear(x, layer['k_proj'])
+        v = F.linear(x, layer['v_proj'])
+
+        q = q.view(bsz, q_len, cfg.num_attention_heads, cfg.head_dim).transpose(1, 2)
+        k = k.view(bsz, q_len, cfg.num_key_value_heads, cfg.head_dim).transpose(1, 2)
+        v = v.view(bsz, q_len, cfg.num_key_value_heads, cfg.head_dim).transpose(1, 2)
+
+        sin = self.sin[past_len : past_len + q_len]
+        cos = self.cos[past_len : past_len + q_len]
+        q = q * cos + _rotate_half(q) * sin
+        k = k * cos + _rotate_half(k) * sin
+
+        # Add keys and values to cache
+        cache.key_states[index][:bsz, :, past_len : past_len + q_len] = k
+        cache.value_states[index][:bsz, :, past_len : past_len + q_len] = v
+
+        keys = cache.key_states[index][:bsz, :, : past_len + q_len]
+        values = cache.value_states[index][:bsz, :, : past_len + q_len]
+        if cfg.num_key_value_groups > 1:
+            keys = keys.repeat_interleave(cfg.num_key_value_groups, dim=1)
+            values = values.repeat_interleave(cfg.num_key_value_groups, dim=1)
+
+        scores = torch.matmul(q, keys.transpose(2, 3)) / math.sqrt(cfg.head_dim)
+        if attn_mask is not None:
+            scores = scores + attn_mask
+        probs = torch.softmax(scores.float(), dim=-1).to(cfg.dtype)
+        out = torch.matmul(probs, values).transpose(1, 2)
+        out = out.reshape(bsz, q_len, cfg.num_attention_heads * cfg.head_dim)
+        return F.linear(out, layer['o_proj'])
+
+    def _mlp(self, layer, x):
+        y = F.silu(F.linear(x, layer['gate_proj']))
+        y = y * F.linear(x, layer['up_proj'])
+        return F.linear(y, layer['down_proj'])
+
+    def _attn_mask(self, bsz, q_len, past_len, input_mask):
+        if q_len == 1 and input_mask is None:
+            return None
+
+        neg = -65504.0
+        causal = torch.full((q_len, past_len + q_len), 0.0,
+                            dtype=self.config.dtype, device=self.config.device)
+        causal[:, past_len:] = torch.triu(
+            torch.full((q_len, q_len), neg, dtype=self.config.dtype), 1)
+        mask = causal.expand(bsz, 1, q_len, past_len + q_len)
+
+        if input_mask is not None:
+            m = input_mask[:, : past_len + q_len].to(self.config.device)
+            m = torch.where(m, 0.0, neg).to(self.config.dtype)
+            mask = torch.minimum(mask, m[:, None, None, :])
+        return mask
+
+    def forward(self, input_ids, cache, last_id_only = True,
+                preprocess_only = False, lora = None, output_device = None,
+                input_mask = None, output_hidden = False):
+        """
+        Run the decoder over input_ids [batch, seq_len] at the current cache
+        position. Returns float logits [batch, seq_len or 1, vocab], or None
+        if preprocess_only. With output_hidden, returns the normalized last
+        hidden states [batch, seq_len or 1, hidden] instead of the logits.
+        The lora argument is accepted and ignored.
+        """
+        with torch.no_grad():
+            bsz, q_len = input_ids.shape
+            past_len = cache.current_seq_len
+            assert past_len + q_len <= cache.max_seq_len, "cache overflow"
+            if output_device is None: output_device = input_ids.device
+
+            attn_mask = self._attn_mask(bsz, q_len, past_len, input_mask)
+            hidden = self.embed_tokens[input_ids.to(self.config.device)]
+
+            for i, layer in enumerate(self.layers):
+                h = _rms_norm(hidden, layer['input_layernorm'],
+                              self.config.rms_norm_eps)
+                hidden = hidden + self._attention(layer, h, cache, i, attn_mask)
+                h = _rms_norm(hidden, layer['post_attention_layernorm'],
+                              self.config.rms_norm_eps)
+                hidden = hidden + self._mlp(layer, h)
+
+            cache.current_seq_len += q_len
+
+            if preprocess_only:
+                return None
+
+            hidden = _rms_norm(hidden, self.norm, self.config.rms_norm_eps)
+            if last_id_only:
+                hidden = hidden[:, -1:, :]
+            if output_hidden:
+                return hidden.float().to(output_device)
+
+            logits = F.linear(hidden, self.lm_head).float()
+            return logits.to(output_device)
+
+    def forward_paged(self, input_ids, cache, seq_ids : list,
+                      last_id_only = True, preprocess_only = False):
+        """
+        Run the decoder over input_ids [batch, seq_len] appended to the
+        sequences seq_ids of a PagedCache. Each row continues at the length
+        of its own sequence, so the rows need not be aligned.
+        """
+        from polyai.server.generation.paged_cache import paged_attention
+
+        cfg = self.config
+        with torch.no_grad():
+            bsz, q_len = input_ids.shape
+            assert len(seq_ids) == bsz
+
+            starts = torch.tensor([cache.length(s) for s in seq_ids])
+            positions = starts[:, None] + torch.arange(q_len)[None, :]
+            assert int(positions.max()) < cfg.max_seq_len, "sequence too long"
+
+            new_slots = torch.stack([cache.reserve(s, q_len) for s in seq_ids])
+            slots, mask = cache.gather_slots(seq_ids)
+
+            sin = self.sin[positions][:, None]      # [b, 1, q, d]
+            cos = self.cos[positions][:, None]
+            hidden = self.embed_tokens[input_ids.to(cfg.device)]
+
+            for i, layer in enumerate(self.layers):
+                h = _rms_norm(hidden, layer['input_layernorm'], cfg.rms_norm_eps)
+
+                q = F.linear(h, layer['q_proj'])
+                k = F.linear(h, layer['k_proj'])
+                v = F.linear(h, layer['v_proj'])
+                q = q.view(bsz, q_len, cfg.num_attention_heads, cfg.head_dim).transpose(1, 2)
+                k = k.view(bsz, q_len, cfg.num_key_value_heads, cfg.head_dim).transpose(1, 2)
+                q = q * cos + _rotate_half(q) * sin
+                k = k * cos + _rotate_half(k) * sin
+
+                cache.write(i, new_slots.flatten(),
+                            k.transpose(1, 2).reshape(bsz * q_len, cfg.num_key_value_heads, cfg.head_dim),
+                            v.reshape(bsz * q_len, cfg.num_key_value_heads, cfg.head_dim))
+
+                out = paged_attention(q, cache, i, slots, mask, positions)
+                out = out.reshape(bsz, q_len, cfg.num_attention_heads * cfg.head_dim)
+                hidden = hidden + F.linear(out, layer['o_proj'])
+
+                h = _rms_norm(hidden, layer['post_attention_layernorm'], cfg.rms_norm_eps)
+                hidden = hidden + self._mlp(layer, h)
+
+            if preprocess_only:
+                return None
+
+            hidden = _rms_norm(hidden, self.norm, cfg.rms_norm_eps)
+            if last_id_only:
+                hidden = hidden[:, -1:, :]
+            return F.linear(hidden, self.lm_head).float()
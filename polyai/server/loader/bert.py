@@ -1,16 +1,40 @@
 import os
 import pylogg
-from collections import namedtuple
 import polyai.server.state as state
+from polyai.server.generation import embedding, ner_align, ner_window, ner_cpu
+from polyai.server.microbatch import MicroBatcher
 
 log = pylogg.New("bert")
 
 
 class BERTModel:
-    def __init__(self, device = None) -> None:
-        import spacy
+    def __init__(self, device = None, embed_batch_tokens = 4096,
+                 ner_batch_size = 16, ner_wait_ms = 5.0,
+                 ner_words = "regex", ner_stride = 128, cpu_mode = "fp32",
+                 cpu_threads = 0, cpu_workers = 0) -> None:
         self.device = device if device else 'cuda:0'
-        self.nlp = spacy.load("en_core_web_sm")
+        self.embed_batch_tokens = embed_batch_tokens
+        self.ner_batch_size = ner_batch_size
+        self.ner_wait_ms = ner_wait_ms
+        self.batcher : MicroBatcher = None
+        self.ner_words = ner_words
+        self.ner_stride = ner_stride
+        self.cpu_mode = cpu_mode
+        self.cpu_threads = cpu_threads
+        self.cpu_workers = cpu_workers
+        self.workers : ner_cpu.Workers = None
+        self.nlp = None
+
+        if ner_words not in ner_align.WORDS:
+            raise ValueError(f"unknown NER word splitter: {ner_words}")
+        if cpu_mode not in ner_cpu.MODES:
+            raise ValueError(f"unknown NER mode: {cpu_mode}")
+        if not self.device.startswith("cpu") and \
+                (cpu_mode != "fp32" or cpu_workers > 0):
+            raise ValueError("NER cpu mode and workers need a cpu device")
+        if ner_words == "spacy":
+            import spacy
+            self.nlp = spacy.load("en_core_web_sm")
 
     def print_vram_usage(self):
         log.info(
@@ -23,25 +47,46 @@ class BERTModel:
         t1 = log.trace("Loading BERT model: {}", model_dir)
         self.print_vram_usage()
 
-        from transformers import AutoModelForTokenClassification, AutoTokenizer, pipeline
-
         state.BERT._model_name = os.path.basename(model_dir).split(".")[0]
-        tokenizer = AutoTokenizer.from_pretrained(model_dir, model_max_length=512)
-        model = AutoModelForTokenClassification.from_pretrained(model_dir)
+        if self.device.startswith("cpu"):
+            ner_cpu.set_threads(self.cpu_threads)
 
         # Load model and tokenizer
-        state.BERT._pipeline = pipeline(task="ner",
-                                 model=model,
-                                 tokenizer=tokenizer,
-                                 aggregation_strategy="simple",
-                                 device=self.device)
+        state.BERT._pipeline = ner_cpu.load_pipeline(model_dir, self.device,
+                                                     self.cpu_mode)
+
+        # Long texts are split into windows overlapping by the stride.
+        tokenizer = state.BERT._pipeline.tokenizer
+        window = tokenizer.model_max_length - tokenizer.num_special_tokens_to_add()
+        if not 0 <= self.ner_stride < window:
+            raise ValueError(f"NER stride must be less than {window} tokens")
+
+        # NER batches split across processes, each with a copy of the model.
+        if self.workers is not None:
+            self.workers.close()
+            self.workers = None
+        if self.cpu_workers > 0:
+            self.workers = ner_cpu.Workers(model_dir, self.cpu_workers,
+                                           self.cpu_mode, self.cpu_threads,
+                                           self.ner_stride,
+                                           self.embed_batch_tokens)
+            log.info("Started {} NER worker processes.", self.cpu_workers)
+
+        # Concurrent NER requests share the forward passes.
+        if self.batcher is not None:
+            self.batcher.close()
+        self.batcher = MicroBatcher(self._ner_batch, self.ner_batch_size,
+                                    self.ner_wait_ms, name="bert-ner").start()
 
         t1.done("Model loaded: {}", state.BERT.model_name())
         self.print_vram_usage()
 
     def ner_tags(self, text):
         t1 = log.trace("Getting NER for: {}", text)
-        ner_output = state.BERT._pipeline(text)
+        if self.batcher is not None:
+            ner_output = self.batcher.submit(text)
+        else:
+            ner_output = self._ner_batch([text])[0]
         ner_tuples = self._ner_feed(ner_output, text)
         t1.done("NER processed: {}", ner_output)
 
@@ -51,58 +96,104 @@ class BERTModel:
             round(1000 * t1.elapsed())
         )
 
+    def ner_batch(self, texts : list):
+        """
+        NER of many texts, batched with the other requests.
+
+        Returns:
+            Name of the model,
+            List of the NER tags of each text,
+            Total time elapsed in miliseconds.
+        """
+        t1 = log.trace("Getting NER for {} texts.", len(texts))
+        if self.batcher is not None:
+            outputs = self.batcher.submit_many(texts)
+        else:
+            outputs = self._ner_batch(texts)
+        tags = [[tup._asdict() for tup in self._ner_feed(output, text)]
+                for output, text in zip(outputs, texts)]
+        t1.done("NER processed {} texts.", len(texts))
+
+        return (
+            state.BERT.model_name(),
+            tags,
+            round(1000 * t1.elapsed())
+        )
+
+    def _ner_batch(self, texts : list) -> list:
+        """
+        Run the model on a batch of texts of any length. The windows of all
+        the texts share the forward passes, padded by length groups.
+        """
+        if self.workers is not None:
+            return self.workers.ner(texts)
+        return ner_window.ner(state.BERT._pipeline, texts, self.ner_stride,
+                              self.embed_batch_tokens)
+
+    def stats(self) -> dict:
+        return self.batcher.stats() if self.batcher is not None else {}
+
+
+    def embed(self, texts : list, pooling = "mean", normalize = True):
+        """
+        Embed a list of texts with the pooled last hidden states of the
+        BERT encoder, in batches of up to embed_batch_tokens padded tokens.
+
+        Returns:
+            Name of the model,
+            List of embedding vectors,
+            Total input tokens,
+            Total time elapsed in miliseconds.
+        """
+        import torch
+
+        t1 = log.trace("Embedding {} texts.", len(texts))
+        tokenizer = state.BERT._pipeline.tokenizer
+        model = state.BERT._pipeline.model
+        lengths = [len(ids) for ids in
+                   tokenizer(texts, truncation=True)['input_ids']]
+
+        vectors = [None] * len(texts)
+        with torch.no_grad():
+            for batch in embedding.length_batches(lengths,
+                                                  self.embed_batch_tokens):
+                inputs = tokenizer([texts[i] for i in batch], padding=True,
+                                   truncation=True, return_tensors="pt")
+                inputs = inputs.to(model.device)
+                output = model(**inputs, output_hidden_states=True)
+                pooled = embedding.pool(output.hidden_states[-1],
+                                        inputs['attention_mask'].bool(),
+                                        pooling, normalize).cpu()
+                for i, vector in zip(batch, pooled):
+                    vectors[i] = vector.tolist()
+
+        t1.done("Embedded {} texts, {} tokens.", len(texts), sum(lengths))
+        return (
+            state.BERT.model_name(),
+            vectors,
+            sum(lengths),
+            round(1000 * t1.elapsed())
+        )
+
 
-    def _ner_feed(self, seq_pred, text) -> list[namedtuple]:
+    def _ner_feed(self, seq_pred, text) -> list[ner_align.token_label]:
         """ Convert outputs of the NER to a form usable by record extraction
             seq_pred: List of dictionaries
             text: str, text fed to sequence classification model
         """
-        doc = self.nlp(text)
-        token_label = namedtuple('token_label', ["text", "label"])
-        if len(seq_pred) == 0:
-            # If no NER could be reconginzed, the prediction list would be empty.
-            return [token_label(doc[i].text, 'O') for i in range(len(doc))]
-
-        seq_index = 0
-        text_len = len(text)
-        seq_len = len(seq_pred)
-        len_doc = len(doc)
-        token = ''
-        token_labels = []
-        start_index = seq_pred[seq_index]["start"]
-        end_index = seq_pred[seq_index]["end"]
-        i = 0
-        char_index = -1
-
-        while i < len_doc:
-            token = doc[i].text
-            if char_index+1 >= start_index and seq_index < seq_len:
-                # Continue loop till end_index or end of word
-                # increment index and values
-                current_label = seq_pred[seq_index]["entity_group"]
-                while char_index < end_index-1:
-                    token_labels.append(token_label(token, current_label))
-                    char_index += len(token)
-                    if char_index < text_len-1 and text[char_index+1] == ' ': char_index+=1
-                    i += 1
-                    if i < len_doc: token=doc[i].text
-                seq_index += 1
-                if seq_index < seq_len:
-                    start_index = seq_pred[seq_index]["start"]
-                    end_index = seq_pred[seq_index]["end"]
-            else:
-                token_labels.append(token_label(token, 'O'))
-                i += 1
-                char_index += len(token)
-                if char_index < text_len-1 and text[char_index+1] == ' ':
-                    char_index += 1
-        
-        return token_labels 
-
-
-def init_bert(device : str):
+        return ner_align.ner_words(seq_pred, text, self.ner_words, self.nlp)
+
+
+def init_bert(device : str, embed_batch_tokens : int = 4096,
+              ner_batch_size : int = 16, ner_wait_ms : float = 5.0,
+              ner_words : str = "regex", ner_stride : int = 128,
+              cpu_mode : str = "fp32", cpu_threads : int = 0,
+              cpu_workers : int = 0):
     if device == 'cuda':
         device = 'cuda:0'
 
-    state.BERT._loader = BERTModel(device)
+    state.BERT._loader = BERTModel(device, embed_batch_tokens,
+                                   ner_batch_size, ner_wait_ms, ner_words,
+                                   ner_stride, cpu_mode, cpu_threads,
+                                   cpu_workers)
     return state.BERT._loader
@@ -1,22 +1,40 @@
 import os
 import argparse
+import functools
 import torch
 
 import pylogg
 import polyai.server.state as state
+from polyai.server.admission import AdmissionQueue
 from polyai.server.exllama import model_init
 from polyai.server.exllama.model import ExLlama, ExLlamaCache
 from polyai.server.exllama.lora import ExLlamaLora
 from polyai.server.exllama.tokenizer import ExLlamaTokenizer
 from polyai.server.exllama.generator import ExLlamaGenerator
+from polyai.server.generation import sampling, embedding
+from polyai.server.generation.scheduler import BatchScheduler
+from polyai.server.generation.prefix_cache import PrefixCache
+from polyai.server.generation.stops import StopMatcher
+from polyai.server.generation.speculative import SpeculativeDecoder
 
 EPS = 1e-10
 log = pylogg.New("llm")
 
 class ExllamaModel:
-    def __init__(self, vram_spec = None, ctx_len = 2048) -> None:
+    def __init__(self, vram_spec = None, ctx_len = 2048, batch_size = 1,
+                 prefix_cache_mb = 0, num_draft_tokens = 4,
+                 embed_batch_tokens = 4096) -> None:
         self.vram_spec = vram_spec
         self.ctx_len = ctx_len
+        self.batch_size = batch_size
+        self.prefix_cache_mb = prefix_cache_mb
+        self.num_draft_tokens = num_draft_tokens
+        self.embed_batch_tokens = embed_batch_tokens
+        self.scheduler : BatchScheduler = None
+        self.prefix_cache : PrefixCache = None
+        self.draft_model : ExLlama = None
+        self.draft_cache : ExLlamaCache = None
+        self.speculative : SpeculativeDecoder = None
 
         # Not sure what this does exactly.
         torch.set_grad_enabled(False)
@@ -34,11 +52,15 @@ class ExllamaModel:
             %state.Server.vram_usage())
 
 
-    def load_model(self, model_file):
-        # Notify user
-        t1 = log.trace("Loading ExLlama model: {}", model_file)
-        self.print_vram_usage()
+    def stats(self) -> dict:
+        stats = {}
+        if self.scheduler is not None:
+            stats['scheduler'] = self.scheduler.stats()
+        if self.speculative is not None:
+            stats['speculative'] = self.speculative.stats()
+        return stats
 
+    def _model_args(self, model_file):
         # Default exllama options
         parser = argparse.ArgumentParser(description = "ExLlama")
         model_init.add_args(parser)
@@ -51,18 +73,49 @@ class ExllamaModel:
             log.info("Using GPU map: {} GB", self.vram_spec)
             exargs.gpu_split = self.vram_spec
 
-        # Unload existing model if any
-        state.LLM.unload_model()
-
         # Post process the arguments
         model_init.get_model_files(exargs)
+        return exargs
+
+
+    def load_model(self, model_file):
+        # Notify user
+        t1 = log.trace("Loading ExLlama model: {}", model_file)
+        self.print_vram_usage()
+
+        # Unload existing model if any
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+        self.prefix_cache = None
+        self.speculative = None
+        _compile_stops.cache_clear()
+        state.LLM.unload_model()
 
         # Load the model, tokenizer
+        exargs = self._model_args(model_file)
         config = model_init.make_config(exargs)
         state.LLM._model = ExLlama(config)
-        state.LLM._cache = ExLlamaCache(state.LLM._model)
+        state.LLM._cache = ExLlamaCache(state.LLM._model,
+                                        batch_size=self.batch_size)
         state.LLM._tokenizer = ExLlamaTokenizer(exargs.tokenizer)
 
+        # Reuse the KV cache of common prompt prefixes across requests.
+        if self.prefix_cache_mb > 0:
+            self.prefix_cache = PrefixCache(
+                state.LLM._model, ExLlamaCache,
+                max_bytes=self.prefix_cache_mb * 1024**2)
+
+        # Serve concurrent requests from the batched cache.
+        if self.batch_size > 1:
+            self.scheduler = BatchScheduler(state.LLM._model, state.LLM._cache,
+                                            state.LLM._tokenizer.eos_token_id,
+                                            state.LLM._tokenizer.pad_token_id,
+                                            prefix_cache=self.prefix_cache)
+            self.scheduler.start()
+
+        self._init_speculative()
+
         state.LLM._model_name = os.path.basename(model_file).split(".")[0]
         if state.LLM._model_name == 'model':
             state.LLM._model_name = os.path.dirname(model_file).split("/")[-1]
@@ -74,6 +127,39 @@ class ExllamaModel:
         self.print_vram_usage()
 
 
+    def load_draft_model(self, model_file):
+        """ Load a small model sharing the tokenizer for speculative decoding. """
+        assert state.LLM._model is not None, "Model must be loaded first"
+        t1 = log.trace("Loading draft model: {}", model_file)
+
+        self.speculative = None
+        self.draft_cache = None
+        self.draft_model = None
+
+        exargs = self._model_args(model_file)
+        config = model_init.make_config(exargs)
+        self.draft_model = ExLlama(config)
+        self.draft_cache = ExLlamaCache(self.draft_model)
+        self._init_speculative()
+
+        t1.done("Draft model loaded: {}", os.path.dirname(model_file))
+        self.print_vram_usage()
+
+
+    def _init_speculative(self):
+        if self.draft_model is None:
+            return
+        if self.scheduler is not None:
+            log.warn("Speculative decoding is not used with batching.")
+            return
+        self.speculative = SpeculativeDecoder(
+            state.LLM._model, state.LLM._cache,
+            self.draft_model, self.draft_cache,
+            self.num_draft_tokens, lora=state.LLM._lora)
+        log.info("Speculative decoding with {} draft tokens.",
+                 self.num_draft_tokens)
+
+
     def add_lora(self, lora_file : str):
         assert state.LLM._model is not None, "Model must be loaded first"
         lora_dir = os.path.dirname(lora_file)
@@ -85,6 +171,10 @@ class ExllamaModel:
         lora = ExLlamaLora(state.LLM._model, lora_config, lora_bin)
         state.LLM._lora = lora
         state.LLM._lora_name = os.path.basename(lora_dir)
+        if self.scheduler is not None:
+            self.scheduler.lora = lora
+        if self.speculative is not None:
+            self.speculative.lora = lora
 
         t1.done("Lora loaded: {}", lora_dir)
         if lora.bias_ignored:
@@ -103,21 +193,32 @@ class ExllamaModel:
             Total time elapsed in miliseconds.
         """
         t1 = log.trace("Getting LLM response.")
-        generator, stops, max_tokens = _prepare_generation(params)
         prompt = prompt.strip()
-        state.LLM._is_ready = False
-
-        # Set the context/user input
         prompt_tokens = state.LLM.encode(prompt)
-        generator.gen_begin_reuse(prompt_tokens)
         prompt_tok = prompt_tokens.shape[-1]
         compl_toks = [0] # list needed to pass by ref.
 
+        if self.scheduler is not None:
+            # Concurrent requests share the batch, model stays ready.
+            outputs = _scheduler_helper(self.scheduler, prompt_tokens,
+                                        params, compl_toks)
+        elif self.speculative is not None:
+            state.LLM._is_ready = False
+            outputs = _speculative_helper(self.speculative, prompt_tokens,
+                                          params, compl_toks)
+        else:
+            generator, stops, max_tokens = _prepare_generation(params)
+            state.LLM._is_ready = False
+
+            # Set the context/user input
+            _begin_prompt(generator, prompt_tokens, self.prefix_cache)
+            outputs = _stream_helper(generator, stops, max_tokens, compl_toks)
+
         print("\n", "-"*80)
         print(prompt)
 
         output = ""
-        for out in _stream_helper(generator, stops, max_tokens, compl_toks):
+        for out in outputs:
             output += out
             print(out, end="", flush=True)
 
@@ -142,22 +243,80 @@ class ExllamaModel:
 
         """
         t1 = log.trace("Streaming LLM response.")
-        generator, stops, max_tokens = _prepare_generation(params)
         prompt = prompt.strip()
-        state.LLM._is_ready = False
-
-        # Set the context/user input
         prompt_tokens = state.LLM.encode(prompt)
-        generator.gen_begin_reuse(prompt_tokens)
         prompt_tok = prompt_tokens.shape[-1]
         compl_toks = [0] # list needed to pass by ref.
 
+        if self.scheduler is not None:
+            yield prompt + " "
+            yield from _scheduler_helper(self.scheduler, prompt_tokens,
+                                         params, compl_toks)
+            t1.done("Stream complete.")
+            return
+
+        if self.speculative is not None:
+            state.LLM._is_ready = False
+            yield prompt + " "
+            yield from _speculative_helper(self.speculative, prompt_tokens,
+                                           params, compl_toks)
+            state.LLM._is_ready = True
+            t1.done("Stream complete.")
+            return
+
+        generator, stops, max_tokens = _prepare_generation(params)
+        state.LLM._is_ready = False
+
+        # Set the context/user input
+        _begin_prompt(generator, prompt_tokens, self.prefix_cache)
+
         yield prompt + " "
         yield from _stream_helper(generator, stops, max_tokens, compl_toks)
         state.LLM._is_ready = True
         t1.done("Stream complete.")
 
 
+    def embed(self, texts : list, pooling = "mean", normalize = True):
+        """
+        Embed a list of texts with the pooled last hidden states, in batched
+        forward passes of up to embed_batch_tokens padded tokens.
+
+        Returns:
+            Name of the model,
+            List of embedding vectors,
+            Total input tokens,
+            Total time elapsed in miliseconds.
+        """
+        t1 = log.trace("Embedding {} texts.", len(texts))
+        tokenizer = state.LLM._tokenizer
+        lengths = [len(ids) + 1 for ids in tokenizer.tokenizer.EncodeAsIds(texts)]
+        if max(lengths) > self.ctx_len:
+            raise ValueError("text longer than the context length")
+
+        def encode(batch):
+            return tokenizer.encode(batch, return_mask=True, add_bos=True,
+                                    max_seq_len=self.ctx_len)
+
+        def run():
+            return embedding.embed(state.LLM._model, ExLlamaCache, encode,
+                                   texts, lengths, pooling, normalize,
+                                   self.embed_batch_tokens)
+
+        # The scheduler thread owns the model while it is running.
+        if self.scheduler is not None:
+            vectors = self.scheduler.call(run)
+        else:
+            vectors = run()
+
+        t1.done("Embedded {} texts, {} tokens.", len(texts), sum(lengths))
+        return (
+            state.LLM.model_name(),
+            vectors.tolist(),
+            sum(lengths),
+            round(1000 * t1.elapsed())
+        )
+
+
 def _prepare_generation(param):
     param = state.LLM.parameters(param)
     generator = ExLlamaGenerator(state.LLM._model,
@@ -167,6 +326,8 @@ def _prepare_generation(param):
     generator.settings.top_k = param['top_k']
     generator.settings.top_p = param['top_p']
     generator.settings.min_p = param['min_p']
+    generator.settings.tfs = param['tfs']
+    generator.settings.top_a = param['top_a']
     generator.settings.beams = param['num_beams']
     generator.settings.token_repetition_penalty_max = \
         param['repetition_penalty']
@@ -188,33 +349,99 @@ def _prepare_generation(param):
     max_tokens = param['max_new_tokens']
     log.trace("Max tokens: {}", max_tokens)
 
+    return generator, _stop_conditions(param), max_tokens
+
+
+def _prepare_sampling(param):
+    """ Sampling parameters for the batch scheduler or speculative decoding. """
+    param = state.LLM.parameters(param)
+    params = sampling.SamplingParams(
+        temperature = param['temperature'],
+        top_k = param['top_k'],
+        top_p = param['top_p'],
+        min_p = param['min_p'],
+        tfs = param['tfs'],
+        top_a = param['top_a'],
+        repetition_penalty = param['repetition_penalty'],
+    )
+
+    if param['ban_eos_token']:
+        params.disallowed_tokens = [state.LLM._tokenizer.eos_token_id]
+
+    log.trace("Generation settings: {}", str(params))
+    max_tokens = param['max_new_tokens']
+    log.trace("Max tokens: {}", max_tokens)
+
+    return params, _stop_conditions(param), max_tokens
+
+
+def _stop_conditions(param) -> StopMatcher:
+    """ Compiled stop strings and token sequences to end the generation. """
     participants = [state.LLM._user_name, state.LLM._bot_name]
     if len(state.LLM._system_name) > 0:
         participants.append(state.LLM._system_name)
+
+    token_sequences = tuple(
+        (seq,) if isinstance(seq, int) else tuple(seq)
+        for seq in param['stopping_token_ids'])
+
+    return _compile_stops(tuple(participants), state.LLM._break_on_newline,
+                          tuple(param['stopping_strings']), token_sequences)
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_stops(participants, break_on_newline, stopping_strings,
+                   token_sequences) -> StopMatcher:
+    """ Encode and compile a stop set, once per distinct set. """
     log.trace("Participants: {}", participants)
 
-    # Prepare stop conditions
-    stop_conditions = []
-    newline_token = \
-        torch.Tensor([[state.LLM._tokenizer.newline_token_id]]).long()
+    # Stop strings, and the number of tokens to rewind for each.
+    strings = []
+    lengths = []
 
-    if state.LLM._break_on_newline:
+    if break_on_newline:
         # Stop generation on newline character.
-        stop_conditions.append((newline_token, "\n"))
+        strings.append("\n")
+        lengths.append(0)
     else:
         # Stop generation if a newline followed by a participant is generated.
         for part in participants:
-            sc = state.LLM.encode(part)
-            sc = torch.cat((newline_token, sc), dim=1)
-            stop_conditions.append((sc, "\n" + part))
-            stop_conditions.append((sc, "\n " + part))
+            n = state.LLM.encode(part).shape[-1]
+            strings += ["\n" + part, "\n " + part]
+            lengths += [n, n]
         # Other stopping strings requested
-        for pattern in param['stopping_strings']:
-            sc = state.LLM.encode(pattern.strip())
-            sc = torch.cat((newline_token, sc), dim=1)
-            stop_conditions.append((sc, pattern))
+        for pattern in stopping_strings:
+            strings.append(pattern)
+            lengths.append(state.LLM.encode(pattern.strip()).shape[-1])
+
+    return StopMatcher(strings, token_sequences, lengths)
+
+
+def _begin_prompt(generator, prompt_tokens, prefix_cache = None):
+    """ Feed the prompt, reusing the cached KV of a known prefix if any. """
+    if prefix_cache is None:
+        generator.gen_begin_reuse(prompt_tokens)
+        return
+
+    # The cache holds all but the last token of the sequence.
+    prefix = prompt_tokens[0, :-1].tolist()
+    blocks = prefix_cache.lookup(prefix)
+    reuse = prefix_cache.restore(blocks, generator.cache)
 
-    return generator, stop_conditions, max_tokens
+    if reuse == 0:
+        # Nothing was restored, the previous sequence is still in the cache.
+        generator.gen_begin_reuse(prompt_tokens)
+    else:
+        log.trace("Reusing cached prefix: {} tokens", reuse)
+        generator.end_beam_search()
+        generator.sequence = prompt_tokens[:, :reuse + 1].clone()
+        generator.sequence_actual = generator.sequence
+        generator.cache.current_seq_len = reuse
+        if reuse + 1 < prompt_tokens.shape[-1]:
+            generator.gen_feed_tokens(prompt_tokens[:, reuse + 1:])
+
+    if reuse < len(prefix):
+        prefix_cache.store(prefix, generator.cache)
 
 
 def _stream_helper(generator, stop_conditions, max_tokens, total_tokens):
@@ -227,9 +454,11 @@ def _stream_helper(generator, stop_conditions, max_tokens, total_tokens):
 
     res_line = ""
     chunk_size = 2
-    stop_condition = False
-    held_text = ""
     num_res_tokens = 0
+    decoder = state.LLM._tokenizer.stream_decoder()
+    stops = stop_conditions.stream()
+    eos_token_id = state.LLM._tokenizer.eos_token_id
+    stopped = False
 
     for i in range(max_tokens):
         # Truncate the past if the next chunk might generate past max_seq_length
@@ -241,18 +470,26 @@ def _stream_helper(generator, stop_conditions, max_tokens, total_tokens):
 
         # Get the most probable token and append to sequence
         gen_token = generator.beam_search()
+        token = gen_token.item()
+        is_eos = token == eos_token_id
 
         # If token is EOS, replace it with newline before continuing
-        if gen_token.item() == state.LLM._tokenizer.eos_token_id:
+        if is_eos:
             generator.replace_last_token(state.LLM._tokenizer.newline_token_id)
+            token = state.LLM._tokenizer.newline_token_id
 
-        # Decode current line to get new characters added
-        # (decoding a single token gives incorrect results sometimes
-        # due to how SentencePiece works)
-        prev_res_line = res_line
+        # Stop token sequences, the text of the last token is not sent.
         num_res_tokens += 1
-        res_line = state.LLM.decode(generator.sequence_actual[0, -num_res_tokens:])
-        new_text = res_line[len(prev_res_line):]
+        stop_tokens = stops.feed_token(token)
+        if stop_tokens is not None:
+            generator.gen_rewind(len(stop_tokens))
+            stopped = True
+            break
+
+        # Decode the new characters added, the decoder keeps enough
+        # context to get SentencePiece spaces and partial unicode
+        # characters right.
+        new_text = decoder.add(token)
 
         # Since SentencePiece is slightly ambiguous,
         # the first token produced after a newline may not be the
@@ -263,52 +500,132 @@ def _stream_helper(generator, stop_conditions, max_tokens, total_tokens):
             if replace.shape[-1] == 1:
                 generator.replace_last_token(replace)
 
-        # Delay streaming if new text might be part of a stop condition
-        hold_text = False
-        for _, stop_string in stop_conditions:
-            if stop_string.lower().startswith((held_text + new_text).lower()):
-                hold_text = True
-
-        # Stream to client
-        if not hold_text:
-            packet = held_text + new_text
+        # Stream to client, holding back the text that might be the
+        # start of a stop string
+        packet, stop_string = stops.feed(new_text)
+        res_line += packet
+        if packet:
             yield packet
-            held_text = ""
-        else:
-            held_text += new_text
 
         # Check the stop conditions
-        if gen_token.item() == state.LLM._tokenizer.eos_token_id:
-            if len(held_text) > 0:  # Not sure if this could actually happen
-                plen = state.LLM.encode(held_text).shape[-1]
-                res_line = res_line[:-len(held_text)]
+        if is_eos:
+            if len(stops.held) > 0:  # Not sure if this could actually happen
+                plen = state.LLM.encode(stops.held).shape[-1]
                 generator.gen_rewind(plen)
-            stop_condition = True
+                stops.held = ""
             break
 
-        for stop_tokens, stop_string in stop_conditions:
-            if res_line.lower().endswith(stop_string.lower()):
-                generator.gen_rewind(
-                    stop_tokens.shape[-1] - (
-                        1 if stop_tokens[0, 0].item() == \
-                            state.LLM._tokenizer.newline_token_id else 0
-                    )
-                )
-                res_line = res_line[:-len(stop_string)]
-                stop_condition = True
-                break
+        if stop_string is not None:
+            generator.gen_rewind(stop_conditions.rewind(stop_string))
+            stopped = True
+            break
 
-        if stop_condition or state.LLM._stop_generation:
+        if state.LLM._stop_generation:
             break
 
+    # Out of tokens, end of sequence or interrupted, send the text held back.
+    if not stopped:
+        packet, stop_string = stops.finish(decoder.flush())
+        res_line += packet
+        if packet:
+            yield packet
+
     generator.end_beam_search()
     res_line = res_line.strip()
     total_tokens[0] += num_res_tokens
     return res_line
 
 
+def _scheduler_helper(scheduler, prompt_tokens, param, total_tokens):
+    """ Generate model response as a sequence of the batch scheduler. """
+    params, stop_conditions, max_tokens = _prepare_sampling(param)
+    req = scheduler.submit(prompt_tokens[0].tolist(), max_tokens, params)
+
+    res_line = ""
+    decoder = state.LLM._tokenizer.stream_decoder()
+    stops = stop_conditions.stream()
+    stopped = False
+
+    try:
+        for token in req.tokens():
+            if token == state.LLM._tokenizer.eos_token_id:
+                break
+            if stops.feed_token(token) is not None:
+                stopped = True
+                break
+
+            # Decode the new characters added, holding back the text that
+            # might be the start of a stop string
+            packet, stop_string = stops.feed(decoder.add(token))
+            res_line += packet
+            if packet:
+                yield packet
+
+            if stop_string is not None:
+                stopped = True
+                break
+            if state.LLM._stop_generation:
+                break
+
+        # No stop was found, send the text held back.
+        if not stopped:
+            packet, stop_string = stops.finish(decoder.flush())
+            res_line += packet
+            if packet:
+                yield packet
+    finally:
+        # Free the batch row if we stopped early.
+        req.cancel()
+        total_tokens[0] += len(req.generated)
+
+    return res_line.strip()
+
+
+def _speculative_helper(spec, prompt_tokens, param, total_tokens):
+    """ Generate model response with speculative decoding. """
+    params, stop_conditions, max_tokens = _prepare_sampling(param)
+    res_line = ""
+    decoder = state.LLM._tokenizer.stream_decoder()
+    stops = stop_conditions.stream()
+    stopped = False
+
+    for token in spec.tokens(prompt_tokens, max_tokens, params):
+        total_tokens[0] += 1
+        if token == state.LLM._tokenizer.eos_token_id:
+            break
+        if stops.feed_token(token) is not None:
+            stopped = True
+            break
+
+        packet, stop_string = stops.feed(decoder.add(token))
+        res_line += packet
+        if packet:
+            yield packet
+
+        if stop_string is not None:
+            stopped = True
+            break
+        if state.LLM._stop_generation:
+            break
+
+    # No stop was found, send the text held back.
+    if not stopped:
+        packet, stop_string = stops.finish(decoder.flush())
+        res_line += packet
+        if packet:
+            yield packet
+
+    log.trace("Speculative decoding: {}", spec.stats())
+    return res_line.strip()
+
+
 def init_exllama(user : str, bot : str, instruct : str,
-                 vram : str = None, context_len : int = 4096):
+                 vram : str = None, context_len : int = 4096,
+                 batch_size : int = 1, prefix_cache_mb : int = 0,
+                 num_draft_tokens : int = 4, queue_depth : int = 16,
+                 queue_timeout : float = 60.0, queue_token_budget : int = 0,
+                 queue_depth_per_key : int = 0,
+                 embed_batch_tokens : int = 4096):
     if vram:
         assert "," in vram, "--vram must be a comma separated string"
         assert " " not in vram, "--vram must be without any space"
@@ -317,5 +634,13 @@ def init_exllama(user : str, bot : str, instruct : str,
     state.LLM._bot_name = bot
     state.LLM._system_name = instruct
 
-    state.LLM._loader = ExllamaModel(vram, context_len)
+    state.LLM._loader = ExllamaModel(vram, context_len, batch_size,
+                                     prefix_cache_mb, num_draft_tokens,
+                                     embed_batch_tokens)
+
+    # Requests wait for a free batch row, and for room in the cache.
+    state.LLM._queue = AdmissionQueue(
+        queue_depth, batch_size,
+        queue_token_budget or batch_size * context_len, queue_timeout,
+        queue_depth_per_key)
     return state.LLM._loader
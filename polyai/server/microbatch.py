@@ -0,0 +1,222 @@
+""" Dynamic micro-batching of model calls.
+
+    Concurrent callers submit one item each and wait for its result. A
+    worker thread takes the oldest waiting item, waits up to max_wait_ms
+    for more to arrive, up to max_batch items, and runs them all with one
+    call of the batch function, e.g. a HF pipeline on a list of texts, so
+    that they share one padded forward pass. The results are handed back to
+    the callers in order. If the batch function fails, each of its callers
+    gets the error.
+
+    A lone request waits at most max_wait_ms more than it would unbatched,
+    while under load the model runs full batches. A batch of texts of mixed
+    lengths can be split by by_length(), so that the short ones are not
+    padded to the longest.
+"""
+import time
+import threading
+import collections
+
+import pylogg
+from polyai.server.admission import QueueFull, _percentile
+from polyai.server.generation.embedding import length_batches
+
+log = pylogg.New("batch")
+
+
+class _Item:
+    """ An item waiting for its result. """
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error : Exception = None
+        self.done = threading.Event()
+        self.submitted = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Run the submitted items in batches on a worker thread.
+
+    Args:
+        fn:             Function of a list of items returning the list of
+                        their results.
+        max_batch:      Max items per call of fn.
+        max_wait_ms:    Max time to wait for a batch to fill.
+        max_queue:      Max items waiting, more are rejected as QueueFull.
+        name:           Name of the worker thread.
+    """
+
+    def __init__(self, fn, max_batch : int = 16, max_wait_ms : float = 5.0,
+                 max_queue : int = 1024, name : str = "batch"):
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._thread : threading.Thread = None
+        self._stop = False
+
+        self._latencies = collections.deque(maxlen=1024)
+        self._sizes = collections.deque(maxlen=1024)
+        self.total_items = 0
+        self.total_batches = 0
+        self.total_rejected = 0
+        self.total_errors = 0
+        self.busy_time = 0.0            # seconds spent in fn
+        self._started = time.perf_counter()
+
+    def start(self) -> 'MicroBatcher':
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop = False
+                self._thread = threading.Thread(target=self._run,
+                                                name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Stop the worker after the items already submitted. Later submits
+        are rejected, until start() is called again.
+        """
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, item, timeout : float = None):
+        """ Run an item in the next batch and return its result. """
+        if self._thread is None and not self._stop:
+            self.start()
+
+        entry = _Item(item)
+        with self._cond:
+            if self._stop:
+                raise RuntimeError(f"{self.name} batcher is closed")
+            if len(self._queue) >= self.max_queue:
+                self.total_rejected += 1
+                raise QueueFull("Too many requests waiting.", 1)
+            self._queue.append(entry)
+            self._cond.notify()
+
+        if not entry.done.wait(timeout):
+            raise TimeoutError("batch did not run in time")
+        self._latencies.append(time.perf_counter() - entry.submitted)
+        if entry.error is not None:
+            raise entry.error
+        return entry.result
+
+    def submit_many(self, items : list, timeout : float = None) -> list:
+        """
+        Run many items, e.g. of a bulk job, in the batches, and return their
+        results in order. Waits for room in the queue instead of rejecting.
+        """
+        if self._thread is None and not self._stop:
+            self.start()
+
+        entries = [_Item(item) for item in items]
+        with self._cond:
+            while not self._stop and self._queue and \
+                    len(self._queue) + len(entries) > self.max_queue:
+                self._cond.wait()
+            if self._stop:
+                raise RuntimeError(f"{self.name} batcher is closed")
+            self._queue.extend(entries)
+            self._cond.notify_all()
+
+        results = []
+        for entry in entries:
+            if not entry.done.wait(timeout):
+                raise TimeoutError("batch did not run in time")
+            self._latencies.append(time.perf_counter() - entry.submitted)
+            if entry.error is not None:
+                raise entry.error
+            results.append(entry.result)
+        return results
+
+    def _next_batch(self) -> list:
+        """ Wait for the first item, then for the batch to fill or max_wait. """
+        with self._cond:
+            while not self._queue and not self._stop:
+                self._cond.wait()
+            if not self._queue:
+                return []
+
+            deadline = self._queue[0].submitted + self.max_wait
+            while len(self._queue) < self.max_batch and not self._stop:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            n = min(self.max_batch, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(n)]
+            self._cond.notify_all()     # room for submit_many()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+
+            t0 = time.perf_counter()
+            try:
+                results = self.fn([entry.item for entry in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"{len(results)} results for "
+                                       f"{len(batch)} items")
+            except Exception as err:
+                log.error("Batch of {} failed: {}", len(batch), err)
+                self.total_errors += 1
+                for entry in batch:
+                    entry.error = err
+            else:
+                for entry, result in zip(batch, results):
+                    entry.result = result
+
+            self.busy_time += time.perf_counter() - t0
+            self.total_batches += 1
+            self.total_items += len(batch)
+            self._sizes.append(len(batch))
+            for entry in batch:
+                entry.done.set()
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        sizes = list(self._sizes)
+        elapsed = time.perf_counter() - self._started
+        return {
+            'waiting': len(self._queue),
+            'max_batch': self.max_batch,
+            'max_wait_ms': 1000 * self.max_wait,
+            'items': self.total_items,
+            'batches': self.total_batches,
+            'rejected': self.total_rejected,
+            'errors': self.total_errors,
+            'avg_batch_size': sum(sizes) / len(sizes) if sizes else 0.0,
+            'items_per_sec': self.total_items / elapsed if elapsed else 0.0,
+            'utilization': self.busy_time / elapsed if elapsed else 0.0,
+            'latency_p50_ms': 1000 * _percentile(latencies, 0.50),
+            'latency_p95_ms': 1000 * _percentile(latencies, 0.95),
+        }
+
+
+
+def by_length(fn, items : list, lengths : list, max_batch_tokens : int) -> list:
+    """
+    Call fn on groups of items of similar length, of at most
+    max_batch_tokens padded tokens each. Returns the results in order.
+    """
+    results = [None] * len(items)
+    for group in length_batches(lengths, max_batch_tokens):
+        for i, result in zip(group, fn([items[i] for i in group])):
+            results[i] = result
+    return results
@@ -35,6 +35,8 @@ class ORMBase(DeclarativeBase):
             session.execute(insert(self.__class__), payload)
         except Exception as err:
             log.error("Insert ({}) - {}", self.__tablename__, err)
+            session.rollback()
+            raise
         if test:
             session.rollback()
             log.trace("Insert ({}) - rollback", self.__tablename__)
@@ -43,12 +45,17 @@ class ORMBase(DeclarativeBase):
             log.trace("Insert ({}) - ok", self.__tablename__)
 
     def update(self, session, newObj, *, test=False):
+        """ Update the record of self with the values of newObj. """
         values = newObj.serialize()
+        values.pop('id', None)
         try:
-            sql = update(self.__class__).where(self.id == newObj.id).values(**values)
-            self.session.execute(sql)
+            cls = self.__class__
+            sql = update(cls).where(cls.id == self.id).values(**values)
+            session.execute(sql)
         except Exception as err:
             log.error("Update ({}) - {}", self.__tablename__, err)
+            session.rollback()
+            raise
         if test:
             session.rollback()
             log.trace("Update ({}) - rollback", self.__tablename__)
@@ -62,31 +69,140 @@ class ORMBase(DeclarativeBase):
         Update the database by inserting or updating a record.
         Args:
             which dict:     The criteria to check if the record already exists.
+                            Its columns need a unique index.
             payload:        The object to insert to the table.
             name str:       Name or ID of the object, for logging purposes.
             update bool:    Whether to update the record if already exists.
-        """
 
-        table = self.__tablename__
-
-        # select existing record by "which" criteria
-        x = self.get_one(session, which)
+        On PostgreSQL and SQLite this is a single INSERT ... ON CONFLICT ...
+        RETURNING statement. Other databases select the record first.
+        """
+        cls = self.__class__
 
         # set the foreign keys
         payload.__dict__.update(which)
 
+        values = payload.serialize()
+        values.pop('id', None)
+
+        stmt = _upsert_stmt(session, cls, list(which), update, values.keys())
+        if stmt is None:
+            return self._upsert_select(session, which, payload, name,
+                                       update=update, test=test)
+
+        try:
+            x = session.scalars(
+                stmt.values(**values).returning(cls),
+                execution_options={'populate_existing': True}).one()
+        except Exception as err:
+            log.error("Upsert ({}) - {}", self.__tablename__, err)
+            session.rollback()
+            raise
+        if test:
+            session.rollback()
+            log.trace(f"{self.__tablename__} upsert rollback: {name}")
+        else:
+            session.commit()
+            log.trace(f"{self.__tablename__} upsert: {name}")
+        return x
+
+    def _upsert_select(self, session, which: dict, payload, name : str, *,
+                       update=False, test=False) -> 'ORMBase':
+        """ Upsert by selecting the existing record first. """
+        x = self.get_one(session, which)
+
         if x is None:
-            self.insert(session, test=test)
+            payload.insert(session, test=test)
             log.trace(f"{self.__tablename__} add: {name}")
         else:
             if update:
-                self.update(session, x, payload, test=test)
+                x.update(session, payload, test=test)
                 log.trace(f"{self.__tablename__} update: {name}")
             else:
                 log.trace(f"{self.__tablename__} ok: {name}")
 
         return self.get_one(session, which)
 
+    @classmethod
+    def bulk_upsert(cls, session, rows : list[dict], which : list[str], *,
+                    update=False, batch_size=5000, test=False) -> int:
+        """
+        Insert many records, and update or skip the existing ones.
+        Args:
+            rows list:      Dicts of the column values, all with the same keys.
+            which list:     Columns to check if a record already exists.
+                            They need a unique index.
+            update bool:    Whether to update the records that already exist.
+            batch_size int: Max records per INSERT statement.
+
+        The rows are written with multi-row INSERT ... ON CONFLICT statements
+        and committed once. Returns the number of rows written, i.e. without
+        the skipped ones.
+        """
+        if not rows:
+            return 0
+
+        stmt = _upsert_stmt(session, cls, which, update, rows[0].keys(),
+                            returning=False)
+        if stmt is None:
+            for row in rows:
+                obj = cls(**row)
+                obj._upsert_select(session, {k: row[k] for k in which}, obj,
+                                   row.get(which[0]), update=update, test=test)
+            return len(rows)
+
+        # Only the rows written are returned, not the skipped ones.
+        stmt = stmt.returning(*[cls.__table__.c[c] for c in which])
+        written = 0
+        try:
+            for i in range(0, len(rows), batch_size):
+                written += len(session.execute(stmt, rows[i:i + batch_size]).all())
+        except Exception as err:
+            log.error("Bulk upsert ({}) - {}", cls.__tablename__, err)
+            session.rollback()
+            raise
+        if test:
+            session.rollback()
+            log.trace("Bulk upsert ({}) - {} rollback", cls.__tablename__,
+                      len(rows))
+        else:
+            session.commit()
+            log.trace("Bulk upsert ({}) - {} of {} ok", cls.__tablename__,
+                      written, len(rows))
+        return written
+
+
+def _upsert_stmt(session, cls, which : list, update : bool, columns = None,
+                 returning = True):
+    """
+    INSERT ... ON CONFLICT statement of the table, or None if the dialect
+    does not support it. Without update, the existing records are skipped,
+    or "updated" with their own conflict values if they are to be returned,
+    since DO NOTHING returns no row for them.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+
+    stmt = dialect_insert(cls)
+    if not update and not returning:
+        return stmt.on_conflict_do_nothing(index_elements=which)
+
+    if columns is None:
+        columns = [c.name for c in cls.__table__.columns]
+    if update:
+        set_ = {c: stmt.excluded[c] for c in columns
+                if c not in which and c != 'id'}
+    else:
+        set_ = {}
+    if not set_:
+        set_ = {c: stmt.excluded[c] for c in which}
+    return stmt.on_conflict_do_update(index_elements=which, set_=set_)
+
 
 class APIRequest(ORMBase):
     """
@@ -133,7 +249,7 @@ class APIKey(ORMBase):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     date_added: Mapped[datetime] = mapped_column(DateTime(timezone=True))
-    apikey: Mapped[str] = mapped_column(VARCHAR(length=40))
+    apikey: Mapped[str] = mapped_column(VARCHAR(length=40), unique=True)
     name: Mapped[str] = mapped_column(VARCHAR(length=40))
     role: Mapped[int] = mapped_column(Integer, default=10)
     email: Mapped[Optional[str]] = mapped_column(VARCHAR(length=40))
@@ -153,6 +269,38 @@ class APIKey(ORMBase):
             self.organization = self.name
 
 
+# Unique indexes the upserts need as ON CONFLICT targets, for tables made
+# before the columns were declared unique.
+UNIQUE_INDEXES = {
+    'api_key_apikey_key': (APIKey.__tablename__, ['apikey']),
+}
+
+
+def create_indexes(en) -> list:
+    """
+    Create the missing UNIQUE_INDEXES of the existing tables.
+    Raises if a table has duplicate values in the columns.
+    Returns the names of the indexes created.
+    """
+    from sqlalchemy import Index, inspect
+
+    insp = inspect(en)
+    created = []
+    for name, (table, columns) in UNIQUE_INDEXES.items():
+        if not insp.has_table(table):
+            continue  # create_all() makes it with the index
+        unique = [c['column_names'] for c in insp.get_unique_constraints(table)]
+        unique += [i['column_names'] for i in insp.get_indexes(table)
+                   if i['unique']]
+        if columns in unique:
+            continue
+        cols = [ORMBase.metadata.tables[table].c[c] for c in columns]
+        Index(name, *cols, unique=True).create(en)
+        log.info("Created unique index {} on {}.", name, table)
+        created.append(name)
+    return created
+
+
 if __name__ == "__main__":
     # Run python polyai/server/orm.py to create the table(s).
 
@@ -166,4 +314,5 @@ if __name__ == "__main__":
 
     # Create all tables if not already created
     ORMBase.metadata.create_all(en)
+    create_indexes(en)
     print("Tables Created. Done!")
@@ -0,0 +1,213 @@
+""" Per API key rate limits.
+
+    Each key has two token buckets, one of requests and one of tokens, that
+    refill at the requests/s and tokens/s of its role and hold up to burst
+    seconds of them. A request takes one from the request bucket before it
+    runs. The tokens are only known when it is done, so the prompt and
+    completion tokens are charged afterwards, and the token bucket may go
+    into debt. The next request of the key is rejected until the debt is
+    paid back, with a Retry-After of the time that takes.
+
+    The limits of a role are the entry of the largest configured role that
+    is not above it. A rate of 0 is unlimited. The weight of the role is its
+    share of the model in the admission queue.
+"""
+import time
+import threading
+import collections
+
+from flask import g, jsonify, make_response, request
+
+import pylogg
+from polyai.server.admission import Overloaded
+
+log = pylogg.New("limit")
+
+# role: requests/s, tokens/s and the queue weight of the keys of the role.
+DEFAULT_LIMITS = {
+    0: {'requests': 0, 'tokens': 0, 'weight': 4},       # admins
+    10: {'requests': 0, 'tokens': 0, 'weight': 1},
+}
+
+
+class RateLimited(Overloaded):
+    """ The key exceeded its requests/s or tokens/s. """
+    status = 429
+
+
+class TokenBucket:
+    """ Refills at rate per second, up to capacity. Unlimited if rate is 0. """
+
+    def __init__(self, rate : float, capacity : float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.level = self.capacity
+        self._time = time.monotonic()
+
+    def _refill(self, now : float):
+        self.level = min(self.capacity,
+                         self.level + (now - self._time) * self.rate)
+        self._time = now
+
+    def take(self, amount : float, now : float) -> float:
+        """
+        Take amount if available. Returns 0 if taken, else the seconds
+        until it will be.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def charge(self, amount : float, now : float):
+        """ Take amount, going into debt if needed. """
+        if self.rate > 0:
+            self._refill(now)
+            self.level -= amount
+
+
+class RateLimiter:
+    """
+    Token buckets of the keys, by role.
+
+    Args:
+        limits:     Dict of role to dict of requests, tokens and weight.
+        burst:      Seconds of requests and tokens a bucket holds.
+        max_keys:   Max number of keys tracked, least recent are dropped.
+    """
+
+    def __init__(self, limits : dict = None, burst : float = 10.0,
+                 max_keys : int = 10000):
+        limits = limits or DEFAULT_LIMITS
+        self.limits = {int(role): dict(limit)
+                       for role, limit in sorted(limits.items(),
+                                                 key=lambda kv: int(kv[0]))}
+        self.burst = burst
+        self.max_keys = max_keys
+
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()   # key: (requests, tokens)
+
+        self.total_allowed = 0
+        self.total_limited = 0
+        self.total_tokens = 0
+
+    def limit(self, role : int) -> dict:
+        """ Limits of a role. """
+        found = None
+        for r, limit in self.limits.items():
+            if found is None or r <= (role or 0):
+                found = limit
+        return found
+
+    def weight(self, role : int) -> float:
+        return float(self.limit(role).get('weight', 1))
+
+    def _buckets_of(self, key : str, role : int) -> tuple:
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            limit = self.limit(role)
+            rps = float(limit.get('requests', 0))
+            tps = float(limit.get('tokens', 0))
+            buckets = (TokenBucket(rps, rps * self.burst),
+                       TokenBucket(tps, tps * self.burst))
+            self._buckets[key] = buckets
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return buckets
+
+    def check(self, key : str, role : int):
+        """ Take a request of the key. Raises RateLimited if over its limits. """
+        now = time.monotonic()
+        with self._lock:
+            requests, tokens = self._buckets_of(key, role)
+            wait = tokens.take(0, now)
+            if wait <= 0:
+                wait = requests.take(1, now)
+            if wait > 0:
+                self.total_limited += 1
+            else:
+                self.total_allowed += 1
+
+        if wait > 0:
+            log.info("Rate limited {}..., retry in {:.1f}s", str(key)[:8], wait)
+            raise RateLimited("Rate limit exceeded.", max(1, round(wait + 0.5)))
+
+    def charge(self, key : str, role : int, tokens : int):
+        """ Charge the prompt and completion tokens of a finished request. """
+        now = time.monotonic()
+        with self._lock:
+            self._buckets_of(key, role)[1].charge(tokens, now)
+            self.total_tokens += tokens
+
+    def stats(self) -> dict:
+        return {
+            'keys': len(self._buckets),
+            'allowed': self.total_allowed,
+            'limited': self.total_limited,
+            'tokens': self.total_tokens,
+        }
+
+
+# Limits of the keys, shared by the blueprints.
+limiter = RateLimiter()
+
+
+def init_limits(limits : dict = None, burst : float = 10.0) -> RateLimiter:
+    """ Replace the rate limiter with a configured one. """
+    global limiter
+    limiter = RateLimiter(limits, burst)
+    return limiter
+
+
+def protect(bp):
+    """
+    Check the rate limits of every request to a blueprint, after its API
+    key was checked, and answer 429 with a Retry-After if exceeded.
+    """
+    bp.before_request(_check)
+    return bp
+
+
+def caller(identity, remote_addr : str) -> tuple:
+    """ Bucket key and role of an authenticated identity, or of an address. """
+    if identity is not None:
+        return identity.apikey, identity.role
+    # Not authenticated, a made up Api-Key header would get a new bucket.
+    return remote_addr, max(limiter.limits)
+
+
+def _caller() -> tuple:
+    """ Key and role of the request. """
+    return caller(g.get('identity'), request.remote_addr)
+
+
+def _check():
+    if request.method == "OPTIONS":
+        return None
+    g.rate_key, g.rate_role = _caller()
+    try:
+        limiter.check(g.rate_key, g.rate_role)
+    except RateLimited as err:
+        resp = make_response(jsonify({
+            'error': {'message': str(err), 'type': 'rate_limited'}
+        }), err.status)
+        resp.headers['Retry-After'] = str(err.retry_after)
+        return resp
+    return None
+
+
+def share() -> dict:
+    """ Queue key and weight of the current request, see LLM.generate(). """
+    return {'key': g.rate_key, 'weight': limiter.weight(g.rate_role)}
+
+
+def charge(prompt_tokens : int, completion_tokens : int):
+    """ Charge the tokens used by the current request. """
+    limiter.charge(g.rate_key, g.rate_role,
+                   (prompt_tokens or 0) + (completion_tokens or 0))
@@ -0,0 +1,119 @@
+""" JSON serialization of the responses and the request records.
+
+    dumps() returns utf-8 bytes, made by orjson if it is installed, else by
+    the json module. A response is serialized once, and the same bytes are
+    sent as the HTTP body and kept in its request record as a Raw value,
+    which dumps(), the spool and the database engine write as is, instead
+    of serializing the response again.
+
+    orjson 3.9 or later embeds the Raw bytes with its Fragment type. The
+    json backend writes a placeholder string for each Raw value, and splices
+    the bytes in place of it, so neither re-parses the body.
+
+    The backend is chosen by use(), "auto" picks the fastest installed.
+"""
+import json
+import secrets
+from datetime import datetime
+
+import numpy as np
+
+import pylogg
+
+log = pylogg.New("json")
+
+try:
+    import orjson
+    if not hasattr(orjson, "Fragment"):
+        # Raw values need orjson.Fragment, from orjson 3.9.
+        log.warn("orjson {} is too old, using json.", orjson.__version__)
+        orjson = None
+except ImportError:
+    orjson = None
+
+BACKENDS = ("auto", "orjson", "json")
+
+# Name of the backend in use.
+backend = "orjson" if orjson is not None else "json"
+
+
+class Raw:
+    """ Serialized JSON bytes, embedded as is in the output of dumps(). """
+    __slots__ = ("data",)
+
+    def __init__(self, data : bytes):
+        self.data = data
+
+    def __repr__(self):
+        return f"Raw({len(self.data)} bytes)"
+
+
+def _default(value):
+    """ Types the json module and orjson do not handle. """
+    if isinstance(value, Raw):
+        return orjson.Fragment(value.data)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} "
+                    "is not JSON serializable")
+
+
+def _dumps_json(obj) -> bytes:
+    """ Serialize obj with the json module, splicing in the Raw values. """
+    raws = []
+    nonce = None
+
+    def default(value):
+        nonlocal nonce
+        if isinstance(value, Raw):
+            if nonce is None:
+                nonce = secrets.token_hex(8)
+            raws.append(value.data)
+            return f"__raw_{nonce}_{len(raws) - 1}__"
+        return _default(value)
+
+    data = json.dumps(obj, default=default, ensure_ascii=False).encode("utf-8")
+    for i, raw in enumerate(raws):
+        data = data.replace(f'"__raw_{nonce}_{i}__"'.encode(), raw, 1)
+    return data
+
+
+def use(name : str = "auto") -> str:
+    """ Select the backend by name. Returns the name of the one in use. """
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f"unknown json backend: {name}")
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    elif name == "orjson" and orjson is None:
+        log.warn("orjson 3.9 or later is not installed, using json.")
+        name = "json"
+    backend = name
+    return backend
+
+
+def dumps(obj) -> bytes:
+    """ Serialize obj to JSON bytes. """
+    if isinstance(obj, Raw):
+        return obj.data
+    if backend == "orjson":
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY |
+                                   orjson.OPT_NON_STR_KEYS)
+    return _dumps_json(obj)
+
+
+def dumps_str(obj) -> str:
+    """ Serialize obj to a JSON string, e.g. for a websocket text frame. """
+    return dumps(obj).decode("utf-8")
+
+
+def loads(data):
+    """ Parse JSON bytes or string. """
+    if backend == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,232 @@
+""" Append-only on-disk spool of records.
+
+    Records are appended as JSON lines to numbered segment files in the
+    spool directory. A new segment is started when the current one reaches
+    segment_bytes. Appending is a single write() under a lock, and sync()
+    fsyncs everything appended since the last call, so the caller decides
+    how many records share one fsync.
+
+    A reader consumes the records in order from a cursor (segment, byte
+    offset). The cursor is only persisted by commit(), after the records
+    are safely stored elsewhere, and segments behind it are deleted. After
+    a crash, reading resumes from the last commit, so records are delivered
+    at least once. A torn line at the end of the last segment is truncated
+    when the spool is opened.
+
+    Run python -m polyai.server.spool <directory> to load a spool, or a
+    JSONL spill file, into the database.
+"""
+import os
+import json
+import threading
+
+import pylogg
+from polyai.server import serializer
+
+log = pylogg.New("spool")
+
+SUFFIX = ".jsonl"
+CHECKPOINT = "checkpoint.json"
+
+
+class Spool:
+    """
+    Append-only JSONL spool in a directory.
+
+    Args:
+        directory:      Spool directory, created if needed.
+        segment_bytes:  Size at which a new segment file is started.
+    """
+
+    def __init__(self, directory : str, segment_bytes : int = 16 << 20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._fd : int = None
+        self._segment = 0           # segment being appended to
+        self._size = 0
+        self._dirty = False
+
+        self.total_appended = 0
+        self.total_synced = 0
+        self.total_committed = 0
+        self._unsynced = 0
+
+        segments = self.segments()
+        self._cursor = self._load_checkpoint(segments)
+        if segments:
+            self._repair(segments[-1])
+            self._open(segments[-1])
+        else:
+            self._open(self._cursor[0] or 1)
+
+        for seg in segments:
+            if seg < self._cursor[0]:
+                os.remove(self._path(seg))
+
+    def _path(self, segment : int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}{SUFFIX}")
+
+    def segments(self) -> list:
+        """ Numbers of the segment files, in order. """
+        return sorted(int(name[:-len(SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit())
+
+    def _load_checkpoint(self, segments : list) -> tuple:
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as fp:
+                cp = json.load(fp)
+            return cp['segment'], cp['offset']
+        except FileNotFoundError:
+            return (segments[0] if segments else 1), 0
+
+    def _repair(self, segment : int):
+        """ Truncate a partly written last line, left by a crash. """
+        path = self._path(segment)
+        with open(path, "rb+") as fp:
+            data = fp.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                log.warn("Truncating {} torn bytes of {}", len(data) - end, path)
+                fp.truncate(end)
+
+    def _open(self, segment : int):
+        self._fd = os.open(self._path(segment),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment = segment
+        self._size = os.fstat(self._fd).st_size
+
+    def append(self, record : dict):
+        """ Append a record. It is durable after the next sync(). """
+        line = serializer.dumps(record) + b"\n"
+        with self._lock:
+            if self._size >= self.segment_bytes:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._open(self._segment + 1)
+            os.write(self._fd, line)
+            self._size += len(line)
+            self._dirty = True
+            self._unsynced += 1
+            self.total_appended += 1
+
+    def unsynced(self) -> int:
+        """ Number of records appended since the last sync(). """
+        return self._unsynced
+
+    def sync(self):
+        """ fsync the records appended so far. """
+        with self._lock:
+            if not self._dirty:
+                return
+            fd, n = self._fd, self._unsynced
+            self._dirty = False
+            self._unsynced = 0
+        os.fsync(fd)
+        self.total_synced += n
+
+    def read(self, max_records : int):
+        """
+        Read up to max_records from the cursor. Returns the records and the
+        position after them, to be passed to commit().
+        """
+        segment, offset = self._cursor
+        records = []
+        while len(records) < max_records:
+            try:
+                with open(self._path(segment), "rb") as fp:
+                    fp.seek(offset)
+                    for line in fp:
+                        if not line.endswith(b"\n"):
+                            break       # still being written
+                        offset += len(line)
+                        records.append(serializer.loads(line))
+                        if len(records) >= max_records:
+                            break
+            except FileNotFoundError:
+                pass
+
+            if len(records) >= max_records or segment >= self._segment:
+                break
+            segment, offset = segment + 1, 0
+
+        return records, (segment, offset)
+
+    def commit(self, position : tuple):
+        """ Persist the cursor, and delete the segments fully behind it. """
+        segment, offset = position
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + ".tmp", "w") as fp:
+            json.dump({'segment': segment, 'offset': offset}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + ".tmp", path)
+
+        for seg in range(self._cursor[0], segment):
+            try:
+                os.remove(self._path(seg))
+            except FileNotFoundError:
+                pass
+        self._cursor = (segment, offset)
+
+    def pending_bytes(self) -> int:
+        """ Size of the records not committed yet. """
+        segment, offset = self._cursor
+        total = 0
+        for seg in self.segments():
+            if seg >= segment:
+                total += os.path.getsize(self._path(seg))
+        return max(0, total - offset)
+
+    def stats(self) -> dict:
+        return {
+            'segment': self._segment,
+            'cursor': list(self._cursor),
+            'pending_bytes': self.pending_bytes(),
+            'appended': self.total_appended,
+            'synced': self.total_synced,
+        }
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def replay_file(path : str, writer, batch_size : int = 1000) -> int:
+    """ Write the records of a JSONL file, e.g. a spill file. """
+    total = 0
+    with open(path) as fp:
+        batch = []
+        for line in fp:
+            if line.strip():
+                batch.append(serializer.loads(line))
+            if len(batch) >= batch_size:
+                total += writer.load(batch)
+                batch = []
+        if batch:
+            total += writer.load(batch)
+    return total
+
+
+if __name__ == "__main__":
+    import sys
+    import dotenv
+    from polyai.server.writer import RequestWriter
+
+    if len(sys.argv) != 2:
+        print("Usage: python -m polyai.server.spool <spool dir | spill file>")
+        sys.exit(1)
+
+    dotenv.load_dotenv()
+    target = sys.argv[1]
+    if os.path.isdir(target):
+        writer = RequestWriter(spool=Spool(target))
+        print("Loaded", writer.replay(), "records.")
+    else:
+        print("Loaded", replay_file(target, RequestWriter()), "records.")
@@ -1,4 +1,5 @@
 """ Global server states. """
+import contextlib
 import torch
 
 class Server:
@@ -28,11 +29,22 @@ class LLM:
     _is_ready : bool = False
     _stop_generation : bool = False
     _break_on_newline = False
+    _queue = None       # AdmissionQueue in front of generate() and stream()
 
     @classmethod
     def stop_generation(cls):
         cls._stop_generation = True
 
+    @classmethod
+    def concurrent(cls) -> bool:
+        """
+        Whether many requests may be in generate() or stream() at once. The
+        admission queue and the batch scheduler bound them, otherwise the
+        callers must take turns.
+        """
+        return cls._queue is not None or \
+            getattr(cls._loader, 'scheduler', None) is not None
+
     @classmethod
     def model_name(cls):
         return cls._model_name
@@ -59,9 +71,10 @@ class LLM:
         cls._loader.add_lora(lora_dir)
 
     @classmethod
-    def generate(cls, prompt, params = {}):
+    def generate(cls, prompt, params = {}, key = None, weight = 1.0):
         """
         Given a prompt message and generation params, generate response.
+        key and weight are the client and its share in the request queue.
         
         Returns:
             Name of the model,
@@ -70,24 +83,80 @@ class LLM:
             Total completion tokens,
             Total time elapsed in miliseconds.
         """
-        if not cls._is_ready:
+        if cls._model is None:
             raise ConnectionError("<model not ready>")
-        try:
-            return cls._loader.generate(prompt, params)
-        except:
-            raise
-        finally:
-            cls._is_ready = True
+        with cls._admit(prompt, params, key, weight):
+            if not cls._is_ready:
+                raise ConnectionError("<model not ready>")
+            try:
+                return cls._loader.generate(prompt, params)
+            except:
+                raise
+            finally:
+                cls._is_ready = True
 
     @classmethod
-    def stream(cls, prompt, params = {}):
+    def stream(cls, prompt, params = {}, key = None, weight = 1.0):
         """
         Given a prompt message and generation params, stream model response.
 
         """
-        if not cls._is_ready:
+        if cls._model is None:
             raise ConnectionError
-        yield from cls._loader.stream(prompt, params)
+        with cls._admit(prompt, params, key, weight):
+            if not cls._is_ready:
+                raise ConnectionError
+            try:
+                yield from cls._loader.stream(prompt, params)
+            finally:
+                # Also when the client went away mid stream.
+                cls._is_ready = True
+
+    @classmethod
+    def embed(cls, texts : list, pooling = "mean", normalize = True,
+              key = None, weight = 1.0):
+        """
+        Embed a list of texts with the pooled last hidden states.
+
+        Returns:
+            Name of the model,
+            List of embedding vectors,
+            Total input tokens,
+            Total time elapsed in miliseconds.
+        """
+        if cls._model is None:
+            raise ConnectionError("<model not ready>")
+        if cls._queue is None:
+            return cls._loader.embed(texts, pooling, normalize)
+
+        # Waits in the request queue like a prompt of all the texts.
+        tokens = sum(cls.encode(text).shape[-1] for text in texts)
+        with cls._queue.admit(tokens, None, key, weight):
+            return cls._loader.embed(texts, pooling, normalize)
+
+    @classmethod
+    def _admit(cls, prompt, params, key = None, weight = 1.0):
+        """
+        Wait in the request queue, if any, for a turn to generate. A
+        request takes up its prompt tokens and max_new_tokens. The optional
+        queue_timeout param (seconds) shortens the wait.
+        """
+        if cls._queue is None:
+            return contextlib.nullcontext()
+        max_tokens = cls.parameters(dict(params))['max_new_tokens']
+        tokens = cls.encode(prompt).shape[-1] + max_tokens
+        timeout = cls.get('queue_timeout', float, None, params)
+        return cls._queue.admit(tokens, timeout, key, weight)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """ Metrics of the request queue and the loader. """
+        stats = {}
+        if cls._queue is not None:
+            stats['queue'] = cls._queue.stats()
+        if cls._loader is not None and hasattr(cls._loader, 'stats'):
+            stats.update(cls._loader.stats())
+        return stats
 
     @classmethod
     def encode(cls, string, **kwargs):
@@ -154,7 +223,8 @@ class LLM:
             'ban_eos_token':                cls.get('ban_eos_token', bool, False, body),
             'skip_special_tokens':          cls.get('skip_special_tokens', bool, True, body),
             'custom_stopping_strings': '',  # leave this blank
-            'stopping_strings':             cls.get('stopping_strings', list, [], body),
+            'stopping_strings':             cls._stopping_strings(body),
+            'stopping_token_ids':           cls._stopping_token_ids(body),
         }
 
         preset_name = body.get('preset', 'None')
@@ -167,6 +237,31 @@ class LLM:
         return generate_params
 
 
+    @staticmethod
+    def _stopping_strings(body : dict) -> list:
+        """ Validated list of the stop strings of a request. """
+        strings = body.get('stopping_strings')
+        if strings is None:
+            return []
+        if type(strings) != list or any(type(s) != str for s in strings):
+            raise ValueError("stopping_strings must be a list of strings")
+        return strings
+
+    @staticmethod
+    def _stopping_token_ids(body : dict) -> list:
+        """ Validated list of the stop token ids or token id sequences. """
+        isint = lambda t: type(t) == int
+        ids = body.get('stopping_token_ids')
+        if ids is None:
+            return []
+        if type(ids) != list or not all(
+                isint(seq) or (type(seq) == list and all(map(isint, seq)))
+                for seq in ids):
+            raise ValueError("stopping_token_ids must be a list of token ids "
+                             "or lists of token ids")
+        return ids
+
+
 class BERT:
     _loader = None
     _model_name : str = None
@@ -191,4 +286,39 @@ class BERT:
             List of generated NER tags as a dict format,
             Total time elapsed in miliseconds.
         """
+        if cls._pipeline is None:
+            raise ConnectionError("<model not ready>")
         return cls._loader.ner_tags(text)
+
+    @classmethod
+    def ner_batch(cls, texts : list):
+        """
+        Perform NER on a list of texts, in batches.
+        Returns:
+            Model name,
+            List of the NER tags of each text,
+            Total time elapsed in miliseconds.
+        """
+        if cls._pipeline is None:
+            raise ConnectionError("<model not ready>")
+        return cls._loader.ner_batch(texts)
+
+    @classmethod
+    def embed(cls, texts : list, pooling = "mean", normalize = True):
+        """
+        Embed a list of texts with the pooled last hidden states.
+
+        Returns:
+            Name of the model,
+            List of embedding vectors,
+            Total input tokens,
+            Total time elapsed in miliseconds.
+        """
+        if cls._pipeline is None:
+            raise ConnectionError("<model not ready>")
+        return cls._loader.embed(texts, pooling, normalize)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """ NER batching metrics. """
+        return cls._loader.stats() if cls._loader is not None else {}
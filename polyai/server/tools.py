@@ -1,50 +1,66 @@
 import time
-import json
-from threading import Thread
-from polyai.server import database
-from polyai.server import orm
-
-
-def store(message, respObj, respheads, apiKey, url, method, reqheads):
-    """ Store api request and response info to database. """
-
-    def _background():
-        try:
-            db = database.connect()
-        except Exception as err:
-            return False
-
-        output = " || ".join([ch['message']['content']
-                                for ch in respObj['choices']])
-
-        if type(message) == dict:
-            reqtext = json.dumps(message)
-        else:
-            reqtext = message
-
-        apiReq = orm.APIRequest(
-            idStr = respObj['id'],
-            apikey = apiKey,
-            requrl = url,
-            reqmethod = method,
-            model = respObj['model'],
-            request = reqtext,
-            output = output,
-            response = respObj,
-            reqheaders = dict(reqheads),
-            respheaders = dict(respheads),
-            elapsed_msec = respObj['elapsed_msec'],
-            request_tokens = respObj['usage']['prompt_tokens'],
-            response_tokens = respObj['usage']['completion_tokens'],
-        )
-        apiReq.insert(db)
-        return True
-
-    Thread(target=_background).start()
+import secrets
+from polyai.server import orm, serializer
+from polyai.server.writer import RequestWriter
+from polyai.server.spool import Spool
+
+# Single background writer of the request records.
+writer = RequestWriter()
+
+
+def init_writer(max_queue = 10000, batch_size = 256, flush_interval = 1.0,
+                policy = "drop_newest", spill_file = "spill/api_request.jsonl",
+                spool_dir = None, engine = None) -> RequestWriter:
+    """
+    Replace the request writer with a configured one and start it. With a
+    spool_dir, the records are spooled to disk before they are written.
+    """
+    global writer
+    writer.close()
+    spool = Spool(spool_dir) if spool_dir else None
+    writer = RequestWriter(engine, max_queue, batch_size, flush_interval,
+                           policy, spill_file, spool)
+    return writer.start()
+
+
+def store(message, respObj, respheads, apiKey, url, method, reqheads,
+          body : bytes = None):
+    """
+    Queue api request and response info to be stored to database.
+    The body, if given, is respObj already serialized, e.g. as sent to the
+    client, and it is stored as is.
+    """
+
+    output = " || ".join([ch['message']['content']
+                            for ch in respObj['choices']])
+
+    if type(message) in (dict, list):
+        reqtext = serializer.dumps_str(message)
+    else:
+        reqtext = message
+
+    apiReq = orm.APIRequest(
+        idStr = respObj['id'],
+        apikey = apiKey,
+        requrl = url,
+        reqmethod = method,
+        model = respObj['model'],
+        request = reqtext,
+        output = output,
+        response = respObj if body is None else serializer.Raw(body),
+        reqheaders = dict(reqheads),
+        respheaders = dict(respheads),
+        elapsed_msec = respObj['elapsed_msec'],
+        request_tokens = respObj['usage']['prompt_tokens'],
+        response_tokens = respObj['usage']['completion_tokens'],
+    )
+    return writer.start().submit(apiReq.serialize())
 
 
 def create_idStr(prefix):
-    """ Use milliseconds to create a unique id. """
+    """
+    Use milliseconds and a random suffix to create a unique id, concurrent
+    requests may be made in the same millisecond.
+    """
     idStr = str(round(time.time() * 1000))
-    return prefix + "-" + idStr
-
+    return prefix + "-" + idStr + "-" + secrets.token_hex(4)
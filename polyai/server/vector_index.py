@@ -0,0 +1,537 @@
+""" Vector index for similarity search of the text embeddings.
+
+    The vectors are rows of a float32 matrix, scored by inner product, or
+    by cosine similarity, in which case they are normalized when added.
+    Two search modes:
+
+        exact   Batched matmul of the queries with all the rows, a block of
+                rows at a time, keeping the top k of each query.
+        approx  Inverted file (IVF). The rows are clustered around nlist
+                centroids with k-means, and a query is only scored against
+                the rows of its nprobe nearest centroids. The queries are
+                grouped by the lists they probe, so that each list is
+                scored against all of its queries with one matmul.
+
+    The centroids are trained on a sample of the rows the first time an
+    approx search is made, and again when the index has doubled since, on
+    a background thread. Searches are exact until the first training ends,
+    and use the old centroids meanwhile after that. Rows added in between
+    are assigned to the nearest centroid. Deleted and replaced rows are
+    masked out until compact() rewrites the index, which flush() does once
+    they are more than half of the rows.
+
+    With a directory, the matrix and the list assignments are memory mapped
+    files, and the adds and deletes are appended to a JSONL log, written by
+    flush() after the matrix is flushed. The log is replayed on open.
+"""
+import os
+import json
+import threading
+
+import numpy as np
+
+import pylogg
+
+log = pylogg.New("index")
+
+METRICS = ("cosine", "ip")
+LOG_FILE = "log.jsonl"
+META_FILE = "meta.json"
+
+
+def _top_k(scores : np.ndarray, rows : np.ndarray, k : int) -> tuple:
+    """ Top k scores of each row of scores [q, n], sorted, and their rows. """
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(rows, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return (np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(rows, order, axis=1))
+
+
+def _nearest(x : np.ndarray, centroids : np.ndarray,
+             block : int = 16384) -> np.ndarray:
+    """ Index of the centroid with the largest inner product with each row. """
+    out = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), block):
+        out[start:start + block] = \
+            np.argmax(x[start:start + block] @ centroids.T, axis=1)
+    return out
+
+
+def kmeans(x : np.ndarray, k : int, iters : int = 10,
+           spherical : bool = True, seed : int = 0) -> np.ndarray:
+    """ Centroids [k, dim] of the rows of x, by Lloyd's iterations. """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        # Sum the rows of each cluster, np.add.at is much slower.
+        order = np.argsort(assign, kind="stable")
+        used = np.flatnonzero(counts)
+        sums = np.zeros_like(centroids)
+        sums[used] = np.add.reduceat(x[order], np.cumsum(counts)[used] -
+                                     counts[used])
+
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        # Restart the empty clusters from random rows.
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+        if spherical:
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids.astype(np.float32)
+
+
+class VectorIndex:
+    """
+    Index of vectors with string ids, and optional texts.
+
+    Args:
+        directory:      Directory of the files, None to keep it in memory.
+        metric:         cosine or ip (inner product).
+        nlist:          Number of IVF lists, 0 for sqrt of the rows.
+        nprobe:         Number of lists searched by an approx search.
+        min_train:      Rows needed before an approx search trains the
+                        lists. Smaller indexes are always searched exactly.
+    """
+
+    def __init__(self, directory : str = None, metric : str = "cosine",
+                 nlist : int = 0, nprobe : int = 8, min_train : int = 10000):
+        if metric not in METRICS:
+            raise ValueError(f"unknown metric: {metric}")
+
+        self.directory = directory
+        self.metric = metric
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.info = {}                  # how the vectors were made
+
+        self.dim : int = None
+        self.count = 0                  # rows used, incl. deleted ones
+        self.capacity = 0
+        self._vectors : np.ndarray = None
+        self._assign : np.ndarray = None    # IVF list of each row, or -1
+        self._alive = np.zeros(0, dtype=bool)
+        self._ids = []                  # row: id, None if deleted
+        self._texts = []                # row: text, or None
+        self._rows = {}                 # id: row
+
+        self._centroids : np.ndarray = None
+        self._lists = []                # rows of each list
+        self._tails = []                # rows added to each list since
+        self._trained_count = 0
+        self._training : threading.Thread = None
+        self._generation = 0            # changed when rows are rewritten
+
+        self._pending = []              # log lines not written yet
+        self._lock = threading.RLock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _path(self, name : str) -> str:
+        return os.path.join(self.directory, name)
+
+    # ---- storage ----
+
+    def _allocate(self, capacity : int):
+        """ Grow the matrix and the assignments to capacity rows. """
+        old = self.count
+        if self.directory:
+            for name, dtype, width in (("vectors.f32", np.float32, self.dim),
+                                       ("assign.i32", np.int32, 1)):
+                arr = self._vectors if width > 1 else self._assign
+                if arr is not None:
+                    arr.flush()
+                size = capacity * width * np.dtype(dtype).itemsize
+                with open(self._path(name), "ab") as fp:
+                    if fp.tell() < size:
+                        fp.truncate(size)
+            self._vectors = np.memmap(self._path("vectors.f32"), np.float32,
+                                      "r+", shape=(capacity, self.dim))
+            self._assign = np.memmap(self._path("assign.i32"), np.int32,
+                                     "r+", shape=(capacity,))
+        else:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            assign = np.full(capacity, -1, dtype=np.int32)
+            if self._vectors is not None:
+                vectors[:old] = self._vectors[:old]
+                assign[:old] = self._assign[:old]
+            self._vectors, self._assign = vectors, assign
+
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:old] = self._alive[:old]
+        self._alive = alive
+        self.capacity = capacity
+
+    def _load(self):
+        try:
+            with open(self._path(META_FILE)) as fp:
+                meta = json.load(fp)
+        except FileNotFoundError:
+            return
+
+        self.dim = meta['dim']
+        self.metric = meta['metric']
+        self.info = meta.get('info', {})
+        self._trained_count = meta.get('trained_count', 0)
+        size = os.path.getsize(self._path("vectors.f32"))
+        self._allocate(max(1, size // (4 * self.dim)))
+
+        count = 0
+        if not os.path.exists(self._path(LOG_FILE)):
+            return
+        with open(self._path(LOG_FILE)) as fp:
+            for line in fp:
+                if not line.endswith("\n"):
+                    break               # torn by a crash
+                op = json.loads(line)
+                if op['op'] == 'add':
+                    self._delete(op['id'])
+                    row = op['row']
+                    self._ids.append(op['id'])
+                    self._texts.append(op.get('text'))
+                    self._rows[op['id']] = row
+                    self._alive[row] = True
+                    count = row + 1
+                elif op['op'] == 'del':
+                    self._delete(op['id'])
+        self.count = count
+
+        if os.path.exists(self._path("centroids.npy")):
+            self._centroids = np.load(self._path("centroids.npy"))
+            self._build_lists()
+        log.info("Loaded index of {} vectors from {}", len(self), self.directory)
+
+    def _write_meta(self):
+        meta = {
+            'dim': self.dim,
+            'metric': self.metric,
+            'info': self.info,
+            'trained_count': self._trained_count,
+        }
+        with open(self._path(META_FILE) + ".tmp", "w") as fp:
+            json.dump(meta, fp)
+        os.replace(self._path(META_FILE) + ".tmp", self._path(META_FILE))
+
+    def flush(self):
+        """
+        Write the added vectors, then log the adds and deletes. Compacts the
+        index instead if most of its rows are deleted.
+        """
+        with self._lock:
+            if 2 * len(self._rows) < self.count:
+                self.compact()
+                return
+            if not self.directory or self.dim is None:
+                return
+            self._vectors.flush()
+            self._assign.flush()
+            self._write_meta()
+            if self._pending:
+                with open(self._path(LOG_FILE), "a") as fp:
+                    fp.writelines(self._pending)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                self._pending = []
+
+    # ---- updates ----
+
+    def _prepare(self, vectors) -> np.ndarray:
+        x = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.dim is not None and x.shape[1] != self.dim:
+            raise ValueError(f"vectors must be of size {self.dim}")
+        if self.metric == "cosine":
+            x = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+        return x
+
+    def add(self, ids : list, vectors, texts : list = None):
+        """ Add or replace the vectors of the ids. """
+        if len(ids) != len(vectors):
+            raise ValueError("number of ids and vectors differ")
+        if len(set(ids)) != len(ids):
+            raise ValueError("duplicate ids")
+
+        with self._lock:
+            x = self._prepare(vectors)
+            if self.dim is None:
+                self.dim = x.shape[1]
+            if self.count + len(x) > self.capacity:
+                self._allocate(max(1024, 2 * (self.count + len(x))))
+
+            start, end = self.count, self.count + len(x)
+            self._vectors[start:end] = x
+            self._assign[start:end] = -1
+            if self._centroids is not None:
+                lists = _nearest(x, self._centroids)
+                self._assign[start:end] = lists
+                for row, l in zip(range(start, end), lists.tolist()):
+                    self._tails[l].append(row)
+
+            for i, id in enumerate(ids):
+                id = str(id)
+                text = texts[i] if texts else None
+                self._delete(id)
+                self._ids.append(id)
+                self._texts.append(text)
+                self._rows[id] = start + i
+                self._alive[start + i] = True
+                self._pending.append(json.dumps({
+                    'op': 'add', 'row': start + i, 'id': id, 'text': text}) + "\n")
+            self.count = end
+
+    def _delete(self, id : str) -> bool:
+        row = self._rows.pop(id, None)
+        if row is None:
+            return False
+        self._alive[row] = False
+        self._ids[row] = None
+        self._texts[row] = None
+        return True
+
+    def delete(self, ids : list) -> int:
+        """ Delete the vectors of the ids. Returns the number deleted. """
+        deleted = 0
+        with self._lock:
+            for id in ids:
+                if self._delete(str(id)):
+                    deleted += 1
+                    self._pending.append(json.dumps({'op': 'del', 'id': str(id)}) + "\n")
+        return deleted
+
+    def compact(self):
+        """ Rewrite the index without the deleted rows. """
+        with self._lock:
+            if self.dim is None:
+                return
+            live = np.flatnonzero(self._alive[:self.count])
+            ids = [self._ids[r] for r in live]
+            texts = [self._texts[r] for r in live]
+            vectors = np.array(self._vectors[live])
+            centroids = self._centroids
+
+            files = ["vectors.f32", "assign.i32", LOG_FILE, "centroids.npy"]
+            if not len(ids):
+                files.append(META_FILE)
+            if self.directory:
+                for name in files:
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+            self.count = self.capacity = 0
+            self._vectors = self._assign = None
+            self._alive = np.zeros(0, dtype=bool)
+            self._ids, self._texts, self._rows = [], [], {}
+            self._centroids, self._lists, self._tails = None, [], []
+            self._trained_count = 0
+            self._pending = []
+            self._generation += 1
+
+            if not len(ids):
+                # Nothing left, start again untrained.
+                self.dim = None
+                log.info("Compacted index to 0 vectors.")
+                return
+
+            self.metric, metric = "ip", self.metric   # already normalized
+            self.add(ids, vectors, texts)
+            self.metric = metric
+            if centroids is not None:
+                self._set_centroids(centroids)
+            self.flush()
+            log.info("Compacted index to {} vectors.", len(ids))
+
+    # ---- IVF ----
+
+    def _set_centroids(self, centroids : np.ndarray,
+                       assign : np.ndarray = None):
+        """ Use the centroids, assign being the lists of the first rows. """
+        done = 0 if assign is None else len(assign)
+        self._centroids = centroids
+        if done:
+            self._assign[:done] = assign
+        self._assign[done:self.count] = _nearest(
+            self._vectors[done:self.count], centroids)
+        self._build_lists()
+        self._trained_count = self.count
+        if self.directory:
+            np.save(self._path("centroids.npy"), centroids)
+
+    def _build_lists(self):
+        nlist = len(self._centroids)
+        assign = np.asarray(self._assign[:self.count])
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        self._lists = [order[bounds[l]:bounds[l + 1]] for l in range(nlist)]
+        self._tails = [[] for _ in range(nlist)]
+
+    def train(self, nlist : int = 0, sample : int = 0) -> bool:
+        """
+        Cluster the rows into nlist IVF lists. The k-means runs without the
+        lock, so searches and adds go on meanwhile. Returns False if the
+        rows were rewritten by compact() in the meantime.
+        """
+        with self._lock:
+            n = self.count
+            if n == 0:
+                return False
+            nlist = nlist or self.nlist or max(1, int(np.sqrt(n)))
+            nlist = min(nlist, n)
+            sample = sample or min(n, max(64 * nlist, 65536))
+            t1 = log.trace("Training {} lists on {} of {} vectors.",
+                           nlist, sample, n)
+            rows = np.sort(np.random.default_rng(0).choice(n, sample,
+                                                           replace=False))
+            x = np.asarray(self._vectors[rows])
+            # Rows below n are not changed by adds, only by compact().
+            vectors, generation = self._vectors, self._generation
+
+        centroids = kmeans(x, nlist, spherical=self.metric == "cosine")
+        assign = _nearest(vectors[:n], centroids)
+
+        with self._lock:
+            if generation != self._generation:
+                t1.done("Dropped {} lists, the index was compacted.", nlist)
+                return False
+            self._set_centroids(centroids, assign)
+            self.flush()
+            t1.done("Trained {} lists.", nlist)
+            return True
+
+    def _train_background(self):
+        """ Start training on a thread, unless already training. """
+        if self._training is not None and self._training.is_alive():
+            return
+        self._training = threading.Thread(target=self._train_safe,
+                                          name="index-train", daemon=True)
+        self._training.start()
+
+    def _train_safe(self):
+        try:
+            self.train()
+        except Exception as err:
+            log.error("Training the index failed: {}", err)
+
+    def _list(self, l : int) -> np.ndarray:
+        if self._tails[l]:
+            self._lists[l] = np.concatenate(
+                [self._lists[l], np.array(self._tails[l], dtype=np.int64)])
+            self._tails[l] = []
+        return self._lists[l]
+
+    # ---- search ----
+
+    def search(self, queries, k : int = 10, exact : bool = None,
+               nprobe : int = None) -> list:
+        """
+        Search the k nearest vectors of each query. Approximate if exact is
+        False, or None and the index is large enough. Returns a list per
+        query of (id, score, text) tuples, best first.
+        """
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        with self._lock:
+            if self.dim is None or not self._rows:
+                return [[] for _ in np.atleast_2d(queries)]
+            q = self._prepare(queries)
+            k = min(k, len(self._rows))
+
+            if exact is None:
+                exact = self.count < self.min_train
+            if not exact and (self._centroids is None or
+                              self.count > 2 * self._trained_count):
+                if self.count >= self.min_train:
+                    self._train_background()
+                if self._centroids is None or self.count < self.min_train:
+                    exact = True
+
+            if exact:
+                scores, rows = self._search_exact(q, k)
+            else:
+                scores, rows = self._search_ivf(q, k, nprobe or self.nprobe)
+
+            return [[(self._ids[r], float(s), self._texts[r])
+                     for s, r in zip(srow, rrow) if r >= 0]
+                    for srow, rrow in zip(scores.tolist(), rows.tolist())]
+
+    def _search_exact(self, q : np.ndarray, k : int) -> tuple:
+        nq = len(q)
+        best_s = np.full((nq, k), -np.inf, dtype=np.float32)
+        best_r = np.full((nq, k), -1, dtype=np.int64)
+        block = max(1024, (64 << 20) // (4 * nq))
+
+        for start in range(0, self.count, block):
+            end = min(start + block, self.count)
+            s = q @ self._vectors[start:end].T
+            s[:, ~self._alive[start:end]] = -np.inf
+            r = np.broadcast_to(np.arange(start, end), s.shape)
+            s, r = _top_k(s, r, k)
+            best_s, best_r = _top_k(np.hstack([best_s, s]),
+                                    np.hstack([best_r, r]), k)
+        best_r[np.isneginf(best_s)] = -1
+        return best_s, best_r
+
+    def _search_ivf(self, q : np.ndarray, k : int, nprobe : int) -> tuple:
+        nq = len(q)
+        nprobe = min(nprobe, len(self._centroids))
+        probe = _top_k(q @ self._centroids.T,
+                       np.broadcast_to(np.arange(len(self._centroids)),
+                                       (nq, len(self._centroids))),
+                       nprobe)[1]
+
+        # Queries of each list.
+        flat = probe.ravel()
+        order = np.argsort(flat, kind="stable")
+        bounds = np.searchsorted(flat[order], np.arange(len(self._centroids) + 1))
+
+        # Top k of each probed list of each query, merged at the end.
+        cand_s = np.full((nq, nprobe, k), -np.inf, dtype=np.float32)
+        cand_r = np.full((nq, nprobe, k), -1, dtype=np.int64)
+        for l in np.unique(flat).tolist():
+            rows = self._list(l)
+            rows = rows[self._alive[rows]]
+            if len(rows) == 0:
+                continue
+            slots = order[bounds[l]:bounds[l + 1]]
+            qs, js = slots // nprobe, slots % nprobe
+            s = q[qs] @ self._vectors[rows].T
+            s, r = _top_k(s, np.broadcast_to(rows, s.shape), k)
+            cand_s[qs, js, :s.shape[1]] = s
+            cand_r[qs, js, :r.shape[1]] = r
+
+        best_s, best_r = _top_k(cand_s.reshape(nq, -1),
+                                cand_r.reshape(nq, -1), k)
+        best_r[np.isneginf(best_s)] = -1
+        return best_s, best_r
+
+    def stats(self) -> dict:
+        return {
+            'vectors': len(self._rows),
+            'rows': self.count,
+            'dim': self.dim,
+            'metric': self.metric,
+            'lists': 0 if self._centroids is None else len(self._centroids),
+            'trained_count': self._trained_count,
+            'bytes': self.count * (self.dim or 0) * 4,
+            'info': self.info,
+        }
+
+
+# Index of the search endpoint.
+index = VectorIndex()
+
+
+def init_index(directory : str = None, nlist : int = 0,
+               nprobe : int = 8) -> VectorIndex:
+    """ Replace the search index with a configured one. """
+    global index
+    index.flush()
+    index = VectorIndex(directory, nlist=nlist, nprobe=nprobe)
+    return index
@@ -0,0 +1,328 @@
+""" Batched background writer of the API request records.
+
+    Records are put on a bounded in-memory queue by the request threads,
+    which never touch the database. A single long-lived thread takes them
+    off in batches, when batch_size records are waiting or flush_interval
+    seconds after the first one arrived, and writes each batch with one
+    multi-row INSERT and one commit. Records with an idStr already in the
+    table are skipped, so replaying records twice is harmless.
+
+    When the queue is full, the overflow policy decides what is lost:
+        drop_newest     the incoming record is dropped (default).
+        drop_oldest     the oldest queued record is dropped.
+        spill           the incoming record is appended to a JSONL file.
+    Batches that cannot be written are spilled with the spill policy, and
+    dropped otherwise.
+
+    With a spool, records are appended to the spool on disk instead, and
+    the writer thread loads them from there, so none are lost while the
+    database is down. Loading is retried with a backoff until it is back.
+    The memory queue is then only used if the spool cannot be written.
+"""
+import os
+import time
+import atexit
+import threading
+import collections
+from datetime import datetime
+
+from sqlalchemy import insert, DateTime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import pylogg
+from polyai.server import orm
+from polyai.server import serializer
+from polyai.server.spool import Spool
+
+log = pylogg.New("writer")
+
+POLICIES = ("drop_newest", "drop_oldest", "spill")
+MAX_RETRY_DELAY = 60
+
+_DATETIMES = [c.name for c in orm.APIRequest.__table__.columns
+              if isinstance(c.type, DateTime)]
+
+
+def _decode(record : dict) -> dict:
+    """ Parse the datetimes of a record read back from JSON. """
+    for name in _DATETIMES:
+        if isinstance(record.get(name), str):
+            record[name] = datetime.fromisoformat(record[name])
+    return record
+
+
+class RequestWriter:
+    """
+    Single writer thread of orm.APIRequest rows.
+
+    Args:
+        engine:         SQLAlchemy engine, database.engine() if None. It is
+                        only connected from the writer thread.
+        max_queue:      Max number of records waiting to be written.
+        batch_size:     Records written per INSERT.
+        flush_interval: Max seconds a record waits for a batch to fill up.
+        policy:         What to do when the queue is full, see POLICIES.
+        spill_file:     JSONL file of the spilled records.
+        spool:          Optional Spool the records go through.
+    """
+
+    def __init__(self, engine = None, max_queue : int = 10000,
+                 batch_size : int = 256, flush_interval : float = 1.0,
+                 policy : str = "drop_newest",
+                 spill_file : str = "spill/api_request.jsonl",
+                 spool : Spool = None):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy: {policy}")
+
+        self.engine = engine
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.spill_file = spill_file
+        self.spool = spool
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._thread : threading.Thread = None
+        self._stop = False
+        self._flush_times = collections.deque(maxlen=256)
+        self._spooled = 0           # appended since the writer woke up
+        self._retry_at = 0.0
+        self._retry_delay = 1.0
+
+        self.total_submitted = 0
+        self.total_written = 0
+        self.total_skipped = 0          # already written, by idStr
+        self.total_dropped = 0
+        self.total_spilled = 0
+        self.total_failed = 0
+        self.total_flushes = 0
+        self.last_batch_size = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stop = False
+            self._thread = threading.Thread(target=self._loop, daemon=True,
+                                            name="request-writer")
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def close(self, timeout : float = 10.0):
+        """ Write the queued records and stop the writer thread. """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+        if self.spool is not None:
+            self.spool.close()
+        atexit.unregister(self.close)
+        log.info("Request writer closed: {}", self.stats())
+
+    def backlog(self) -> int:
+        return len(self._queue)
+
+    def submit(self, record : dict) -> bool:
+        """
+        Queue a record, a dict of APIRequest columns, to be written. Never
+        blocks. Returns False if the record was dropped or spilled.
+        """
+        if self.spool is not None:
+            try:
+                self.spool.append(record)
+            except (OSError, TypeError, ValueError) as err:
+                log.error("Spool append failed: {}", err)
+            else:
+                with self._cond:
+                    self.total_submitted += 1
+                    self._spooled += 1
+                    if self._spooled == 1 or self._spooled >= self.batch_size:
+                        self._cond.notify()
+                return True
+
+        with self._cond:
+            self.total_submitted += 1
+            if len(self._queue) < self.max_queue:
+                self._queue.append(record)
+                if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                    self._cond.notify()
+                return True
+
+            if self.policy == "drop_oldest":
+                self._queue.popleft()
+                self._queue.append(record)
+                self.total_dropped += 1
+                return False
+
+            if self.policy == "drop_newest":
+                self.total_dropped += 1
+                return False
+
+        self._spill([record])
+        return False
+
+    def stats(self) -> dict:
+        times = sorted(self._flush_times)
+        return {
+            'backlog': len(self._queue),
+            'max_queue': self.max_queue,
+            'policy': self.policy,
+            'submitted': self.total_submitted,
+            'written': self.total_written,
+            'skipped': self.total_skipped,
+            'dropped': self.total_dropped,
+            'spilled': self.total_spilled,
+            'failed': self.total_failed,
+            'flushes': self.total_flushes,
+            'last_batch_size': self.last_batch_size,
+            'flush_avg_ms': 1000 * sum(times) / len(times) if times else 0.0,
+            'flush_p95_ms': 1000 * times[int(0.95 * (len(times) - 1))] \
+                            if times else 0.0,
+            'flush_max_ms': 1000 * times[-1] if times else 0.0,
+            'spool': self.spool.stats() if self.spool is not None else None,
+        }
+
+    def _next_batch(self) -> list:
+        """
+        Wait for a full batch, the flush interval, or close(). With a spool,
+        also wake up every flush_interval to retry loading it.
+        """
+        idle = None if self.spool is None else self.flush_interval
+        with self._cond:
+            deadline = None
+            while not self._stop and \
+                    len(self._queue) + self._spooled < self.batch_size:
+                if not self._queue and not self._spooled:
+                    if not self._cond.wait(idle):
+                        break
+                    continue
+
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            self._spooled = 0
+            n = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(n)]
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self.flush(batch)
+            if self.spool is not None:
+                self._load_spool()
+            if not batch and self._stop:
+                return
+
+    def flush(self, batch : list):
+        """ Write a batch of the memory queue, or give up on it. """
+        try:
+            self.load(batch)
+        except Exception as err:
+            log.error("Write of {} records failed: {}", len(batch), err)
+            self._failed(batch)
+
+    def load(self, batch : list) -> int:
+        """
+        Write a batch with a single INSERT. Records already in the table,
+        e.g. replayed after a crash, are skipped by their idStr. Raises if
+        the database is not available. Returns the number of records written.
+        """
+        t0 = time.time()
+        batch = [_decode(record) for record in batch]
+        if self.engine is None:
+            from polyai.server import database
+            self.engine = database.engine()
+
+        try:
+            with Session(self.engine) as session:
+                written = orm.APIRequest.bulk_upsert(
+                    session, batch, ['idStr'], batch_size=len(batch))
+
+        except IntegrityError as err:
+            log.warn("Bulk insert of {} records failed: {}", len(batch), err)
+            written = self._insert_each(batch)
+
+        if written < len(batch):
+            skipped = len(batch) - written
+            self.total_skipped += skipped
+            log.warn("Skipped {} of {} records, their idStr was already "
+                     "written.", skipped, len(batch))
+
+        self._flush_times.append(time.time() - t0)
+        self.total_flushes += 1
+        self.total_written += written
+        self.last_batch_size = len(batch)
+        log.trace("Wrote {} records in {:.1f} ms", written,
+                  1000 * (time.time() - t0))
+        return written
+
+    def replay(self) -> int:
+        """ Load the spooled records into the database. Returns the count. """
+        total = 0
+        while True:
+            records, position = self.spool.read(self.batch_size)
+            if not records:
+                return total
+            total += self.load(records)
+            self.spool.commit(position)
+
+    def _load_spool(self):
+        self.spool.sync()
+        if time.time() < self._retry_at:
+            return
+        try:
+            self.replay()
+            self._retry_delay = 1.0
+        except Exception as err:
+            log.error("DB unavailable, {} bytes spooled, retry in {}s: {}",
+                      self.spool.pending_bytes(), self._retry_delay, err)
+            self._retry_at = time.time() + self._retry_delay
+            self._retry_delay = min(2 * self._retry_delay, MAX_RETRY_DELAY)
+
+    def _insert_each(self, batch : list) -> int:
+        """
+        Write the records of a failed batch one at a time, so that a bad
+        record, e.g. a duplicate idStr, does not lose the others.
+        """
+        failed = []
+        with Session(self.engine) as session:
+            for record in batch:
+                try:
+                    with session.begin_nested():
+                        session.execute(insert(orm.APIRequest), [record])
+                except IntegrityError as err:
+                    log.error("Insert ({}) - {}", record.get('idStr'), err)
+                    failed.append(record)
+            session.commit()
+
+        self._failed(failed)
+        return len(batch) - len(failed)
+
+    def _failed(self, records : list):
+        self.total_failed += len(records)
+        if records and self.policy == "spill":
+            self._spill(records)
+
+    def _spill(self, records : list):
+        with self._spill_lock:
+            try:
+                os.makedirs(os.path.dirname(self.spill_file) or ".",
+                            exist_ok=True)
+                with open(self.spill_file, "ab") as fp:
+                    for record in records:
+                        fp.write(serializer.dumps(record) + b"\n")
+                self.total_spilled += len(records)
+            except OSError as err:
+                log.error("Spill of {} records failed: {}", len(records), err)
+                self.total_dropped += len(records)
@@ -2,7 +2,7 @@
     Settings are grouped by sections defined below.
 """
 import yaml
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -11,6 +11,16 @@ class text_generation:
     bot_fmt : str = "### Assistant:"
     instruction_fmt : str = ""
     context_length : int = 4096
+    max_batch_size : int = 1        # >1 to batch concurrent requests
+    prefix_cache_mb : int = 0       # VRAM budget to reuse prompt prefixes
+    num_draft_tokens : int = 4      # tokens proposed per speculative step
+    embed_batch_tokens : int = 4096 # padded tokens per embedding forward pass
+    embed_cache_dir : str = None    # keep the embeddings on disk, e.g. cache/embeddings
+    embed_cache_memory_mb : int = 64    # embeddings kept in memory
+    embed_cache_disk_mb : int = 1024    # embeddings kept on disk, per vector size
+    search_index_dir : str = None   # keep the search index on disk, e.g. cache/search
+    search_nlist : int = 0          # IVF lists of the search index, 0 for sqrt(n)
+    search_nprobe : int = 8         # IVF lists searched per approx query
 
 TextGen = text_generation()
 
@@ -18,9 +28,17 @@ TextGen = text_generation()
 class models:
     model_file_path : str = None
     lora_file_path : str = None
+    draft_file_path : str = None    # small model for speculative decoding
     bert_file_path : str = None
     vram_config : str = "8,10,10,10"
     bert_device : str = "cuda"
+    bert_batch_size : int = 16      # NER requests run in one batch
+    bert_batch_wait_ms : float = 5  # max wait for a NER batch to fill
+    bert_ner_words : str = "regex"  # NER word splitter: regex, whitespace, spacy
+    bert_ner_stride : int = 128     # tokens shared by the windows of long texts
+    bert_cpu_mode : str = "fp32"    # bert_device cpu: fp32, or int8 quantized
+    bert_cpu_threads : int = 0      # torch threads per process, 0 for default
+    bert_cpu_workers : int = 0      # NER worker processes, 0 to run in the server
 
 Model = models()
 
@@ -41,11 +59,32 @@ class server:
     stream_endpoint_port : int = 8002
     max_content_len : int = 10000
     use_ssl : bool = False
+    server_mode : str = "flask"     # flask (development), or asgi (uvicorn)
+    server_threads : int = 32       # asgi: requests handled at once, > queue_depth
+    keep_alive : int = 5            # asgi: seconds to keep idle connections open
+    drain_timeout : float = 30.0    # asgi: seconds to finish requests on shutdown
     listen_all : bool = False       # listen to 0.0.0.0
     log_level : int = 6
     debug : bool = False
     log_file_name : str = "polyai.log"
     log_append : bool = False
+    queue_depth : int = 16          # requests waiting for the model, or 429
+    queue_timeout : float = 60.0    # max seconds a request waits, 0 for no limit
+    queue_token_budget : int = 0    # prompt + max tokens running, 0 for batch x context
+    queue_depth_per_key : int = 0   # requests waiting per api key, 0 for queue_depth
+    require_api_key : bool = False  # reject requests without a valid Api-Key
+    key_cache_ttl : float = 300     # seconds a valid key is trusted
+    key_negative_ttl : float = 30   # seconds an invalid key is rejected
+    key_cache_size : int = 10000    # max keys kept in memory
+    key_refresh_interval : float = 60   # seconds between reloads of the keys
+    # Per role requests/s, tokens/s (0 for no limit) and share of the model.
+    # A key uses the entry of the largest role not above its own.
+    rate_limits : dict = field(default_factory=lambda: {
+        0: {'requests': 0, 'tokens': 0, 'weight': 4},
+        10: {'requests': 0, 'tokens': 0, 'weight': 1},
+    })
+    rate_burst : float = 10.0       # seconds of requests and tokens allowed at once
+    json_backend : str = "auto"     # auto, orjson or json
 
 Server = server()
 
@@ -58,6 +97,16 @@ class postgres_db:
     db_host : str = ""
     db_port : int = 5432
     db_name : str = "polyai"
+    pool_size : int = 5             # connections kept open
+    pool_overflow : int = 10        # extra connections under load
+    pool_pre_ping : bool = True     # test connections before use
+    pool_recycle : int = 1800       # seconds before a connection is replaced
+    write_queue : int = 10000       # api request records waiting to be written
+    write_batch : int = 256         # records written per INSERT
+    write_interval : float = 1.0    # max seconds between writes
+    write_overflow : str = "drop_newest"    # or drop_oldest, spill
+    spill_file : str = "spill/api_request.jsonl"
+    spool_dir : str = None          # spool records on disk while the db is down
 
 Postgres = postgres_db()
 
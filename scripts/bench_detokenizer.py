@@ -0,0 +1,114 @@
+""" Benchmark of the streaming detokenizer.
+
+    Streams a long generation through ExLlamaStreamDecoder and through the
+    previous approach of re-decoding the whole response on every token,
+    checks the streamed text against a single decode of all the tokens, and
+    reports the decode cost per token over the course of the generation.
+
+    Without --tokenizer, a small byte fallback SentencePiece model is
+    trained on the fly, on text with multi-byte characters so that partial
+    UTF-8 sequences are exercised.
+
+    Usage: python scripts/bench_detokenizer.py [--tokenizer tokenizer.model]
+"""
+import io
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import torch
+import sentencepiece as spm
+
+from polyai.server.exllama.tokenizer import ExLlamaTokenizer
+
+WORDS = ["the", "polymer", "glass", "transition", "temperature", "of",
+         "was", "measured", "at", "°C", "and", "µm", "thin", "films",
+         "naïve", "Tg", "≈", "150", "K", "in", "—", "\n", "(", ")", ",", "."]
+
+# Left out of the training text, so they decode through byte tokens.
+RARE = ["蛋白质", "結晶", "🙂"]
+
+
+def random_text(n_words, seed = 0, words = WORDS + RARE):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(words) for _ in range(n_words))
+
+
+def train_tokenizer(path):
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(random_text(50, i, WORDS) for i in range(2000)),
+        model_writer=model, vocab_size=300, byte_fallback=True,
+        minloglevel=2)
+    with open(path, "wb") as f:
+        f.write(model.getvalue())
+
+
+def full_decode(tokenizer, ids):
+    """ Previous approach: decode the whole response every token. """
+    res_line = ""
+    for n in range(1, len(ids) + 1):
+        prev = res_line
+        res_line = tokenizer.decode(torch.tensor(ids[:n]))
+        yield res_line[len(prev):]
+
+
+def incremental_decode(tokenizer, ids):
+    decoder = tokenizer.stream_decoder()
+    for tok in ids:
+        yield decoder.add(tok)
+
+
+def timed(gen, buckets, bucket_size):
+    out = []
+    t0 = time.perf_counter()
+    for i, text in enumerate(gen):
+        out.append(text)
+        if (i + 1) % bucket_size == 0:
+            t1 = time.perf_counter()
+            buckets.append((t1 - t0) / bucket_size)
+            t0 = t1
+    return "".join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default=None)
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--buckets", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.tokenizer
+        if path is None:
+            path = os.path.join(tmp, "tokenizer.model")
+            train_tokenizer(path)
+        tokenizer = ExLlamaTokenizer(path)
+
+    ids = []
+    seed = 0
+    while len(ids) < args.tokens:
+        ids += tokenizer.encode(random_text(200, 10_000 + seed))[0].tolist()
+        seed += 1
+    ids = ids[:args.tokens]
+
+    bucket_size = args.tokens // args.buckets
+    full, incr = [], []
+    text_full = timed(full_decode(tokenizer, ids), full, bucket_size)
+    text_incr = timed(incremental_decode(tokenizer, ids), incr, bucket_size)
+
+    # Re-decoding emits 0xfffd for characters split over byte tokens, which
+    # leaks into the joined deltas. The decoder holds them back instead.
+    ref = tokenizer.decode(torch.tensor(ids)).rstrip(chr(0xfffd))
+    print(f"{args.tokens} tokens, matches full decode: "
+          f"incremental {text_incr == ref}, re-decode {text_full == ref}")
+    print(f"{'tokens':>12} {'full us/tok':>12} {'incr us/tok':>12}")
+    for i, (f, n) in enumerate(zip(full, incr)):
+        span = f"{i * bucket_size}-{(i + 1) * bucket_size}"
+        print(f"{span:>12} {f * 1e6:>12.1f} {n * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
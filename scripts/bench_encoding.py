@@ -0,0 +1,65 @@
+""" Payload size and time to encode and decode embeddings, by encoding.
+
+    Encodes --batch random vectors of --dim as the /polyai/text/embedding
+    endpoint does, serializes the payload with json, and decodes it back
+    into a numpy array as polyai.api.helpers.embeddings() does.
+
+    Usage: python scripts/bench_encoding.py [--batch 32] [--dim 4096]
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+
+from polyai.api.helpers import embeddings
+from polyai.server.endpoints.openai import utils
+
+
+def timed(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - t0) / repeat * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    vectors = np.random.default_rng(0).standard_normal(
+        (args.batch, args.dim)).astype(np.float32)
+
+    print(f"{args.batch} x {args.dim} vectors")
+    print(f"{'encoding':>16} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+    for encoding_format, dtype in (("float", "float32"), ("base64", "float32"),
+                                   ("base64", "float16"), ("binary", "float32"),
+                                   ("binary", "float16")):
+        if encoding_format == "binary":
+            body, enc_ms = timed(
+                lambda: utils.little_endian(vectors, dtype).tobytes(),
+                args.repeat)
+            payload = {'encoding_format': 'binary', 'dtype': dtype,
+                       'shape': list(vectors.shape), 'embeddings': body}
+            decode = lambda: embeddings(payload)
+        else:
+            def encode():
+                payload = {'embeddings': utils.encode_vectors(
+                    vectors, encoding_format, dtype)}
+                if encoding_format != "float":
+                    payload['encoding_format'] = encoding_format
+                    payload['dtype'] = dtype
+                return json.dumps(payload)
+            body, enc_ms = timed(encode, args.repeat)
+            decode = lambda: embeddings(json.loads(body))
+
+        _, dec_ms = timed(decode, args.repeat)
+        print(f"{encoding_format + ' ' + dtype:>16} {len(body):>10} "
+              f"{enc_ms:>10.2f} {dec_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+""" Latency of an interactive client next to a bulk job, FIFO vs fair share.
+
+    A bulk client keeps --bulk requests of --bulk-tokens queued at all
+    times, while an interactive client sends one request of
+    --interactive-tokens at a time, with a pause in between. Requests are
+    served by an AdmissionQueue with --running slots, and take --ms-per-token
+    per token. With fifo, all requests share one key, i.e. arrival order.
+    With fair, each client has its own key.
+
+    Usage: python scripts/bench_fairness.py [--duration 10]
+"""
+import time
+import argparse
+import threading
+
+from polyai.server.admission import AdmissionQueue, Overloaded
+
+
+def serve(queue, key, weight, tokens, ms_per_token, stop_at, latencies,
+          pause = 0.0):
+    while time.time() < stop_at:
+        t0 = time.perf_counter()
+        try:
+            with queue.admit(tokens, key=key, weight=weight):
+                time.sleep(tokens * ms_per_token / 1000)
+        except Overloaded:
+            time.sleep(0.01)
+            continue
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(pause)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run(policy, args):
+    queue = AdmissionQueue(max_depth=args.bulk + 4, max_running=args.running,
+                           timeout=0)
+    stop_at = time.time() + args.duration
+    bulk, interactive = [], []
+    threads = [
+        threading.Thread(target=serve, args=(
+            queue, "bulk" if policy == "fair" else None, 1.0,
+            args.bulk_tokens, args.ms_per_token, stop_at, bulk))
+        for _ in range(args.bulk)
+    ]
+    threads.append(threading.Thread(target=serve, args=(
+        queue, "interactive" if policy == "fair" else None, 1.0,
+        args.interactive_tokens, args.ms_per_token, stop_at, interactive,
+        args.pause)))
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"{policy:>6} {len(interactive):>8} "
+          f"{percentile(interactive, 0.5) * 1e3:>8.0f} "
+          f"{percentile(interactive, 0.95) * 1e3:>8.0f} "
+          f"{len(bulk):>8} {len(bulk) * args.bulk_tokens / args.duration:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--running", type=int, default=2)
+    parser.add_argument("--bulk", type=int, default=16)
+    parser.add_argument("--bulk-tokens", type=int, default=512)
+    parser.add_argument("--interactive-tokens", type=int, default=64)
+    parser.add_argument("--ms-per-token", type=float, default=0.5)
+    parser.add_argument("--pause", type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f"{args.bulk} bulk requests queued, {args.running} running, "
+          f"{args.ms_per_token} ms/token")
+    print(f"{'policy':>6} {'interact':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'bulk':>8} {'bulk tok/s':>10}")
+    for policy in ("fifo", "fair"):
+        run(policy, args)
+
+
+if __name__ == "__main__":
+    main()
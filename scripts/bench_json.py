@@ -0,0 +1,81 @@
+""" Time to serialize a response and its request record, old vs new path.
+
+    old     Flask jsonify() of the payload for the body, then json.dumps()
+            of the request, and of the response again by the database
+            engine when the record is written.
+    json    serializer.dumps() once with the json backend, the body bytes
+            are stored as is.
+    orjson  Same with the orjson backend, if installed.
+
+    The payload is a chat completion with --choices replies of --words
+    words, and --tags NER tags.
+
+    Usage: python scripts/bench_json.py [--choices 8] [--tags 5000]
+"""
+import json
+import time
+import argparse
+
+from flask import Flask, jsonify
+
+from polyai.server import serializer
+from polyai.server.endpoints.openai import utils
+
+
+def payload(args):
+    text = " ".join(f"word{i}" for i in range(args.words))
+    choices = [utils.make_choice_dict(text, 'stop') for _ in range(args.choices)]
+    ner = [{'word': f"polymer{i}", 'entity_group': "POLYMER",
+            'score': 0.98765, 'start': i * 10, 'end': i * 10 + 9}
+           for i in range(args.tags)]
+    return utils.make_response_dict("chcmpl-1", 'chat.completions', "model",
+                                    1234, prompt_tok=100, compl_tok=500,
+                                    choices=choices, ner=ner)
+
+
+def old_path(request, response):
+    body = jsonify(response).get_data()
+    record = {'request': json.dumps(request), 'response': response}
+    stored = json.dumps(record['response'])
+    return len(body) + len(stored)
+
+
+def new_path(request, response):
+    body = serializer.dumps(response)
+    record = {'request': serializer.dumps_str(request),
+              'response': serializer.Raw(body)}
+    stored = serializer.dumps_str(record['response'])
+    return len(body) + len(stored)
+
+
+def timed(fn, repeat, *args):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - t0) / repeat * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--choices", type=int, default=8)
+    parser.add_argument("--words", type=int, default=500)
+    parser.add_argument("--tags", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    response = payload(args)
+    request = {'messages': [{'role': 'user', 'content': "x " * 1000}]}
+    print(f"payload of {len(json.dumps(response))} bytes")
+
+    with Flask(__name__).app_context():
+        print(f"{'path':>8} {'ms':>8}")
+        print(f"{'old':>8} {timed(old_path, args.repeat, request, response):>8.2f}")
+        for backend in ("json", "orjson"):
+            if serializer.use(backend) != backend:
+                continue
+            ms = timed(new_path, args.repeat, request, response)
+            print(f"{backend:>8} {ms:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
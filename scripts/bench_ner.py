@@ -0,0 +1,115 @@
+""" Throughput and latency of NER requests, one at a time vs micro-batched.
+
+    --clients threads send --requests NER requests in total to a HF token
+    classification pipeline, either called directly by each request, or
+    through a MicroBatcher as BERTModel.ner_tags() does. Without --model, a
+    tiny random BERT is made in a temporary directory, so this runs on CPU
+    with only transformers installed.
+
+    Usage: python scripts/bench_ner.py [--model dir] [--clients 16]
+"""
+import time
+import string
+import argparse
+import tempfile
+import threading
+
+from polyai.server.admission import _percentile
+from polyai.server.microbatch import MicroBatcher, by_length
+
+
+def tiny_model(directory, hidden = 128, layers = 2):
+    """ Save a random BERT token classifier of the given size to directory. """
+    import torch
+    from transformers import (BertConfig, BertForTokenClassification,
+                              BertTokenizerFast)
+    words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    words += list(string.ascii_lowercase + string.digits + string.punctuation)
+    words += ["##" + c for c in string.ascii_lowercase + string.digits]
+    with open(f"{directory}/vocab.txt", "w") as fp:
+        fp.write("\n".join(words))
+    tokenizer = BertTokenizerFast(f"{directory}/vocab.txt")
+    labels = ["O", "B-POLYMER", "I-POLYMER", "B-PROP", "I-PROP"]
+    config = BertConfig(vocab_size=len(words), hidden_size=hidden,
+                        num_hidden_layers=layers,
+                        num_attention_heads=max(2, hidden // 64),
+                        intermediate_size=2 * hidden,
+                        id2label=dict(enumerate(labels)),
+                        label2id={l: i for i, l in enumerate(labels)})
+    torch.manual_seed(0)
+    BertForTokenClassification(config).save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+
+
+def run(ner, texts, clients):
+    """ Send the texts from clients threads. Returns req/s and latencies. """
+    latencies = []
+    pending = iter(texts)
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                text = next(pending, None)
+            if text is None:
+                return
+            t0 = time.perf_counter()
+            ner(text)
+            latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(texts) / (time.perf_counter() - t0), sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--wait-ms", type=float, default=5.0)
+    parser.add_argument("--batch-tokens", type=int, default=4096)
+    parser.add_argument("--spread", type=int, default=8,
+                        help="texts are 1 to spread sentences long")
+    args = parser.parse_args()
+
+    from transformers import pipeline
+
+    directory = args.model
+    if directory is None:
+        directory = tempfile.mkdtemp()
+        tiny_model(directory)
+
+    pipe = pipeline(task="ner", model=directory, tokenizer=directory,
+                    aggregation_strategy="simple", device=args.device)
+    sentence = "poly(methyl methacrylate) has a tg of 105 c. "
+    texts = [sentence * (1 + i % args.spread) for i in range(args.requests)]
+
+    def ner_batch(batch):
+        # As BERTModel._ner_batch()
+        lengths = [len(ids) for ids in
+                   pipe.tokenizer(batch, truncation=True)['input_ids']]
+        return by_length(lambda group: pipe(group, batch_size=len(group)),
+                         batch, lengths, args.batch_tokens)
+
+    batcher = MicroBatcher(ner_batch, args.batch, args.wait_ms,
+                           name="bench-ner")
+
+    print(f"{args.requests} requests from {args.clients} clients")
+    print(f"{'mode':>10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for mode, ner in (("single", pipe), ("batched", batcher.submit)):
+        rps, latencies = run(ner, texts, args.clients)
+        print(f"{mode:>10} {rps:>8.1f} {1000 * _percentile(latencies, 0.5):>8.1f} "
+              f"{1000 * _percentile(latencies, 0.95):>8.1f}")
+    print(f"avg batch size {batcher.stats()['avg_batch_size']:.1f}")
+    batcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+""" Per document latency of the NER word labels, with and without spaCy.
+
+    The texts are run once through a HF token classification pipeline, then
+    the entities are aligned to the words of each text by every splitter
+    of ner_align. The spacy splitter runs the en_core_web_sm pipeline, or
+    if it is not installed, the tokenizer of a blank English pipeline,
+    which is a lower bound of the cost. Without --model, a tiny random BERT
+    is made in a temporary directory, as in bench_ner.py.
+
+    Usage: python scripts/bench_ner_align.py [--model dir] [--docs 200]
+"""
+import time
+import argparse
+import tempfile
+
+from bench_ner import tiny_model
+from polyai.server.generation import ner_align
+
+
+def spacy_pipeline():
+    """ The spaCy pipeline for the spacy words, and its name. """
+    try:
+        import spacy
+    except ImportError:
+        return None, "not installed"
+    try:
+        return spacy.load("en_core_web_sm"), "en_core_web_sm"
+    except OSError:
+        return spacy.blank("en"), "blank en tokenizer"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--sentences", type=int, default=8,
+                        help="sentences per document")
+    args = parser.parse_args()
+
+    from transformers import pipeline
+
+    directory = args.model
+    if directory is None:
+        directory = tempfile.mkdtemp()
+        tiny_model(directory)
+
+    pipe = pipeline(task="ner", model=directory, tokenizer=directory,
+                    aggregation_strategy="simple", device=args.device)
+    sentence = "poly(methyl methacrylate) has a tg of 105 c.\tpmma is clear.\n"
+    texts = [sentence * args.sentences] * args.docs
+
+    t0 = time.perf_counter()
+    entities = [pipe(text) for text in texts]
+    model_ms = (time.perf_counter() - t0) / args.docs * 1e3
+
+    nlp, name = spacy_pipeline()
+    print(f"{args.docs} documents of {len(texts[0])} characters, "
+          f"spacy: {name}")
+    print(f"{'words':>12} {'align ms':>10} {'total ms':>10}")
+    for words in ner_align.WORDS:
+        if words == "spacy" and nlp is None:
+            continue
+        t0 = time.perf_counter()
+        for output, text in zip(entities, texts):
+            ner_align.ner_words(output, text, words, nlp)
+        ms = (time.perf_counter() - t0) / args.docs * 1e3
+        print(f"{words:>12} {ms:>10.3f} {model_ms + ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
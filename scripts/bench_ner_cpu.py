@@ -0,0 +1,97 @@
+""" Throughput and accuracy of the CPU NER modes against fp32.
+
+    Each mode of ner_cpu runs the same documents in batches of --batch,
+    in the server process, and with --workers processes if given. The
+    entities of each mode are compared to those of fp32:
+        words   share of the words given the same label.
+        f1      F1 of the exact (start, end, entity_group) entities.
+
+    Without --model, a random BERT of --layers and --hidden is made in a
+    temporary directory. Its predictions are close to ties, so the parity
+    of a trained model is expected to be higher than shown.
+
+    Usage: python scripts/bench_ner_cpu.py [--model dir] [--workers 2]
+"""
+import time
+import argparse
+import tempfile
+
+from bench_ner import tiny_model
+from polyai.server.generation import ner_align, ner_cpu, ner_window
+
+
+def run(ner, texts, batch):
+    """ Entities of the texts and docs/s. """
+    t0 = time.perf_counter()
+    entities = []
+    for i in range(0, len(texts), batch):
+        entities += ner(texts[i:i + batch])
+    return entities, len(texts) / (time.perf_counter() - t0)
+
+
+def parity(texts, expected, entities):
+    """ Word label agreement and entity F1 against the expected entities. """
+    same = words = 0
+    true = found = hits = 0
+    for text, exp, got in zip(texts, expected, entities):
+        a = ner_align.ner_words(exp, text)
+        b = ner_align.ner_words(got, text)
+        same += sum(x.label == y.label for x, y in zip(a, b))
+        words += len(a)
+        exp = {(e['start'], e['end'], e['entity_group']) for e in exp}
+        got = {(e['start'], e['end'], e['entity_group']) for e in got}
+        true += len(exp)
+        found += len(got)
+        hits += len(exp & got)
+    f1 = 2 * hits / (true + found) if true + found else 1.0
+    return same / words if words else 1.0, f1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--hidden", type=int, default=768)
+    parser.add_argument("--docs", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--stride", type=int, default=128)
+    parser.add_argument("--batch-tokens", type=int, default=4096)
+    args = parser.parse_args()
+
+    directory = args.model
+    if directory is None:
+        directory = tempfile.mkdtemp()
+        tiny_model(directory, args.hidden, args.layers)
+
+    sentence = "poly(methyl methacrylate) has a tg of 105 c and is clear. "
+    texts = [sentence * (1 + i % 4) for i in range(args.docs)]
+    ner_cpu.set_threads(args.threads)
+
+    print(f"{args.docs} documents, batches of {args.batch}")
+    print(f"{'mode':>12} {'docs/s':>8} {'words':>8} {'f1':>8}")
+    expected = None
+    for mode in ner_cpu.MODES:
+        pipe = ner_cpu.load_pipeline(directory, "cpu", mode)
+        ner = lambda batch: ner_window.ner(pipe, batch, args.stride,
+                                           args.batch_tokens)
+        run(ner, texts[:args.batch], args.batch)  # warm up
+        entities, rate = run(ner, texts, args.batch)
+        expected = expected or entities
+        words, f1 = parity(texts, expected, entities)
+        print(f"{mode:>12} {rate:>8.1f} {words:>8.3f} {f1:>8.3f}")
+
+        if args.workers > 0:
+            workers = ner_cpu.Workers(directory, args.workers, mode,
+                                      args.threads, args.stride,
+                                      args.batch_tokens)
+            entities, rate = run(workers.ner, texts, args.batch)
+            workers.close()
+            words, f1 = parity(texts, expected, entities)
+            name = f"{mode} x{args.workers}"
+            print(f"{name:>12} {rate:>8.1f} {words:>8.3f} {f1:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
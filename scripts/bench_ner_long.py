@@ -0,0 +1,69 @@
+""" NER of long documents, split by the client vs windowed by the server.
+
+    split       The document is split into pieces that fit the model, and
+                each piece is one pipeline call, as clients had to do.
+    windows     ner_window.ner() on the whole document, the windows of all
+                the documents batched into padded passes of --batch-tokens.
+
+    A page is taken as 500 words. Without --model, a tiny random BERT is
+    made in a temporary directory, as in bench_ner.py.
+
+    Usage: python scripts/bench_ner_long.py [--model dir] [--pages 10]
+"""
+import time
+import argparse
+import tempfile
+
+from bench_ner import tiny_model
+from polyai.server.generation import ner_window
+
+
+def split(pipe, texts):
+    for text in texts:
+        enc = pipe.tokenizer(text, truncation=True,
+                             return_overflowing_tokens=True,
+                             return_offsets_mapping=True)
+        for offsets in enc['offset_mapping']:
+            spans = [span for span in offsets if span[1] > span[0]]
+            pipe(text[spans[0][0]:spans[-1][1]])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--docs", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--stride", type=int, default=128)
+    parser.add_argument("--batch-tokens", type=int, default=4096)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer, pipeline
+
+    directory = args.model
+    if directory is None:
+        directory = tempfile.mkdtemp()
+        tiny_model(directory)
+
+    # As BERTModel.load_model()
+    tokenizer = AutoTokenizer.from_pretrained(directory, model_max_length=512)
+    pipe = pipeline(task="ner", model=directory, tokenizer=tokenizer,
+                    aggregation_strategy="simple", device=args.device)
+    sentence = "poly(methyl methacrylate) has a tg of 105 c and is clear. "
+    words = 500 * args.pages
+    texts = [sentence * (words // len(sentence.split()))] * args.docs
+    tokens = len(pipe.tokenizer(texts[0])['input_ids'])
+    print(f"{args.docs} documents of {args.pages} pages, {tokens} tokens each")
+
+    print(f"{'mode':>8} {'s/doc':>8}")
+    t0 = time.perf_counter()
+    split(pipe, texts)
+    print(f"{'split':>8} {(time.perf_counter() - t0) / args.docs:>8.2f}")
+
+    t0 = time.perf_counter()
+    ner_window.ner(pipe, texts, args.stride, args.batch_tokens)
+    print(f"{'windows':>8} {(time.perf_counter() - t0) / args.docs:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+""" Micro-benchmark of the token sampler.
+
+    Compares the per token loop of the previous ExLlamaGenerator.sample()
+    with the tensorized polyai.server.generation.sampling.sample_batch(),
+    checks that both sample the same tokens for the same seed, and reports
+    the time per decode step.
+
+    Usage: python scripts/bench_sampler.py [--device cuda] [--vocab 32000]
+"""
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from polyai.server.generation.sampling import sample_batch
+
+
+def legacy_sample(logits, temperature, top_k, top_p, min_p, typical):
+    """ The previous ExLlamaGenerator.sample() for a single row. """
+    logits = logits.clone()
+    logits /= temperature
+    logits += 1e-8
+    probs = torch.softmax(logits, dim = -1)
+
+    if top_k == 0:
+        top_probs, top_indices = torch.sort(probs, descending = True)
+    else:
+        top_probs, top_indices = torch.topk(probs, top_k)
+        top_probs = F.normalize(top_probs, p = 1, dim = -1)
+
+    if top_p > 0.0:
+        num_top_p_probs = 0
+        cum_prob = top_probs[0].item()
+        while True:
+            num_top_p_probs += 1
+            if num_top_p_probs == top_probs.shape[-1]: break
+            if top_probs[num_top_p_probs].item() < min_p: break
+            cum_prob += top_probs[num_top_p_probs].item()
+            if cum_prob > top_p: break
+
+        top_probs = top_probs[:num_top_p_probs]
+        top_probs = F.normalize(top_probs, p = 1, dim = -1)
+        top_indices = top_indices[:num_top_p_probs]
+
+    if typical > 0.0:
+        epsilon = 1e-10
+        log_probs = (top_probs + epsilon).log()
+        neg_entropy = (top_probs * log_probs).sum()
+        entropy_dev = (neg_entropy - log_probs).abs()
+        _, entropy_dev_order = torch.sort(entropy_dev)
+
+        top_probs = top_probs.gather(-1, entropy_dev_order)
+        top_indices = top_indices.gather(-1, entropy_dev_order)
+
+        num_typical_probs = 0
+        cum_prob = top_probs[0].item()
+        while True:
+            num_typical_probs += 1
+            if num_typical_probs == top_probs.shape[-1]: break
+            cum_prob += top_probs[num_typical_probs].item()
+            if cum_prob > typical: break
+
+        top_probs = top_probs[:num_typical_probs]
+        top_probs = F.normalize(top_probs, p = 1, dim = -1)
+        top_indices = top_indices[:num_typical_probs]
+
+    sampled_ind = torch.multinomial(top_probs, 1)
+    return top_indices[sampled_ind], top_probs[sampled_ind]
+
+
+SETTINGS = [
+    # temperature, top_k, top_p, min_p, typical
+    (0.95, 40, 0.65, 0.0, 0.0),
+    (0.7, 0, 0.95, 0.0, 0.0),
+    (0.5, 0, 0.9, 0.001, 0.0),
+    (1.0, 100, 0.9, 0.0, 0.8),
+]
+
+
+def sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def check_parity(vocab, device, trials):
+    mismatch = 0
+    for t in range(trials):
+        setting = SETTINGS[t % len(SETTINGS)]
+        logits = torch.randn(vocab, device=device) * 4
+
+        torch.manual_seed(t)
+        a, _ = legacy_sample(logits, *setting)
+        torch.manual_seed(t)
+        b, _ = sample_batch(logits.unsqueeze(0), *setting)
+        mismatch += int(a.item() != b.item())
+    return mismatch
+
+
+def bench(fn, device, steps):
+    fn()
+    sync(device)
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    sync(device)
+    return (time.perf_counter() - t0) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--vocab", type=int, default=32000)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--trials", type=int, default=200)
+    args = parser.parse_args()
+
+    mismatch = check_parity(args.vocab, args.device, args.trials)
+    print(f"Parity: {args.trials - mismatch}/{args.trials} identical tokens")
+
+    print(f"{'setting':>32} {'batch':>6} {'loop ms':>9} {'batched ms':>11} {'speedup':>8}")
+    for setting in SETTINGS:
+        for batch in (1, 8, 32):
+            logits = torch.randn(batch, args.vocab, device=args.device) * 4
+
+            def loop():
+                for i in range(batch):
+                    legacy_sample(logits[i], *setting)
+
+            def batched():
+                sample_batch(logits, *setting)
+
+            t_loop = bench(loop, args.device, args.steps)
+            t_batched = bench(batched, args.device, args.steps)
+            print(f"{str(setting):>32} {batch:>6} {t_loop * 1e3:>9.3f} "
+                  f"{t_batched * 1e3:>11.3f} {t_loop / t_batched:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
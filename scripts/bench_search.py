@@ -0,0 +1,83 @@
+""" Recall and queries/s of the search index, exact vs IVF.
+
+    Makes --n synthetic vectors of --dim around --clusters random centers,
+    with gaussian --noise, and --queries held out ones, adds them to a
+    VectorIndex, and searches the top --k of the queries in batches of
+    --batch. The exact results are
+    the ground truth of the recall@k of the IVF search at each nprobe.
+
+    Usage: python scripts/bench_search.py [--n 1000000] [--dir /tmp/index]
+"""
+import time
+import argparse
+
+import numpy as np
+
+from polyai.server.vector_index import VectorIndex
+
+
+def synthetic(n, dim, clusters, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, 100000):
+        end = min(start + 100000, n)
+        x[start:end] = centers[rng.integers(0, clusters, end - start)]
+        x[start:end] += rng.standard_normal((end - start, dim)) * noise
+    return x
+
+
+def search(index, queries, k, batch, **kwargs):
+    t0 = time.perf_counter()
+    results = []
+    for start in range(0, len(queries), batch):
+        results += index.search(queries[start:start + batch], k, **kwargs)
+    qps = len(queries) / (time.perf_counter() - t0)
+    return [{id for id, _, _ in found} for found in results], qps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--clusters", type=int, default=2000)
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--dir", default=None, help="memory map the index here")
+    args = parser.parse_args()
+
+    x = synthetic(args.n + args.queries, args.dim, args.clusters, args.noise)
+    queries, x = x[:args.queries], x[args.queries:]
+
+    index = VectorIndex(args.dir, nlist=args.nlist)
+    t0 = time.perf_counter()
+    for start in range(0, len(x), 100000):
+        end = min(start + 100000, len(x))
+        index.add([str(i) for i in range(start, end)], x[start:end])
+    index.flush()
+    print(f"Added {len(x)} x {args.dim} vectors in "
+          f"{time.perf_counter() - t0:.1f} s")
+
+    t0 = time.perf_counter()
+    index.train(args.nlist)
+    print(f"Trained {index.stats()['lists']} lists in "
+          f"{time.perf_counter() - t0:.1f} s")
+    del x
+
+    truth, qps = search(index, queries, args.k, args.batch, exact=True)
+    print(f"{'mode':>8} {'nprobe':>6} {'recall':>7} {'qps':>8}")
+    print(f"{'exact':>8} {'-':>6} {1.0:>7.3f} {qps:>8.0f}")
+    for nprobe in args.nprobe:
+        found, qps = search(index, queries, args.k, args.batch,
+                            exact=False, nprobe=nprobe)
+        recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+        print(f"{'ivf':>8} {nprobe:>6} {recall:>7.3f} {qps:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
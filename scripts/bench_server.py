@@ -0,0 +1,159 @@
+""" Load test of the server modes against a stub LLM.
+
+    Starts the endpoints in a child process with a stub model, which takes
+    --latency seconds per request and runs up to --batch requests at once,
+    like the batch scheduler. Then --clients concurrent clients post chat
+    completions for --duration seconds, and the requests/s and latency
+    percentiles are reported for each server mode.
+
+    Usage: python scripts/bench_server.py [--modes flask asgi] [--clients 32]
+"""
+import json
+import time
+import socket
+import argparse
+import threading
+import http.client
+import multiprocessing
+
+import torch
+
+
+class StubTokenizer:
+    def encode(self, text):
+        return torch.zeros(1, len(text.split()), dtype=torch.long)
+
+    def decode(self, ids):
+        return ""
+
+
+class StubLoader:
+    """ Stands in for ExllamaModel, takes a fixed time per request. """
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate(self, prompt, params):
+        time.sleep(self.latency)
+        return "stub", ["The glass transition temperature."], 10, 6, \
+            round(1000 * self.latency)
+
+    def stream(self, prompt, params):
+        for word in "The glass transition temperature.".split():
+            time.sleep(self.latency / 4)
+            yield word + " "
+
+
+def serve(mode, port, latency, batch, threads):
+    import logging
+    import polyai.server.state as state
+    from polyai.server import endpoints
+    from polyai.server.admission import AdmissionQueue
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    state.LLM._loader = StubLoader(latency)
+    state.LLM._model = object()
+    state.LLM._tokenizer = StubTokenizer()
+    state.LLM._model_name = "stub"
+    state.LLM._is_ready = True
+    state.LLM._queue = AdmissionQueue(max_depth=4096, max_running=batch,
+                                      timeout=0)
+    endpoints.run(port, port + 1, mode=mode, threads=threads)
+
+
+def wait_for_port(port, timeout = 30):
+    t0 = time.time()
+    while time.time() < t0 + timeout:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"server did not start on port {port}")
+
+
+def client(port, stop_at, latencies, errors):
+    body = json.dumps({
+        "messages": [{"role": "user", "content": "What is the Tg of PS?"}],
+        "max_tokens": 16,
+    })
+    headers = {"Content-Type": "application/json", "Api-Key": "pl-test"}
+    conn = None
+    while time.time() < stop_at:
+        t0 = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            conn.request("POST", "/polyai/chat/completions", body, headers)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+                continue
+            if resp.getheader("Connection", "").lower() == "close" or \
+                    resp.version == 10:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException) as err:
+            errors.append(type(err).__name__)
+            conn = None
+            continue
+        latencies.append(time.perf_counter() - t0)
+
+
+def load_test(port, clients, duration):
+    latencies, errors = [], []
+    stop_at = time.time() + duration
+    threads = [threading.Thread(target=client,
+                                args=(port, stop_at, latencies, errors))
+               for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    return sorted(latencies), errors, elapsed
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["flask", "asgi"])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients, {args.duration:.0f}s, stub latency "
+          f"{args.latency * 1e3:.0f} ms, batch {args.batch}")
+    print(f"{'mode':>8} {'requests':>9} {'errors':>7} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+
+    for i, mode in enumerate(args.modes):
+        port = args.port + 10 * i
+        proc = multiprocessing.Process(
+            target=serve, daemon=True,
+            args=(mode, port, args.latency, args.batch, args.threads))
+        proc.start()
+        try:
+            wait_for_port(port)
+            load_test(port, args.clients, 1)       # warm up
+            lat, errors, elapsed = load_test(port, args.clients, args.duration)
+        finally:
+            proc.terminate()
+            proc.join()
+
+        print(f"{mode:>8} {len(lat):>9} {len(errors):>7} "
+              f"{len(lat) / elapsed:>8.1f} {percentile(lat, 0.5) * 1e3:>8.1f} "
+              f"{percentile(lat, 0.99) * 1e3:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import pytest
+import torch
+from sqlalchemy import create_engine, select
+
+from polyai.server import orm
+from polyai.server.generation.torch_llama import (TorchLlama,
+                                                  TorchLlamaCache,
+                                                  TorchLlamaConfig)
+
+
+@pytest.fixture(scope="session")
+def model():
+    """ Small random TorchLlama on CPU. """
+    return TorchLlama(TorchLlamaConfig(max_seq_len=128), seed=0)
+
+
+def _greedy(model, prompt, max_new_tokens):
+    cache = TorchLlamaCache(model)
+    ids = torch.tensor([prompt], dtype=torch.long)
+    if len(prompt) > 1:
+        model.forward(ids[:, :-1], cache, preprocess_only=True)
+    tokens = []
+    last = ids[:, -1:]
+    for _ in range(max_new_tokens):
+        token = int(model.forward(last, cache)[0, -1].argmax())
+        tokens.append(token)
+        last = torch.tensor([[token]], dtype=torch.long)
+    return tokens
+
+
+@pytest.fixture(scope="session")
+def greedy():
+    """ Reference greedy decoding of a single sequence. """
+    return _greedy
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """ SQLite database of the orm tables. """
+    # A file, the writer thread does not share an in memory database.
+    en = create_engine(f"sqlite:///{tmp_path / 'polyai.db'}")
+    orm.ORMBase.metadata.create_all(en)
+    yield en
+    en.dispose()
+
+
+def _record(i : int) -> dict:
+    return orm.APIRequest(
+        idStr=f"req-{i}", apikey="key", requrl="/api/test", reqmethod="POST",
+        model="test", request=f"prompt {i}", output=f"output {i}",
+        response={'id': f"req-{i}", 'n': i}, reqheaders={}, respheaders={},
+        elapsed_msec=1, request_tokens=2, response_tokens=3,
+    ).serialize()
+
+
+@pytest.fixture(scope="session")
+def record():
+    """ Record of the i-th api request. """
+    return _record
+
+
+def _rows(engine) -> list:
+    with engine.connect() as conn:
+        return conn.execute(select(orm.APIRequest.idStr)
+                            .order_by(orm.APIRequest.id)).scalars().all()
+
+
+@pytest.fixture(scope="session")
+def rows():
+    """ idStr of the rows of the api_request table. """
+    return _rows
@@ -0,0 +1,133 @@
+import time
+import threading
+
+import pytest
+
+from polyai.server.admission import QueueFull
+from polyai.server.microbatch import MicroBatcher, by_length
+
+
+def _submit_all(batcher, items):
+    """ Submit each item from its own thread, return the results. """
+    results = [None] * len(items)
+    errors = [None] * len(items)
+
+    def run(i):
+        try:
+            results[i] = batcher.submit(items[i], timeout=10)
+        except Exception as err:
+            errors[i] = err
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(items))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_batches_concurrent_items():
+    sizes = []
+
+    def double(items):
+        sizes.append(len(items))
+        return [2 * x for x in items]
+
+    batcher = MicroBatcher(double, max_batch=4, max_wait_ms=200).start()
+    results, errors = _submit_all(batcher, list(range(8)))
+    batcher.close()
+
+    assert results == [2 * x for x in range(8)]
+    assert errors == [None] * 8
+    assert sum(sizes) == 8
+    assert max(sizes) <= 4
+    assert len(sizes) < 8
+    assert batcher.stats()['items'] == 8
+
+
+def test_error_goes_to_every_caller():
+    def fail(items):
+        raise ValueError("bad batch")
+
+    batcher = MicroBatcher(fail, max_batch=4, max_wait_ms=100).start()
+    results, errors = _submit_all(batcher, list(range(4)))
+    batcher.close()
+
+    assert results == [None] * 4
+    assert all(isinstance(err, ValueError) for err in errors)
+    assert batcher.stats()['errors'] >= 1
+
+
+def test_wrong_number_of_results_is_an_error():
+    batcher = MicroBatcher(lambda items: items[:-1], max_wait_ms=0)
+    with pytest.raises(RuntimeError):
+        batcher.submit(1, timeout=10)
+    batcher.close()
+
+
+def test_full_queue_is_overloaded():
+    running = threading.Event()
+    release = threading.Event()
+
+    def wait(items):
+        running.set()
+        release.wait(10)
+        return items
+
+    batcher = MicroBatcher(wait, max_batch=1, max_wait_ms=0, max_queue=1)
+    first = threading.Thread(target=batcher.submit, args=(1, 10))
+    first.start()
+    assert running.wait(10)
+
+    # One item running, one waiting, the next is rejected.
+    second = threading.Thread(target=batcher.submit, args=(2, 10))
+    second.start()
+    while batcher.stats()['waiting'] < 1:
+        time.sleep(0.001)
+    with pytest.raises(QueueFull):
+        batcher.submit(3)
+    assert batcher.stats()['rejected'] == 1
+
+    release.set()
+    first.join()
+    second.join()
+    batcher.close()
+
+
+def test_submit_many_in_order():
+    batcher = MicroBatcher(lambda items: [x + 1 for x in items],
+                           max_batch=3, max_wait_ms=0, max_queue=4)
+    assert batcher.submit_many(list(range(10)), timeout=10) == \
+        list(range(1, 11))
+    batcher.close()
+
+
+def test_submit_after_close_is_rejected():
+    batcher = MicroBatcher(lambda items: items, max_wait_ms=0)
+    assert batcher.submit(1, timeout=10) == 1
+    batcher.close()
+    assert batcher._thread is None
+
+    with pytest.raises(RuntimeError):
+        batcher.submit(2, timeout=1)
+    with pytest.raises(RuntimeError):
+        batcher.submit_many([3], timeout=1)
+
+    # Started again, it takes items.
+    batcher.start()
+    assert batcher.submit(4, timeout=10) == 4
+    batcher.close()
+
+
+def test_by_length_keeps_order():
+    items = ["a" * n for n in (5, 1, 9, 3, 7)]
+    calls = []
+
+    def fn(group):
+        calls.append(group)
+        return [len(x) for x in group]
+
+    assert by_length(fn, items, [len(x) for x in items], 10) == \
+        [5, 1, 9, 3, 7]
+    assert len(calls) > 1
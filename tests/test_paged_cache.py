@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from polyai.server.generation.paged_cache import PagedCache, OutOfBlocks
+from polyai.server.generation.sampling import SamplingParams
+from polyai.server.generation.scheduler import PagedBatchScheduler
+from polyai.server.generation.torch_llama import TorchLlamaCache
+
+
+def test_fork_shares_blocks_copy_on_write(model):
+    cache = PagedCache(model.config, num_blocks=8, block_size=4)
+    cache.add_sequence(0)
+    cache.reserve(0, 6)
+    cache.fork(0, 1)
+    assert cache.block_table(1) == cache.block_table(0)
+    assert cache.utilization()['shared_blocks'] == 2
+
+    # The partially filled last block is copied before it is written.
+    cache.reserve(1, 1)
+    assert cache.block_table(1)[0] == cache.block_table(0)[0]
+    assert cache.block_table(1)[1] != cache.block_table(0)[1]
+    assert cache.utilization()['shared_blocks'] == 1
+
+
+def test_rewind_and_free_release_blocks(model):
+    cache = PagedCache(model.config, num_blocks=8, block_size=4)
+    cache.add_sequence(0)
+    cache.reserve(0, 10)
+    assert cache.allocator.num_used == 3
+    cache.rewind(0, 6)
+    assert cache.length(0) == 4
+    assert cache.allocator.num_used == 1
+    cache.free_sequence(0)
+    assert cache.allocator.num_used == 0
+
+
+def test_failed_reserve_rolls_back(model):
+    cache = PagedCache(model.config, num_blocks=2, block_size=4)
+    cache.add_sequence(0)
+    cache.reserve(0, 4)
+    with pytest.raises(OutOfBlocks):
+        cache.reserve(0, 9)
+    assert cache.length(0) == 4
+    assert len(cache.block_table(0)) == 1
+    assert cache.allocator.num_free == 1
+
+
+def test_forward_paged_matches_forward(model):
+    prompts = [[1, 5, 9, 13, 17, 21], [1, 7, 11]]
+    cache = PagedCache(model.config, num_blocks=16, block_size=4)
+
+    # Rows at different lengths, decoded together.
+    for seq, prompt in enumerate(prompts):
+        cache.add_sequence(seq)
+        ids = torch.tensor([prompt[:-1]], dtype=torch.long)
+        model.forward_paged(ids, cache, [seq], preprocess_only=True)
+    last = torch.tensor([[p[-1]] for p in prompts], dtype=torch.long)
+    paged = model.forward_paged(last, cache, [0, 1])
+
+    for seq, prompt in enumerate(prompts):
+        ids = torch.tensor([prompt], dtype=torch.long)
+        logits = model.forward(ids, TorchLlamaCache(model))
+        assert torch.allclose(paged[seq, -1], logits[0, -1], atol=1e-4)
+
+
+def test_paged_scheduler_matches_single_sequence(model, greedy):
+    prompts = [[1, 5, 9, 13, 17], [1, 7], [1, 30, 31, 32, 33, 34, 35, 36], [1]]
+    params = SamplingParams(temperature=0, top_k=1)
+    expected = [greedy(model, p, 12) for p in prompts]
+
+    # Too few blocks for all the sequences at once.
+    cache = PagedCache(model.config, num_blocks=6, block_size=8)
+    scheduler = PagedBatchScheduler(model, cache, 4, eos_token_id=-1)
+    reqs = [scheduler.submit(p, 12, params) for p in prompts]
+    scheduler.run_until_idle()
+    assert [req.result() for req in reqs] == expected
+    assert cache.utilization()['used_blocks'] == 0
@@ -0,0 +1,49 @@
+from polyai.server.generation.sampling import SamplingParams
+from polyai.server.generation.scheduler import BatchScheduler
+from polyai.server.generation.torch_llama import TorchLlamaCache
+
+GREEDY = SamplingParams(temperature=0, top_k=1)
+PROMPTS = [[1, 5, 9, 13, 17], [1, 7], [1, 30, 31, 32, 33, 34, 35, 36], [1]]
+NO_EOS = -1
+
+
+def run(scheduler, prompts, max_new_tokens):
+    reqs = [scheduler.submit(p, max_new_tokens, GREEDY) for p in prompts]
+    scheduler.run_until_idle()
+    return [req.result() for req in reqs]
+
+
+def test_scheduler_matches_single_sequence(model, greedy):
+    expected = [greedy(model, p, 10) for p in PROMPTS]
+    scheduler = BatchScheduler(model, TorchLlamaCache(model, batch_size=2),
+                               NO_EOS)
+    assert run(scheduler, PROMPTS, 10) == expected
+    assert scheduler.stats()['tokens'] == 10 * len(PROMPTS)
+
+
+def test_scheduler_stops_at_eos(model, greedy):
+    tokens = greedy(model, PROMPTS[0], 10)
+    scheduler = BatchScheduler(model, TorchLlamaCache(model, batch_size=2),
+                               eos_token_id=tokens[3])
+    req = scheduler.submit(PROMPTS[0], 10, GREEDY)
+    scheduler.run_until_idle()
+    assert req.result() == tokens[:tokens.index(tokens[3]) + 1]
+    assert req.finish_reason == "stop"
+
+
+def test_scheduler_cancel_in_background_thread(model, greedy):
+    scheduler = BatchScheduler(model, TorchLlamaCache(model, batch_size=2),
+                               NO_EOS)
+    scheduler.start()
+    try:
+        req = scheduler.submit(PROMPTS[1], 50, GREEDY)
+        for i, _ in enumerate(req.tokens()):
+            if i == 2:
+                req.cancel()
+        assert req.finish_reason == "cancelled"
+        assert 3 <= len(req.generated) < 50
+
+        assert scheduler.submit(PROMPTS[0], 5, GREEDY).result(10) == \
+            greedy(model, PROMPTS[0], 5)
+    finally:
+        scheduler.stop()
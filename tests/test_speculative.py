@@ -0,0 +1,28 @@
+from polyai.server.generation.sampling import SamplingParams
+from polyai.server.generation.speculative import SpeculativeDecoder
+from polyai.server.generation.torch_llama import (TorchLlama,
+                                                  TorchLlamaCache,
+                                                  TorchLlamaConfig)
+
+GREEDY = SamplingParams(temperature=0, top_k=1)
+PROMPTS = [[1, 5, 9, 13, 17], [1, 7], [1, 30, 31, 32, 33, 34, 35, 36], [1]]
+
+
+def test_greedy_matches_main_model(model, greedy):
+    draft = TorchLlama(TorchLlamaConfig(max_seq_len=128, num_hidden_layers=1),
+                       seed=1)
+    spec = SpeculativeDecoder(model, TorchLlamaCache(model),
+                              draft, TorchLlamaCache(draft),
+                              num_draft_tokens=3)
+    for prompt in PROMPTS:
+        assert list(spec.tokens(prompt, 12, GREEDY)) == \
+            greedy(model, prompt, 12)
+
+
+def test_accepts_own_drafts(model, greedy):
+    spec = SpeculativeDecoder(model, TorchLlamaCache(model),
+                              model, TorchLlamaCache(model),
+                              num_draft_tokens=4)
+    tokens = list(spec.tokens(PROMPTS[0], 10, GREEDY))
+    assert tokens == greedy(model, PROMPTS[0], 10)
+    assert spec.stats()['acceptance_rate'] == 1.0
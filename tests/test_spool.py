@@ -0,0 +1,68 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, func, select
+
+from polyai.server import orm
+from polyai.server.spool import Spool, replay_file
+from polyai.server.writer import RequestWriter
+
+
+def test_spool_resumes_from_commit(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory, segment_bytes=32)
+    for i in range(10):
+        spool.append({'n': i})
+    spool.sync()
+    assert len(spool.segments()) > 1
+
+    records, position = spool.read(4)
+    assert [r['n'] for r in records] == [0, 1, 2, 3]
+    spool.commit(position)
+    records, _ = spool.read(2)          # read, not committed
+    spool.close()
+
+    # A torn line at the end is dropped when the spool is opened again.
+    last = os.path.join(directory, f"{spool.segments()[-1]:08d}.jsonl")
+    with open(last, "ab") as fp:
+        fp.write(b'{"n": 1')
+
+    spool = Spool(directory, segment_bytes=32)
+    records, position = spool.read(100)
+    assert [r['n'] for r in records] == list(range(4, 10))
+    spool.commit(position)
+    assert spool.pending_bytes() == 0
+    spool.close()
+
+
+def test_spool_keeps_records_while_database_is_down(engine, tmp_path, record):
+    down = create_engine(f"sqlite:///{tmp_path / 'missing' / 'polyai.db'}")
+    directory = str(tmp_path / "spool")
+
+    writer = RequestWriter(down, batch_size=8, spool=Spool(directory))
+    for i in range(5):
+        assert writer.submit(record(i))
+    with pytest.raises(Exception):
+        writer.replay()
+    writer.spool.close()
+
+    # Loaded once the database is back, after a restart.
+    writer = RequestWriter(engine, batch_size=2, spool=Spool(directory))
+    assert writer.replay() == 5
+    assert writer.replay() == 0
+    writer.spool.close()
+
+    with engine.connect() as conn:
+        count = conn.execute(select(func.count())
+                             .select_from(orm.APIRequest)).scalar()
+    assert count == 5
+
+
+def test_replay_spill_file(engine, tmp_path, record, rows):
+    spill = str(tmp_path / "spill.jsonl")
+    writer = RequestWriter(engine, max_queue=1, policy="spill",
+                           spill_file=spill)
+    writer.submit(record(0))
+    writer.submit(record(1))
+    assert replay_file(spill, writer) == 1
+    assert rows(engine) == ["req-1"]
@@ -0,0 +1,91 @@
+import pytest
+
+from polyai.server.generation.stops import StopMatcher
+from polyai.server.state import LLM
+
+
+def stream(state, pieces):
+    """ Feed (token, text) pieces, return the text sent and the stop. """
+    sent = ""
+    for token, text in pieces:
+        if state.feed_token(token) is not None:
+            return sent, "tokens"
+        packet, stop = state.feed(text)
+        sent += packet
+        if stop is not None:
+            return sent, stop
+    packet, stop = state.finish()
+    return sent + packet, stop
+
+
+def test_stop_string_is_cut_case_insensitive():
+    state = StopMatcher(["\nUser:"]).stream()
+    pieces = enumerate(["Hello", " there", "\nus", "er:", " more"])
+    assert stream(state, pieces) == ("Hello there", "\nUser:")
+
+
+def test_first_given_stop_wins():
+    state = StopMatcher(["b", "ab"]).stream()
+    assert state.feed("xab") == ("xa", "b")
+    state = StopMatcher(["ab", "b"]).stream()
+    assert state.feed("xab") == ("x", "ab")
+
+
+def test_possible_stop_is_held_then_sent():
+    state = StopMatcher(["\nUser:"]).stream()
+    assert state.feed("Hi\nUs") == ("Hi", None)
+    assert state.feed("a") == ("\nUsa", None)
+
+
+def test_stop_token_sequence():
+    state = StopMatcher([], [(5, 6, 7)]).stream()
+    assert [state.feed_token(t) for t in (5, 6, 5, 6, 7)] == \
+        [None, None, None, None, (5, 6, 7)]
+
+
+def test_held_text_is_sent_at_the_end():
+    state = StopMatcher(["\nUser:"]).stream()
+    assert stream(state, enumerate(["Hi", "\nUs"])) == ("Hi\nUs", None)
+    state = StopMatcher(["\nUser:"]).stream()
+    state.feed("Hi\nUs")
+    assert state.finish("er:") == ("", "\nUser:")
+
+
+def test_stop_token_sequence_text_is_not_sent():
+    state = StopMatcher([], [(5, 6, 7)]).stream()
+    pieces = [(1, "a"), (5, "b"), (6, "c"), (7, "d")]
+    assert stream(state, pieces) == ("a", "tokens")
+
+
+def test_broken_stop_token_sequence_is_sent():
+    state = StopMatcher([], [(5, 6, 7)]).stream()
+    assert state.feed_token(5) is None
+    assert state.feed("b") == ("", None)
+    assert state.feed_token(6) is None
+    assert state.feed("c") == ("", None)
+    assert state.feed_token(2) is None
+    assert state.feed("d") == ("bcd", None)
+
+    # Pending at the end of the sequence.
+    state.feed_token(5)
+    state.feed("e")
+    assert state.finish() == ("e", None)
+
+
+@pytest.mark.parametrize("body", [
+    {'stopping_strings': "User"},
+    {'stopping_strings': ["User", 1]},
+    {'stopping_token_ids': 5},
+    {'stopping_token_ids': [True]},
+    {'stopping_token_ids': [[1, "a"]]},
+])
+def test_bad_stop_parameters(body):
+    with pytest.raises(ValueError):
+        LLM.parameters(body)
+
+
+def test_stop_parameters():
+    param = LLM.parameters({'stopping_strings': ["User"],
+                            'stopping_token_ids': [2, [5, 6]]})
+    assert param['stopping_strings'] == ["User"]
+    assert param['stopping_token_ids'] == [2, [5, 6]]
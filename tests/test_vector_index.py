@@ -0,0 +1,25 @@
+import numpy as np
+
+from polyai.server.vector_index import VectorIndex
+
+
+def test_flush_compacts_deleted_rows(tmp_path):
+    rng = np.random.default_rng(0)
+    index = VectorIndex(str(tmp_path))
+    ids = [str(i) for i in range(10)]
+    vectors = rng.standard_normal((10, 8))
+    index.add(ids, vectors)
+    index.flush()
+
+    # Replacing rows masks the old ones until most of them are dead.
+    index.add(ids[:5], vectors[:5])
+    index.flush()
+    assert index.count == 15
+    index.delete(ids[5:])
+    index.flush()
+    assert index.count == len(index) == 5
+
+    # The compacted index is what is loaded again.
+    index = VectorIndex(str(tmp_path))
+    assert index.count == 5
+    assert index.search(vectors[2], k=1)[0][0][0] == "2"
@@ -0,0 +1,53 @@
+import json
+
+from polyai.server.writer import RequestWriter
+
+
+def test_writer_batches(engine, record, rows):
+    writer = RequestWriter(engine, batch_size=4, flush_interval=0.05)
+    writer.start()
+    for i in range(10):
+        assert writer.submit(record(i))
+    writer.close()
+
+    assert rows(engine) == [f"req-{i}" for i in range(10)]
+    stats = writer.stats()
+    assert stats['written'] == 10
+    assert stats['flushes'] >= 3
+
+
+def test_writer_full_queue_drops_newest(engine, record):
+    writer = RequestWriter(engine, max_queue=2)
+    assert writer.submit(record(0))
+    assert writer.submit(record(1))
+    assert not writer.submit(record(2))
+    assert writer.stats()['dropped'] == 1
+    assert [r['idStr'] for r in writer._queue] == ["req-0", "req-1"]
+
+
+def test_writer_full_queue_drops_oldest(engine, record):
+    writer = RequestWriter(engine, max_queue=2, policy="drop_oldest")
+    for i in range(3):
+        writer.submit(record(i))
+    assert [r['idStr'] for r in writer._queue] == ["req-1", "req-2"]
+
+
+def test_writer_spills_full_queue(engine, tmp_path, record):
+    spill = tmp_path / "spill.jsonl"
+    writer = RequestWriter(engine, max_queue=1, policy="spill",
+                           spill_file=str(spill))
+    assert writer.submit(record(0))
+    assert not writer.submit(record(1))
+    assert writer.stats()['spilled'] == 1
+    lines = spill.read_text().splitlines()
+    assert [json.loads(line)['idStr'] for line in lines] == ["req-1"]
+
+
+def test_writer_skips_written_records(engine, record, rows):
+    writer = RequestWriter(engine)
+    assert writer.load([record(0), record(1)]) == 2
+
+    # Replayed records are skipped by their idStr.
+    assert writer.load([record(1), record(2)]) == 1
+    assert writer.stats()['skipped'] == 1
+    assert rows(engine) == ["req-0", "req-1", "req-2"]